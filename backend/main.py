@@ -2,30 +2,221 @@
 AI 流程图生成器 - 后端 API
 支持调用大模型生成 draw.io XML 格式的流程图
 """
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.openapi.docs import get_swagger_ui_html, get_redoc_html
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Tuple, Callable, Awaitable
+from contextlib import asynccontextmanager, aclosing
+from contextvars import ContextVar
 import httpx
 import json
 import os
 import re
+import sys
+import time
 from datetime import datetime
 from xml.etree import ElementTree as ET
 from dotenv import load_dotenv
 import asyncio
+import atexit
+import bisect
+import copy
+import logging
+import logging.handlers
+import queue
+import random
+import signal
+from collections import deque, OrderedDict
+import hashlib
+import uuid
+import base64
+import gzip
+import zlib
+import urllib.parse
+import sqlite3
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+# HTTP/2 需要可选依赖 h2（pip install httpx[http2]）
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Redis 共享状态需要可选依赖 redis（pip install redis）
+try:
+    from redis import asyncio as redis_asyncio
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# zstd 压缩需要可选依赖 zstandard
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
 
 # 加载环境变量（优先加载 .env 文件）
 load_dotenv()
 
+# ========== 日志 ==========
+# 结构化日志：调用方只把记录放入队列，由后台线程格式化并写出，stdout 阻塞（如容器日志驱动）不会卡住事件循环
+# DEV_MODE=true 时默认输出易读的文本和全部调试日志；否则默认输出 JSON，调试日志按比例采样
+DEV_MODE = os.getenv("DEV_MODE", "true").lower() == "true"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if DEV_MODE else "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text" if DEV_MODE else "json").lower()
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0" if DEV_MODE else "0.1"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 队列满时丢弃新记录，不阻塞调用方
+
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+_LOG_TAG_RE = re.compile(r'^\[([^\]]+)\]\s*')
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id"}
+
+class LogContextFilter(logging.Filter):
+    """在调用方补充 request_id，并对调试日志采样"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG and LOG_DEBUG_SAMPLE_RATE < 1 and random.random() >= LOG_DEBUG_SAMPLE_RATE:
+            return False
+        record.request_id = request_id_var.get()
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """只在调用方合并消息参数，JSON 序列化和写出都交给后台线程；队列满时丢弃"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JSONLogFormatter(logging.Formatter):
+    """每条记录一行 JSON：时间、级别、标签（消息开头的 [xxx]）、消息、request_id 及 extra 字段"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        match = _LOG_TAG_RE.match(message)
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "tag": match.group(1) if match else None,
+            "message": message[match.end():] if match else message,
+            "request_id": getattr(record, "request_id", "-"),
+            "pid": record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    """开发模式的文本格式：时间 级别 request_id 消息"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = (f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]} "
+                f"{record.levelname:<7} {getattr(record, 'request_id', '-'):<12} {record.getMessage()}")
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+def setup_logging() -> Tuple[logging.Logger, logging.handlers.QueueListener]:
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(LogContextFilter())
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)  # 退出前写完队列中剩余的记录
+
+    app_logger = logging.getLogger("auto_drawio")
+    app_logger.setLevel(LOG_LEVEL)
+    app_logger.addHandler(handler)
+    app_logger.propagate = False
+    return app_logger, listener
+
+logger, log_listener = setup_logging()
+
+class RequestIdMiddleware:
+    """为每个请求分配 request_id（优先使用 X-Request-ID 请求头），写入日志上下文和响应头"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:12]
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", []).append((b"x-request-id", request_id.encode("latin-1")))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期：启动 XML 处理进程池、与共享存储同步配置并开始接收变更通知、启动熔断探测任务；
+    关闭时释放进程池、上游 HTTP 连接池、图表存储和共享存储
+    """
+    # fork 出进程池子进程时进程中只能有主线程：暂停日志写出线程，子进程启动后再恢复；
+    # 共享存储、图表存储的数据库线程在第一次数据库操作（config_manager.sync）时才创建
+    log_listener.stop()
+    try:
+        xml_pool.start()
+    finally:
+        log_listener.start()
+    await config_manager.sync()
+    await shared_state.start()
+    probe_task = asyncio.create_task(circuit_probe_loop())
+    lag_task = asyncio.create_task(loop_lag_monitor())
+    yield
+    probe_task.cancel()
+    lag_task.cancel()
+    xml_pool.shutdown()
+    await client_pool.aclose()
+    diagram_store.close()
+    await shared_state.close()
+
 # 使用国内 CDN 镜像
 app = FastAPI(
     title="AI 流程图生成器",
     docs_url=None,  # 禁用默认的 docs
-    redoc_url=None  # 禁用默认的 redoc
+    redoc_url=None,  # 禁用默认的 redoc
+    lifespan=lifespan
 )
 
 # 配置 CORS（允许前端跨域请求）
@@ -36,6 +227,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestIdMiddleware)
 
 # ========== 数据模型 ==========
 
@@ -53,6 +245,8 @@ class AIConfigModel(BaseModel):
     enabled: bool = True  # 是否启用
     priority: int = 0  # 优先级（数字越小优先级越高）
     is_system: bool = False  # 是否为系统配置（系统配置不可编辑/删除，对用户隐藏敏感信息）
+    timeout: Optional[float] = None  # 请求超时（秒），为空时使用各接口的默认值
+    history_token_budget: Optional[int] = None  # 对话历史的 token 预算，为空时使用 HISTORY_TOKEN_BUDGET
 
 class AIConfigCreateRequest(BaseModel):
     """创建 AI 配置请求"""
@@ -62,6 +256,8 @@ class AIConfigCreateRequest(BaseModel):
     model: str
     enabled: bool = True
     priority: int = 0
+    timeout: Optional[float] = None
+    history_token_budget: Optional[int] = None
 
 class AIConfigUpdateRequest(BaseModel):
     """更新 AI 配置请求"""
@@ -71,33 +267,1358 @@ class AIConfigUpdateRequest(BaseModel):
     model: Optional[str] = None
     enabled: Optional[bool] = None
     priority: Optional[int] = None
+    timeout: Optional[float] = None
+    history_token_budget: Optional[int] = None
 
 class DiagramGenerateRequest(BaseModel):
     prompt: str
     messages: Optional[List[Message]] = []  # 对话历史
     skip_apis: Optional[List[str]] = []     # 要跳过的 API 名称列表
     system_prompt: Optional[str] = None     # 自定义系统提示词（用于模板）
+    no_cache: bool = False                  # 跳过结果缓存（重新生成时使用）
+    session_id: Optional[str] = None        # 服务端会话 ID，提供时忽略 messages，使用服务端保存的历史
+    edit_mode: Optional[bool] = None        # 补丁模式：None 按 EDIT_MODE 自动选择，True/False 强制开启/关闭
+    chunked: bool = False                   # 分块生成：先生成子系统大纲，再并行生成各子系统（用于大型流程图）
+    auto_layout: Optional[bool] = None      # 拓扑模式：模型只给出节点和连线，坐标由服务端自动布局；None 按 AUTO_LAYOUT
+    dsl: Optional[bool] = None              # DSL 模式：模型输出节点/连线 DSL，由服务端编译为 XML；None 按 DSL_MODE
 
 class DiagramSaveRequest(BaseModel):
     xml: str
     name: Optional[str] = None
 
+class DiagramLayoutRequest(BaseModel):
+    xml: str
+    direction: Optional[str] = None  # TB / LR，不提供时使用 LAYOUT_DIRECTION
+
 class DiagramResponse(BaseModel):
     id: str
     xml: str
     name: Optional[str] = None
     created_at: str
 
-# ========== 模拟数据库 ==========
-# 生产环境应使用 PostgreSQL/MongoDB
-diagrams_db: Dict[str, dict] = {}
-diagram_counter = 1
+# ========== 图表压缩 ==========
+# 保存的图表 XML 压缩存储：gzip（默认）/ zstd（需要 pip install zstandard）/ none
+DIAGRAM_COMPRESSION = os.getenv("DIAGRAM_COMPRESSION", "gzip").lower()
+if DIAGRAM_COMPRESSION == "zstd" and not ZSTD_AVAILABLE:
+    logger.warning("[存储] 未安装 zstandard，图表压缩改用 gzip")
+    DIAGRAM_COMPRESSION = "gzip"
+
+def compress_diagram(xml: str) -> Tuple[object, str]:
+    """按 DIAGRAM_COMPRESSION 压缩 XML，返回 (数据, 编码)；编码与 HTTP Content-Encoding 一致"""
+    if DIAGRAM_COMPRESSION == "gzip":
+        return gzip.compress(xml.encode('utf-8'), compresslevel=6, mtime=0), "gzip"
+    if DIAGRAM_COMPRESSION == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(xml.encode('utf-8')), "zstd"
+    return xml, "identity"
+
+def decompress_diagram(data, encoding: str) -> str:
+    if encoding == "gzip":
+        return gzip.decompress(data).decode('utf-8')
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return data
+
+# draw.io 原生压缩格式：<diagram> 内容为 base64(deflateRaw(encodeURIComponent(xml)))
+_DRAWIO_COMPRESSED_RE = re.compile(r'(<diagram\b[^>]*>)\s*([A-Za-z0-9+/=\s]+?)\s*(</diagram>)')
+_DRAWIO_PLAIN_RE = re.compile(r'(<diagram\b[^>]*>)\s*(<mxGraphModel\b.*?</mxGraphModel>)\s*(</diagram>)', re.DOTALL)
+
+def inflate_drawio_diagrams(xml: str) -> str:
+    """把 draw.io 压缩的 <diagram> 内容展开为 mxGraphModel，统一以明文结构保存"""
+    def inflate(match):
+        try:
+            data = base64.b64decode(match.group(2))
+            model = urllib.parse.unquote(zlib.decompress(data, -15).decode('utf-8'))
+        except Exception:
+            return match.group(0)
+        return match.group(1) + model + match.group(3)
+    return _DRAWIO_COMPRESSED_RE.sub(inflate, xml)
+
+def deflate_drawio_diagrams(xml: str) -> str:
+    """把 <diagram> 中的 mxGraphModel 压缩为 draw.io 原生格式"""
+    def deflate(match):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        encoded = urllib.parse.quote(match.group(2), safe="~()*!.'")
+        data = compressor.compress(encoded.encode('utf-8')) + compressor.flush()
+        return match.group(1) + base64.b64encode(data).decode('ascii') + match.group(3)
+    return _DRAWIO_PLAIN_RE.sub(deflate, xml)
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """客户端的 Accept-Encoding 是否接受指定编码（忽略 q=0）"""
+    for item in accept_encoding.split(","):
+        token, _, params = item.strip().partition(";")
+        if token.strip().lower() == encoding:
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+# ========== 图表版本历史 ==========
+# 每次更新保存为相对上一版本的 mxCell 级差异（按 cell id），每隔若干版本保存一次完整快照，
+# 读取任意版本只需 快照 + 不超过 DIAGRAM_SNAPSHOT_INTERVAL - 1 个差异
+DIAGRAM_SNAPSHOT_INTERVAL = int(os.getenv("DIAGRAM_SNAPSHOT_INTERVAL", "20"))
+
+def decompose_diagram(xml: str) -> Optional[dict]:
+    """
+    把图表拆分为 frame（去掉所有 cell 的骨架）和按顺序排列的 cells
+    cell 的键为 "页序号:id"，多页图表中不同页的相同 id 互不冲突；无法解析时返回 None
+    """
+    try:
+        tree = ET.fromstring(xml)
+    except ET.ParseError:
+        return None
+
+    cells: Dict[str, str] = {}
+    for page, root in enumerate(list(tree.iter('root'))):
+        for n, child in enumerate(list(root)):
+            cell_id = child.get('id')
+            key = f"{page}:{cell_id}" if cell_id is not None else f"{page}:#{n}"
+            if key in cells:
+                key = f"{key}#{n}"  # 重复 id
+            child.tail = None
+            cells[key] = ET.tostring(child, encoding='unicode')
+            root.remove(child)
+
+    return {"frame": ET.tostring(tree, encoding='unicode'), "cells": cells}
+
+def compose_diagram(state: dict) -> str:
+    tree = ET.fromstring(state["frame"])
+    roots = list(tree.iter('root'))
+    for key, cell_xml in state["cells"].items():
+        page = int(key.split(':', 1)[0])
+        roots[page].append(ET.fromstring(cell_xml))
+    return ET.tostring(tree, encoding='unicode')
+
+def diff_states(old: dict, new: dict) -> dict:
+    """计算 old → new 的差异：frame / set（新增或修改）/ del / order（仅顺序变化时）"""
+    delta = {}
+    if old["frame"] != new["frame"]:
+        delta["frame"] = new["frame"]
+
+    changed = {k: v for k, v in new["cells"].items() if old["cells"].get(k) != v}
+    removed = [k for k in old["cells"] if k not in new["cells"]]
+    if changed:
+        delta["set"] = changed
+    if removed:
+        delta["del"] = removed
+
+    # apply_delta 保持原有 cell 的位置并把新 cell 追加到末尾，与新顺序不一致时记录完整顺序
+    # （只比较每页内部的顺序，compose_diagram 按页分别追加）
+    def by_page(keys: List[str]) -> List[str]:
+        return sorted(keys, key=lambda k: int(k.split(':', 1)[0]))
+
+    merged = [k for k in old["cells"] if k in new["cells"]] + [k for k in new["cells"] if k not in old["cells"]]
+    if by_page(merged) != by_page(list(new["cells"])):
+        delta["order"] = list(new["cells"])
+    return delta
+
+def apply_delta(state: dict, delta: dict) -> dict:
+    cells = dict(state["cells"])
+    for key in delta.get("del", []):
+        cells.pop(key, None)
+    cells.update(delta.get("set", {}))
+    if "order" in delta:
+        cells = {key: cells[key] for key in delta["order"]}
+    return {"frame": delta.get("frame", state["frame"]), "cells": cells}
+
+def build_revision(prev_xml: Optional[str], xml: str, revision: int) -> Tuple[str, str]:
+    """返回 (kind, payload)：到达快照间隔、无法解析或差异不够小时保存完整快照"""
+    if prev_xml is not None and (revision - 1) % DIAGRAM_SNAPSHOT_INTERVAL != 0:
+        old, new = decompose_diagram(prev_xml), decompose_diagram(xml)
+        if old is not None and new is not None:
+            delta = json.dumps(diff_states(old, new), ensure_ascii=False, separators=(",", ":"))
+            if len(delta) < len(xml) // 2:
+                return "delta", delta
+    return "snapshot", xml
+
+def reconstruct_revision(records: List[dict]) -> str:
+    """records 为从最近快照到目标版本的记录（含 kind / data / encoding）"""
+    xml = decompress_diagram(records[0]["data"], records[0]["encoding"])
+    if len(records) == 1:
+        return xml
+
+    state = decompose_diagram(xml)
+    for record in records[1:]:
+        state = apply_delta(state, json.loads(decompress_diagram(record["data"], record["encoding"])))
+    return compose_diagram(state)
+
+def diff_revisions(old_xml: str, new_xml: str) -> dict:
+    """按 cell id 比较两个版本"""
+    old, new = decompose_diagram(old_xml), decompose_diagram(new_xml)
+    if old is None or new is None:
+        raise ValueError("图表 XML 无法解析，不能比较")
+
+    def cell_ref(key: str) -> dict:
+        page, cell_id = key.split(':', 1)
+        return {"page": int(page), "id": cell_id}
+
+    delta = diff_states(old, new)
+    return {
+        "added": [cell_ref(k) for k in delta.get("set", {}) if k not in old["cells"]],
+        "changed": [cell_ref(k) for k in delta.get("set", {}) if k in old["cells"]],
+        "removed": [cell_ref(k) for k in delta.get("del", [])],
+        "reordered": "order" in delta,
+        "frame_changed": "frame" in delta
+    }
+
+# ========== 共享状态（多 worker 部署）==========
+# uvicorn --workers N 时每个 worker 是独立进程，AI 配置和会话必须放在共享存储中，各 worker 只保留本地缓存
+# 某个 worker 修改后发布变更通知，其它 worker 收到后使对应的本地缓存失效
+# STATE_BACKEND=sqlite（默认，文件存储，同一台机器的 worker 共享）、redis（需要 pip install redis，可跨机器）
+# 或 memory（只在当前进程内有效，仅适合单 worker 开发调试）
+WORKERS = int(os.getenv("WORKERS", "1"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite").lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "data/state.db")
+STATE_POLL_INTERVAL = float(os.getenv("STATE_POLL_INTERVAL", "0.5"))  # SQLite 存储轮询变更通知的间隔（秒）
+STATE_EVENT_RETENTION = 300  # SQLite 存储中变更通知保留时间（秒）
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "autodrawio")
+
+WORKER_ID = uuid.uuid4().hex[:8]  # 区分变更通知来自哪个 worker，自己发出的通知不再处理
+
+class SharedState:
+    """
+    共享状态接口，所有方法均为异步
+    - hash：名称 → {字段: 值}，用于 AI 配置
+    - list：名称 → [值...]，原子追加并可设置、延长过期时间，用于会话历史
+    - 计数器：生成全局唯一的 ID
+    - 变更通知：publish 发给其它 worker，subscribe 注册的回调在收到通知时执行
+    """
+
+    def __init__(self):
+        self._subscribers: List[Callable[[dict], Awaitable[None]]] = []
+        self._listen_task: Optional[asyncio.Task] = None
+
+    async def hash_get_all(self, name: str) -> Dict[str, str]:
+        raise NotImplementedError
+
+    async def hash_set(self, name: str, field: str, value: str):
+        raise NotImplementedError
+
+    async def hash_delete(self, name: str, field: str) -> bool:
+        raise NotImplementedError
+
+    async def list_get(self, name: str) -> Optional[List[bytes]]:
+        """读取列表；不存在或已过期时返回 None"""
+        raise NotImplementedError
+
+    async def list_append(self, name: str, values: List[bytes], ttl: int,
+                          max_len: int = 0, create: bool = True) -> bool:
+        """
+        追加到列表末尾，并把过期时间重置为 ttl 秒后
+        max_len > 0 时只保留最后 max_len 项；create=False 时列表不存在（或已过期）则不追加并返回 False
+        """
+        raise NotImplementedError
+
+    async def expire(self, name: str, ttl: int) -> bool:
+        """把列表的过期时间重置为 ttl 秒后；不存在或已过期时返回 False"""
+        raise NotImplementedError
+
+    async def delete(self, name: str) -> bool:
+        raise NotImplementedError
+
+    async def incr(self, name: str) -> int:
+        raise NotImplementedError
+
+    async def publish(self, event: dict):
+        """发布变更通知（event 中的 kind 字段区分类型）"""
+        raise NotImplementedError
+
+    async def _listen(self):
+        """接收其它 worker 的变更通知并调用 _dispatch，直到被取消"""
+        raise NotImplementedError
+
+    def subscribe(self, callback: Callable[[dict], Awaitable[None]]):
+        self._subscribers.append(callback)
+
+    async def _dispatch(self, event: dict):
+        if event.get("origin") == WORKER_ID:
+            return
+        for callback in self._subscribers:
+            try:
+                await callback(event)
+            except Exception as e:
+                logger.error(f"[共享状态] 处理变更通知失败: {e}")
+
+    async def start(self):
+        self._listen_task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+            try:
+                await self._listen_task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+class MemorySharedState(SharedState):
+    """进程内实现：没有其它 worker，不需要变更通知"""
+
+    def __init__(self):
+        super().__init__()
+        self._hashes: Dict[str, Dict[str, str]] = {}
+        self._lists: Dict[str, Tuple[List[bytes], float]] = {}
+        self._counters: Dict[str, int] = {}
+
+    async def hash_get_all(self, name: str) -> Dict[str, str]:
+        return dict(self._hashes.get(name, {}))
+
+    async def hash_set(self, name: str, field: str, value: str):
+        self._hashes.setdefault(name, {})[field] = value
+
+    async def hash_delete(self, name: str, field: str) -> bool:
+        return self._hashes.get(name, {}).pop(field, None) is not None
+
+    async def list_get(self, name: str) -> Optional[List[bytes]]:
+        entry = self._lists.get(name)
+        if entry is None or entry[1] <= time.time():
+            self._lists.pop(name, None)
+            return None
+        return list(entry[0])
+
+    async def list_append(self, name: str, values: List[bytes], ttl: int,
+                          max_len: int = 0, create: bool = True) -> bool:
+        current = await self.list_get(name)
+        if current is None and not create:
+            return False
+        items = (current or []) + values
+        self._lists[name] = (items[-max_len:] if max_len > 0 else items, time.time() + ttl)
+        return True
+
+    async def expire(self, name: str, ttl: int) -> bool:
+        current = await self.list_get(name)
+        if current is None:
+            return False
+        self._lists[name] = (self._lists[name][0], time.time() + ttl)
+        return True
+
+    async def delete(self, name: str) -> bool:
+        existed = self._hashes.pop(name, None) is not None
+        return self._lists.pop(name, None) is not None or existed
+
+    async def incr(self, name: str) -> int:
+        self._counters[name] = self._counters.get(name, 0) + 1
+        return self._counters[name]
+
+    async def publish(self, event: dict):
+        pass
+
+    async def start(self):
+        pass
+
+class SQLiteSharedState(SharedState):
+    """
+    SQLite 文件实现：同一台机器上的 worker 共享同一个数据库文件（WAL 模式，多进程安全）
+    变更通知写入 events 表，各 worker 按 STATE_POLL_INTERVAL 轮询新记录
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS state_hash (
+            name TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL,
+            PRIMARY KEY (name, field)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS state_list (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, value BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_state_list_name ON state_list (name, seq);
+        CREATE TABLE IF NOT EXISTS state_expiry (name TEXT PRIMARY KEY, expires_at REAL NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS state_counter (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS state_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str, poll_interval: float):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self._db: Optional[sqlite3.Connection] = None
+        self._last_event = 0
+        # 单线程执行器：所有数据库操作串行执行；在当前线程打开数据库，执行器线程到第一次数据库操作时才创建，
+        # 启动 XML 进程池时进程中还没有其它线程（见 lifespan）
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-db")
+        self._open_db()
+
+    def _open_db(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA busy_timeout=30000")
+        self._db.executescript(self.SCHEMA)
+        # 只处理启动之后的变更通知，启动时的状态直接从表中读取
+        self._last_event = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM state_events").fetchone()[0]
+
+    async def _run_db(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _transaction(self, fn: Callable, *args):
+        """BEGIN IMMEDIATE 立即获取写锁，读-改-写在多个进程之间也是原子的"""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        return result
+
+    async def hash_get_all(self, name: str) -> Dict[str, str]:
+        rows = await self._run_db(
+            lambda: self._db.execute("SELECT field, value FROM state_hash WHERE name = ?", (name,)).fetchall()
+        )
+        return dict(rows)
+
+    async def hash_set(self, name: str, field: str, value: str):
+        await self._run_db(
+            self._db.execute, "INSERT OR REPLACE INTO state_hash (name, field, value) VALUES (?, ?, ?)",
+            (name, field, value)
+        )
+
+    async def hash_delete(self, name: str, field: str) -> bool:
+        cursor = await self._run_db(
+            self._db.execute, "DELETE FROM state_hash WHERE name = ? AND field = ?", (name, field)
+        )
+        return cursor.rowcount > 0
+
+    def _list_get(self, name: str) -> Optional[List[bytes]]:
+        row = self._db.execute("SELECT expires_at FROM state_expiry WHERE name = ?", (name,)).fetchone()
+        if row is None or row[0] <= time.time():
+            return None
+        return [r[0] for r in self._db.execute("SELECT value FROM state_list WHERE name = ? ORDER BY seq", (name,))]
+
+    async def list_get(self, name: str) -> Optional[List[bytes]]:
+        return await self._run_db(self._list_get, name)
+
+    def _list_append(self, name: str, values: List[bytes], ttl: int, max_len: int, create: bool) -> bool:
+        row = self._db.execute("SELECT expires_at FROM state_expiry WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] <= time.time():
+            self._delete(name)  # 已过期的旧列表不再延续
+            row = None
+        if row is None and not create:
+            return False
+        self._db.executemany("INSERT INTO state_list (name, value) VALUES (?, ?)", [(name, v) for v in values])
+        if max_len > 0:
+            self._db.execute(
+                "DELETE FROM state_list WHERE name = ? AND seq <= "
+                "(SELECT seq FROM state_list WHERE name = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                (name, name, max_len)
+            )
+        self._db.execute("INSERT OR REPLACE INTO state_expiry (name, expires_at) VALUES (?, ?)", (name, time.time() + ttl))
+        return True
+
+    async def list_append(self, name: str, values: List[bytes], ttl: int,
+                          max_len: int = 0, create: bool = True) -> bool:
+        return await self._run_db(self._transaction, self._list_append, name, values, ttl, max_len, create)
+
+    async def expire(self, name: str, ttl: int) -> bool:
+        now = time.time()
+        cursor = await self._run_db(
+            self._db.execute, "UPDATE state_expiry SET expires_at = ? WHERE name = ? AND expires_at > ?",
+            (now + ttl, name, now)
+        )
+        return cursor.rowcount > 0
+
+    def _delete(self, name: str) -> bool:
+        deleted = self._db.execute("DELETE FROM state_list WHERE name = ?", (name,)).rowcount
+        deleted += self._db.execute("DELETE FROM state_expiry WHERE name = ?", (name,)).rowcount
+        deleted += self._db.execute("DELETE FROM state_hash WHERE name = ?", (name,)).rowcount
+        return deleted > 0
+
+    async def delete(self, name: str) -> bool:
+        return await self._run_db(self._transaction, self._delete, name)
+
+    async def incr(self, name: str) -> int:
+        def increment():
+            self._db.execute(
+                "INSERT INTO state_counter (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,)
+            )
+            return self._db.execute("SELECT value FROM state_counter WHERE name = ?", (name,)).fetchone()[0]
+        return await self._run_db(self._transaction, increment)
+
+    async def publish(self, event: dict):
+        await self._run_db(
+            self._db.execute, "INSERT INTO state_events (origin, payload, created_at) VALUES (?, ?, ?)",
+            (WORKER_ID, json.dumps(event, ensure_ascii=False), time.time())
+        )
+
+    def _poll(self) -> List[dict]:
+        rows = self._db.execute(
+            "SELECT seq, origin, payload FROM state_events WHERE seq > ? ORDER BY seq", (self._last_event,)
+        ).fetchall()
+        if rows:
+            self._last_event = rows[-1][0]
+        return [{**json.loads(payload), "origin": origin} for _, origin, payload in rows]
+
+    def _cleanup(self):
+        """删除过期的通知和会话"""
+        now = time.time()
+        self._db.execute("DELETE FROM state_events WHERE created_at < ?", (now - STATE_EVENT_RETENTION,))
+        expired = [r[0] for r in self._db.execute("SELECT name FROM state_expiry WHERE expires_at <= ?", (now,))]
+        for name in expired:
+            self._transaction(self._delete, name)
+
+    async def _listen(self):
+        last_cleanup = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                for event in await self._run_db(self._poll):
+                    await self._dispatch(event)
+                if time.monotonic() - last_cleanup > STATE_EVENT_RETENTION:
+                    last_cleanup = time.monotonic()
+                    await self._run_db(self._cleanup)
+            except sqlite3.Error as e:
+                logger.warning(f"[共享状态] 读取变更通知失败: {e}")
+
+    async def close(self):
+        await super().close()
+        self._executor.submit(self._db.close).result()
+        self._executor.shutdown(wait=True)
+
+class RedisSharedState(SharedState):
+    """
+    Redis 实现（兼容 Redis 协议的服务均可，如 Valkey、KeyDB）
+    hash/list 对应同名的 Redis 类型，变更通知使用 PUBLISH/SUBSCRIBE
+    """
+
+    def __init__(self, url: str, prefix: str):
+        super().__init__()
+        self.prefix = prefix
+        self._redis = redis_asyncio.from_url(url)
+        self._channel = f"{prefix}:events"
+
+    def _key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    async def hash_get_all(self, name: str) -> Dict[str, str]:
+        values = await self._redis.hgetall(self._key(name))
+        return {field.decode(): value.decode() for field, value in values.items()}
+
+    async def hash_set(self, name: str, field: str, value: str):
+        await self._redis.hset(self._key(name), field, value)
+
+    async def hash_delete(self, name: str, field: str) -> bool:
+        return await self._redis.hdel(self._key(name), field) > 0
+
+    async def list_get(self, name: str) -> Optional[List[bytes]]:
+        values = await self._redis.lrange(self._key(name), 0, -1)
+        return values or None
+
+    async def list_append(self, name: str, values: List[bytes], ttl: int,
+                          max_len: int = 0, create: bool = True) -> bool:
+        key = self._key(name)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            # RPUSHX 只在列表已存在时追加；对不存在的键 LTRIM/EXPIRE 不会创建它
+            (pipe.rpush if create else pipe.rpushx)(key, *values)
+            if max_len > 0:
+                pipe.ltrim(key, -max_len, -1)
+            pipe.expire(key, ttl)
+            length = (await pipe.execute())[0]
+        return length > 0
+
+    async def expire(self, name: str, ttl: int) -> bool:
+        return bool(await self._redis.expire(self._key(name), ttl))
+
+    async def delete(self, name: str) -> bool:
+        return await self._redis.delete(self._key(name)) > 0
+
+    async def incr(self, name: str) -> int:
+        return await self._redis.incr(self._key(name))
+
+    async def publish(self, event: dict):
+        await self._redis.publish(self._channel, json.dumps({**event, "origin": WORKER_ID}, ensure_ascii=False))
+
+    async def _listen(self):
+        # 连接断开后重新订阅；断开期间错过的通知无法补发，因此重连后通知所有订阅者全量刷新
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self._channel)
+                    async for message in pubsub.listen():
+                        if message["type"] == "subscribe":
+                            await self._dispatch({"kind": "resync", "origin": ""})
+                        elif message["type"] == "message":
+                            await self._dispatch(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[共享状态] Redis 订阅断开，稍后重连: {e}")
+                await asyncio.sleep(1)
+
+    async def close(self):
+        await super().close()
+        await self._redis.aclose()
+
+def create_shared_state() -> SharedState:
+    if STATE_BACKEND == "redis":
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("STATE_BACKEND=redis 需要安装 redis（pip install redis）")
+        logger.info(f"[共享状态] 使用 Redis: {REDIS_URL}")
+        return RedisSharedState(REDIS_URL, REDIS_PREFIX)
+    if STATE_BACKEND == "memory":
+        if WORKERS > 1:
+            logger.warning("[共享状态] 多个 worker 不能使用 memory 存储，各 worker 之间的配置和会话将不一致")
+        return MemorySharedState()
+    logger.info(f"[共享状态] 使用 SQLite 存储: {STATE_DB_PATH}")
+    return SQLiteSharedState(STATE_DB_PATH, STATE_POLL_INTERVAL)
+
+shared_state = create_shared_state()
+
+# ========== 图表存储 ==========
+# DIAGRAM_STORE=sqlite（默认，持久化）或 memory（仅用于开发调试）
+DIAGRAM_STORE = os.getenv("DIAGRAM_STORE", "sqlite").lower()
+DIAGRAM_DB_PATH = os.getenv("DIAGRAM_DB_PATH", "data/diagrams.db")
+DIAGRAM_DB_THREADS = int(os.getenv("DIAGRAM_DB_THREADS", "4"))
+DIAGRAM_DB_CACHE_KB = int(os.getenv("DIAGRAM_DB_CACHE_KB", "8192"))  # 每个连接的页缓存上限
+
+DIAGRAM_SORT_FIELDS = ("created_at", "updated_at")
+DIAGRAM_LIST_MAX_LIMIT = 200
+
+def encode_cursor(sort_value: str, diagram_id: str) -> str:
+    """分页游标：上一页最后一条的 (排序字段值, id)"""
+    raw = json.dumps([sort_value, int(diagram_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, diagram_id = json.loads(raw)
+        if not isinstance(sort_value, str) or not isinstance(diagram_id, int):
+            raise ValueError
+        return sort_value, diagram_id
+    except Exception:
+        raise ValueError("无效的分页游标")
+
+def name_prefix_upper_bound(prefix: str) -> str:
+    """name >= prefix AND name < 上界，等价于前缀匹配且可以使用 name 索引"""
+    return prefix + chr(0x10FFFF)
+
+class DiagramStore:
+    """
+    图表存储接口，所有方法均为异步
+    图表以 dict 表示：id / name / xml / created_at / updated_at
+    XML 以 compress_diagram 的结果保存，get_encoded 返回未解压的数据
+    """
+
+    async def create(self, xml: str, name: Optional[str]) -> dict:
+        raise NotImplementedError
+
+    async def get(self, diagram_id: str) -> Optional[dict]:
+        diagram = await self.get_encoded(diagram_id)
+        if diagram is None:
+            return None
+        data, encoding = diagram.pop("data"), diagram.pop("encoding")
+        diagram["xml"] = decompress_diagram(data, encoding)
+        return diagram
+
+    async def get_encoded(self, diagram_id: str) -> Optional[dict]:
+        """返回图表元数据及压缩数据（data / encoding 字段代替 xml）"""
+        raise NotImplementedError
+
+    async def update(self, diagram_id: str, xml: str, name: Optional[str]) -> bool:
+        raise NotImplementedError
+
+    async def delete(self, diagram_id: str) -> bool:
+        raise NotImplementedError
+
+    async def list(self, limit: int, cursor: Optional[str] = None, sort: str = "created_at",
+                   descending: bool = True, name_prefix: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        按 (sort, id) 游标分页列出图表元数据（不含 xml）
+        返回 (本页图表, 下一页游标)，没有下一页时游标为 None
+        """
+        raise NotImplementedError
+
+    async def count(self, name_prefix: Optional[str] = None) -> int:
+        raise NotImplementedError
+
+    async def list_revisions(self, diagram_id: str) -> Optional[List[dict]]:
+        """列出版本（新的在前）；图表不存在时返回 None"""
+        raise NotImplementedError
+
+    async def get_revision(self, diagram_id: str, revision: int) -> Optional[dict]:
+        """重建指定版本，返回 revision / xml / created_at；不存在时返回 None"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class MemoryDiagramStore(DiagramStore):
+    """进程内字典存储，重启后数据丢失"""
+
+    def __init__(self):
+        self._diagrams: Dict[str, dict] = {}
+        self._revisions: Dict[str, List[dict]] = {}
+        self._counter = 1
+
+    def _add_revision(self, diagram_id: str, prev_xml: Optional[str], xml: str, now: str):
+        revisions = self._revisions.setdefault(diagram_id, [])
+        revision = len(revisions) + 1
+        kind, payload = build_revision(prev_xml, xml, revision)
+        data, encoding = compress_diagram(payload)
+        revisions.append({"revision": revision, "kind": kind, "data": data, "encoding": encoding, "created_at": now})
+
+    async def create(self, xml: str, name: Optional[str]) -> dict:
+        diagram_id = str(self._counter)
+        self._counter += 1
+        now = datetime.now().isoformat()
+        data, encoding = compress_diagram(xml)
+        diagram = {
+            "id": diagram_id,
+            "data": data,
+            "encoding": encoding,
+            "name": name or f"流程图 {diagram_id}",
+            "created_at": now,
+            "updated_at": now
+        }
+        self._diagrams[diagram_id] = diagram
+        self._add_revision(diagram_id, None, xml, now)
+        return {**self._meta(diagram), "xml": xml}
+
+    def _meta(self, diagram: dict) -> dict:
+        return {k: diagram[k] for k in ("id", "name", "created_at", "updated_at")}
+
+    async def get_encoded(self, diagram_id: str) -> Optional[dict]:
+        diagram = self._diagrams.get(diagram_id)
+        if diagram is None:
+            return None
+        return dict(diagram)
+
+    async def update(self, diagram_id: str, xml: str, name: Optional[str]) -> bool:
+        diagram = self._diagrams.get(diagram_id)
+        if diagram is None:
+            return False
+        prev_xml = decompress_diagram(diagram["data"], diagram["encoding"])
+        diagram["data"], diagram["encoding"] = compress_diagram(xml)
+        diagram["updated_at"] = datetime.now().isoformat()
+        if name:
+            diagram["name"] = name
+        self._add_revision(diagram_id, prev_xml, xml, diagram["updated_at"])
+        return True
+
+    async def delete(self, diagram_id: str) -> bool:
+        self._revisions.pop(diagram_id, None)
+        return self._diagrams.pop(diagram_id, None) is not None
+
+    async def list_revisions(self, diagram_id: str) -> Optional[List[dict]]:
+        if diagram_id not in self._diagrams:
+            return None
+        return [
+            {"revision": r["revision"], "kind": r["kind"], "size": len(r["data"]), "created_at": r["created_at"]}
+            for r in reversed(self._revisions.get(diagram_id, []))
+        ]
+
+    async def get_revision(self, diagram_id: str, revision: int) -> Optional[dict]:
+        revisions = self._revisions.get(diagram_id, [])
+        if not 1 <= revision <= len(revisions):
+            return None
+        start = revision - 1
+        while revisions[start]["kind"] != "snapshot":
+            start -= 1
+        records = revisions[start:revision]
+        return {"revision": revision, "xml": reconstruct_revision(records), "created_at": records[-1]["created_at"]}
+
+    def _matching(self, name_prefix: Optional[str]) -> List[dict]:
+        if not name_prefix:
+            return list(self._diagrams.values())
+        return [d for d in self._diagrams.values() if d["name"].startswith(name_prefix)]
+
+    async def list(self, limit: int, cursor: Optional[str] = None, sort: str = "created_at",
+                   descending: bool = True, name_prefix: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        def sort_key(d: dict):
+            return d[sort], int(d["id"])
+
+        diagrams = sorted(self._matching(name_prefix), key=sort_key, reverse=descending)
+        if cursor:
+            after = decode_cursor(cursor)
+            diagrams = [d for d in diagrams if (sort_key(d) < after if descending else sort_key(d) > after)]
+
+        page = diagrams[:limit]
+        next_cursor = encode_cursor(page[-1][sort], page[-1]["id"]) if len(diagrams) > limit else None
+        return [self._meta(d) for d in page], next_cursor
+
+    async def count(self, name_prefix: Optional[str] = None) -> int:
+        return len(self._matching(name_prefix))
+
+class SQLiteDiagramStore(DiagramStore):
+    """
+    SQLite 存储（WAL 模式）
+    - 查询在线程池中执行，不阻塞事件循环；每个线程持有自己的连接
+    - WAL 允许读写并发；写操作使用 BEGIN IMMEDIATE + busy_timeout，
+      多进程同时写入时排队等待而不是报错
+    - 数据只保存在磁盘上，进程内存占用仅限于 SQLite 页缓存
+    - 总数由触发器维护在 diagram_stats 中，无需 COUNT(*) 全表扫描
+    - xml 列保存压缩后的数据（BLOB），encoding 列记录压缩方式；压缩和解压都在线程池中进行
+    - diagram_revisions 保存版本历史（快照或差异），主键 (diagram_id, revision) 支持按范围读取
+    """
+
+    SCHEMA = """
+        BEGIN IMMEDIATE;
+        CREATE TABLE IF NOT EXISTS diagrams (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            xml TEXT NOT NULL,
+            encoding TEXT NOT NULL DEFAULT 'identity',
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_diagrams_created_at ON diagrams (created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_diagrams_updated_at ON diagrams (updated_at, id);
+        CREATE INDEX IF NOT EXISTS idx_diagrams_name ON diagrams (name, id);
+        CREATE TABLE IF NOT EXISTS diagram_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO diagram_stats (id, total) VALUES (1, (SELECT COUNT(*) FROM diagrams));
+        CREATE TRIGGER IF NOT EXISTS trg_diagrams_insert AFTER INSERT ON diagrams
+            BEGIN UPDATE diagram_stats SET total = total + 1 WHERE id = 1; END;
+        CREATE TRIGGER IF NOT EXISTS trg_diagrams_delete AFTER DELETE ON diagrams
+            BEGIN UPDATE diagram_stats SET total = total - 1 WHERE id = 1; END;
+        CREATE TABLE IF NOT EXISTS diagram_revisions (
+            diagram_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            data BLOB NOT NULL,
+            encoding TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (diagram_id, revision)
+        ) WITHOUT ROWID;
+        COMMIT;
+    """
+
+    def __init__(self, path: str, threads: int):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="diagram-db")
+
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        self._migrate(conn)
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """旧版本数据库没有 encoding 列，已有数据视为未压缩"""
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(diagrams)")}
+        if "encoding" not in columns:
+            try:
+                conn.execute("ALTER TABLE diagrams ADD COLUMN encoding TEXT NOT NULL DEFAULT 'identity'")
+            except sqlite3.OperationalError:
+                pass  # 其它进程已完成迁移
+
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的连接（首次使用时创建）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute(f"PRAGMA cache_size=-{DIAGRAM_DB_CACHE_KB}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    async def _run(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _write(self, sql: str, params: tuple) -> sqlite3.Cursor:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(sql, params)
+            conn.execute("COMMIT")
+            return cursor
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _create(self, xml: str, name: Optional[str]) -> dict:
+        data, encoding = compress_diagram(xml)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 在写锁内取时间，保证 created_at 与 id 顺序一致
+            now = datetime.now().isoformat()
+            cursor = conn.execute(
+                "INSERT INTO diagrams (name, xml, encoding, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (name or "", data, encoding, now, now)
+            )
+            diagram_id = str(cursor.lastrowid)
+            if not name:
+                name = f"流程图 {diagram_id}"
+                conn.execute("UPDATE diagrams SET name = ? WHERE id = ?", (name, diagram_id))
+            conn.execute(
+                "INSERT INTO diagram_revisions (diagram_id, revision, kind, data, encoding, created_at) "
+                "VALUES (?, 1, 'snapshot', ?, ?, ?)",
+                (diagram_id, data, encoding, now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {"id": diagram_id, "xml": xml, "name": name, "created_at": now, "updated_at": now}
+
+    def _get_encoded(self, diagram_id: str) -> Optional[dict]:
+        row = self._connect().execute(
+            "SELECT id, name, xml AS data, encoding, created_at, updated_at FROM diagrams WHERE id = ?",
+            (diagram_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        diagram = dict(row)
+        diagram["id"] = str(diagram["id"])
+        return diagram
+
+    def _get(self, diagram_id: str) -> Optional[dict]:
+        diagram = self._get_encoded(diagram_id)
+        if diagram is None:
+            return None
+        diagram["xml"] = decompress_diagram(diagram.pop("data"), diagram.pop("encoding"))
+        return diagram
+
+    def _update(self, diagram_id: str, xml: str, name: Optional[str]) -> bool:
+        data, encoding = compress_diagram(xml)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT xml, encoding, updated_at FROM diagrams WHERE id = ?", (diagram_id,)
+            ).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return False
+
+            # 在写锁内读取上一版本，保证差异基于最新内容
+            now = datetime.now().isoformat()
+            last = conn.execute(
+                "SELECT MAX(revision) FROM diagram_revisions WHERE diagram_id = ?", (diagram_id,)
+            ).fetchone()[0] or 0
+            if not last:
+                # 版本历史表出现之前保存的图表没有任何版本：先把当前内容记为版本 1，本次更新为版本 2
+                conn.execute(
+                    "INSERT INTO diagram_revisions (diagram_id, revision, kind, data, encoding, created_at) "
+                    "VALUES (?, 1, 'snapshot', ?, ?, ?)",
+                    (diagram_id, row["xml"], row["encoding"], row["updated_at"])
+                )
+                last = 1
+            prev_xml = decompress_diagram(row["xml"], row["encoding"])
+            kind, payload = build_revision(prev_xml, xml, last + 1)
+            revision_data, revision_encoding = (data, encoding) if kind == "snapshot" else compress_diagram(payload)
+
+            conn.execute(
+                "UPDATE diagrams SET xml = ?, encoding = ?, name = COALESCE(?, name), updated_at = ? WHERE id = ?",
+                (data, encoding, name or None, now, diagram_id)
+            )
+            conn.execute(
+                "INSERT INTO diagram_revisions (diagram_id, revision, kind, data, encoding, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (diagram_id, last + 1, kind, revision_data, revision_encoding, now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def _delete(self, diagram_id: str) -> bool:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = conn.execute("DELETE FROM diagrams WHERE id = ?", (diagram_id,)).rowcount > 0
+            conn.execute("DELETE FROM diagram_revisions WHERE diagram_id = ?", (diagram_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return deleted
+
+    def _list_revisions(self, diagram_id: str) -> Optional[List[dict]]:
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM diagrams WHERE id = ?", (diagram_id,)).fetchone() is None:
+            return None
+        rows = conn.execute(
+            "SELECT revision, kind, length(data) AS size, created_at FROM diagram_revisions "
+            "WHERE diagram_id = ? ORDER BY revision DESC",
+            (diagram_id,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _get_revision(self, diagram_id: str, revision: int) -> Optional[dict]:
+        conn = self._connect()
+        # 先定位最近的快照，再按主键范围读取之后的差异
+        snapshot = conn.execute(
+            "SELECT MAX(revision) FROM diagram_revisions WHERE diagram_id = ? AND revision <= ? AND kind = 'snapshot'",
+            (diagram_id, revision)
+        ).fetchone()[0]
+        if snapshot is None:
+            return None
+        rows = conn.execute(
+            "SELECT revision, kind, data, encoding, created_at FROM diagram_revisions "
+            "WHERE diagram_id = ? AND revision BETWEEN ? AND ? ORDER BY revision",
+            (diagram_id, snapshot, revision)
+        ).fetchall()
+        if not rows or rows[-1]["revision"] != revision:
+            return None
+        return {"revision": revision, "xml": reconstruct_revision(rows), "created_at": rows[-1]["created_at"]}
+
+    def _list(self, limit: int, cursor: Optional[str], sort: str, descending: bool,
+              name_prefix: Optional[str]) -> Tuple[List[dict], Optional[str]]:
+        if sort not in DIAGRAM_SORT_FIELDS:
+            raise ValueError(f"不支持的排序字段: {sort}")
+
+        conditions = []
+        params: list = []
+        if name_prefix:
+            conditions.append("name >= ? AND name < ?")
+            params += [name_prefix, name_prefix_upper_bound(name_prefix)]
+        if cursor:
+            # 行值比较可以直接在 (sort, id) 索引上定位
+            conditions.append(f"({sort}, id) {'<' if descending else '>'} (?, ?)")
+            params += list(decode_cursor(cursor))
+
+        direction = "DESC" if descending else "ASC"
+        sql = "SELECT id, name, created_at, updated_at FROM diagrams"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {sort} {direction}, id {direction} LIMIT ?"
+        params.append(limit + 1)  # 多取一条判断是否还有下一页
+
+        rows = self._connect().execute(sql, params).fetchall()
+        page = [{**dict(row), "id": str(row["id"])} for row in rows[:limit]]
+        next_cursor = encode_cursor(page[-1][sort], page[-1]["id"]) if len(rows) > limit else None
+        return page, next_cursor
+
+    def _count(self, name_prefix: Optional[str]) -> int:
+        conn = self._connect()
+        if not name_prefix:
+            return conn.execute("SELECT total FROM diagram_stats WHERE id = 1").fetchone()[0]
+        # 前缀过滤只扫描 name 索引的对应区间
+        return conn.execute(
+            "SELECT COUNT(*) FROM diagrams WHERE name >= ? AND name < ?",
+            (name_prefix, name_prefix_upper_bound(name_prefix))
+        ).fetchone()[0]
+
+    async def create(self, xml: str, name: Optional[str]) -> dict:
+        return await self._run(self._create, xml, name)
+
+    async def get(self, diagram_id: str) -> Optional[dict]:
+        return await self._run(self._get, diagram_id)
+
+    async def get_encoded(self, diagram_id: str) -> Optional[dict]:
+        return await self._run(self._get_encoded, diagram_id)
+
+    async def update(self, diagram_id: str, xml: str, name: Optional[str]) -> bool:
+        return await self._run(self._update, diagram_id, xml, name)
+
+    async def delete(self, diagram_id: str) -> bool:
+        return await self._run(self._delete, diagram_id)
+
+    async def list(self, limit: int, cursor: Optional[str] = None, sort: str = "created_at",
+                   descending: bool = True, name_prefix: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        return await self._run(self._list, limit, cursor, sort, descending, name_prefix)
+
+    async def count(self, name_prefix: Optional[str] = None) -> int:
+        return await self._run(self._count, name_prefix)
+
+    async def list_revisions(self, diagram_id: str) -> Optional[List[dict]]:
+        return await self._run(self._list_revisions, diagram_id)
+
+    async def get_revision(self, diagram_id: str, revision: int) -> Optional[dict]:
+        return await self._run(self._get_revision, diagram_id, revision)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+def create_diagram_store() -> DiagramStore:
+    if DIAGRAM_STORE == "memory":
+        if WORKERS > 1:
+            logger.warning("[存储] 多个 worker 不能共享内存存储，各 worker 只能看到自己保存的图表")
+        logger.info("[存储] 使用内存存储（重启后数据丢失）")
+        return MemoryDiagramStore()
+    logger.info(f"[存储] 使用 SQLite 存储: {DIAGRAM_DB_PATH}")
+    return SQLiteDiagramStore(DIAGRAM_DB_PATH, DIAGRAM_DB_THREADS)
+
+diagram_store = create_diagram_store()
+
+# ========== 监控指标（Prometheus）==========
+# /metrics 以 Prometheus 文本格式输出生成流水线各阶段的延迟和计数，按 AI 配置名称（config）分组
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """单调递增计数器，按标签值分组"""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ("config",)):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        if METRICS_ENABLED:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value:g}")
+        return lines
+
+class Gauge:
+    """可增可减的当前值，按标签值分组"""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, *label_values: str):
+        if METRICS_ENABLED:
+            self._values[label_values] = value
+
+    def inc(self, *label_values: str, amount: float = 1):
+        if METRICS_ENABLED:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value:g}")
+        return lines
+
+class Histogram:
+    """直方图：每组标签记录各桶计数、总和与样本数，输出时转为累计桶"""
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...],
+                 labels: Tuple[str, ...] = ("config",)):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], list] = {}  # 标签值 → [各桶计数（非累计）, 总和, 样本数]
+
+    def observe(self, value: float, *label_values: str):
+        if not METRICS_ENABLED:
+            return
+        state = self._values.get(label_values)
+        if state is None:
+            state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip((*self.buckets, "+Inf"), counts):
+                cumulative += n
+                le = f'le="{bound if bound == "+Inf" else f"{bound:g}"}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+class Metrics:
+    """生成流水线的全部指标"""
+
+    def __init__(self):
+        self.ttft = Histogram("autodrawio_ttft_seconds", "Time to first token", LATENCY_BUCKETS)
+        self.generation = Histogram("autodrawio_generation_seconds", "Total generation time of successful requests",
+                                    LATENCY_BUCKETS)
+        self.tokens_per_sec = Histogram("autodrawio_tokens_per_second", "Streaming output rate after the first token",
+                                        RATE_BUCKETS)
+        self.clean = Histogram("autodrawio_clean_xml_seconds", "Time spent cleaning and incrementally parsing output",
+                               STAGE_BUCKETS)
+        self.validate = Histogram("autodrawio_validate_xml_seconds", "Time spent in strict XML validation",
+                                  STAGE_BUCKETS)
+        self.output_bytes = Histogram("autodrawio_output_bytes", "Size of generated diagram XML", SIZE_BUCKETS)
+        self.memory_bytes = Histogram("autodrawio_response_memory_bytes", "Output retained in memory per request",
+                                      SIZE_BUCKETS)
+        self.attempts = Counter("autodrawio_attempts_total", "Upstream requests by outcome", ("config", "outcome"))
+        self.failovers = Counter("autodrawio_failover_total", "Failover hops away from a config")
+        self.validation_failures = Counter("autodrawio_validation_failures_total", "Outputs rejected by XML validation")
+        self.cache_hits = Counter("autodrawio_cache_hits_total", "Generations served from the response cache")
+        self.xml_tasks = Histogram("autodrawio_xml_task_seconds", "XML post-processing time including pool wait",
+                                   STAGE_BUCKETS, ("task", "mode"))
+        self.xml_pool_wait = Histogram("autodrawio_xml_pool_wait_seconds", "Time waiting for a free process pool slot",
+                                       STAGE_BUCKETS, ())
+        self.xml_pool_waiting = Gauge("autodrawio_xml_pool_waiting", "XML tasks waiting for a process pool slot")
+        self.xml_pool_running = Gauge("autodrawio_xml_pool_running", "XML tasks submitted to the process pool")
+        self.admission_active = Gauge("autodrawio_admission_active", "Generations holding a concurrency slot")
+        self.admission_waiting = Gauge("autodrawio_admission_waiting", "Generations waiting in the admission queue")
+        self.admission_wait = Histogram("autodrawio_admission_wait_seconds", "Time spent in the admission queue",
+                                        LATENCY_BUCKETS, ())
+        self.admission_rejected = Counter("autodrawio_admission_rejected_total", "Generations rejected with 429",
+                                          ("reason",))
+        self.loop_lag = Histogram("autodrawio_event_loop_lag_seconds", "Event loop scheduling delay",
+                                  STAGE_BUCKETS, ())
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in vars(self).values():
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# ========== AI 配置健康统计与熔断 ==========
+PROVIDER_STATS_WINDOW = int(os.getenv("PROVIDER_STATS_WINDOW", "100"))      # 每个配置保留的样本数
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))  # 连续失败多少次后熔断
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))        # 熔断后多久开始探测
+CIRCUIT_PROBE_INTERVAL = float(os.getenv("CIRCUIT_PROBE_INTERVAL", "10"))    # 后台探测间隔（秒）
+HEALTH_TTFT_REFERENCE_MS = float(os.getenv("HEALTH_TTFT_REFERENCE_MS", "3000"))  # 首 token 延迟参考值
+HEALTH_ROUTING_WEIGHT = float(os.getenv("HEALTH_ROUTING_WEIGHT", "2.0"))     # 健康分对路由顺序的影响
+
+class ProviderHealth:
+    """
+    单个 AI 配置的滚动健康统计 + 熔断器
+    - 统计：成功率、首 token 延迟（ttft）、完整请求耗时（duration）、输出速度（tokens/s）、单次请求内存（memory_kb）
+    - 熔断：closed（正常）→ 连续失败达到阈值 → open（跳过）→ 后台探测成功 → half_open（试用）
+      half_open 下请求成功恢复 closed，失败重新 open
+    """
+
+    def __init__(self):
+        self.samples: Dict[str, deque] = {
+            "ttft": deque(maxlen=PROVIDER_STATS_WINDOW),
+            "duration": deque(maxlen=PROVIDER_STATS_WINDOW),
+            "tokens_per_sec": deque(maxlen=PROVIDER_STATS_WINDOW),
+            "memory_kb": deque(maxlen=PROVIDER_STATS_WINDOW)  # 单次请求保留的输出占用的内存
+        }
+        self.outcomes: deque = deque(maxlen=PROVIDER_STATS_WINDOW)  # True 成功 / False 失败
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def record(self, metric: str, value: float):
+        self.samples[metric].append(value)
+
+    def percentile(self, metric: str, q: float, min_samples: int = 1) -> Optional[float]:
+        """返回分位数，样本不足时返回 None"""
+        values = self.samples[metric]
+        if not values or len(values) < min_samples:
+            return None
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def p95(self, metric: str, min_samples: int = 1) -> Optional[float]:
+        return self.percentile(metric, 0.95, min_samples)
+
+    def record_success(self):
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            logger.info("[熔断器] 请求成功，恢复正常")
+        self.state = "closed"
+        self.opened_at = None
+
+    def record_failure(self, error: str, trip: bool = True):
+        """
+        记录一次失败
+        trip=False 表示模型输出问题（如 XML 无效），只计入成功率，不触发熔断
+        """
+        self.outcomes.append(False)
+        self.last_error = error
+        if not trip:
+            return
+
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            if self.state != "open":
+                logger.warning(f"[熔断器] 连续失败 {self.consecutive_failures} 次，暂停使用: {error}")
+            self.trip()
+
+    def trip(self):
+        """打开熔断器"""
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+    def half_open(self):
+        """探测成功，允许真实请求试用"""
+        self.state = "half_open"
+        self.consecutive_failures = 0
+
+    def probe_due(self) -> bool:
+        """熔断冷却时间已过，可以进行后台探测"""
+        return self.state == "open" and time.monotonic() - self.opened_at >= CIRCUIT_OPEN_SECONDS
+
+    def success_rate(self) -> float:
+        if not self.outcomes:
+            return 1.0
+        return sum(self.outcomes) / len(self.outcomes)
+
+    def score(self) -> float:
+        """
+        健康分 [0, 1]：成功率占 70%，首 token 延迟占 30%
+        成功率按 2 次虚拟成功做平滑，避免偶发的单次失败就让配置长期排到后面
+        """
+        smoothed_rate = (sum(self.outcomes) + 2) / (len(self.outcomes) + 2)
+        ttft = self.percentile("ttft", 0.5)
+        latency_factor = 1.0
+        if ttft is not None:
+            reference = HEALTH_TTFT_REFERENCE_MS / 1000
+            latency_factor = reference / (reference + ttft)
+        return 0.7 * smoothed_rate + 0.3 * latency_factor
+
+    def snapshot(self) -> dict:
+        def rounded(value: Optional[float]) -> Optional[float]:
+            return None if value is None else round(value, 3)
+
+        return {
+            "state": self.state,
+            "score": round(self.score(), 3),
+            "success_rate": round(self.success_rate(), 3),
+            "requests": len(self.outcomes),
+            "consecutive_failures": self.consecutive_failures,
+            "ttft_p50": rounded(self.percentile("ttft", 0.5)),
+            "ttft_p95": rounded(self.p95("ttft")),
+            "duration_p95": rounded(self.p95("duration")),
+            "tokens_per_sec": rounded(self.percentile("tokens_per_sec", 0.5)),
+            "memory_kb_p50": rounded(self.percentile("memory_kb", 0.5)),
+            "memory_kb_max": rounded(max(self.samples["memory_kb"], default=None)),
+            "last_error": self.last_error
+        }
 
 # ========== AI 配置管理器 ==========
+CONFIG_STATE_KEY = "ai_configs"          # 共享存储中保存配置的 hash（配置 ID → JSON）
+CONFIG_COUNTER_KEY = "ai_config_counter"
+
 class AIConfigManager:
     """
     AI 配置管理器（单例模式）
     负责管理所有 AI API 配置的增删改查
+    配置保存在共享存储中，self.configs 是本 worker 的缓存，其它 worker 修改配置后通过变更通知刷新
     """
     _instance = None
 
@@ -113,6 +1634,9 @@ class AIConfigManager:
 
         self.configs: Dict[str, AIConfigModel] = {}
         self.config_counter = 1
+        self.state = shared_state
+        self._listeners: List[Callable[[str, Optional[AIConfigModel], Optional[AIConfigModel]], None]] = []
+        self.health: Dict[str, ProviderHealth] = {}  # 配置 ID -> 健康统计
         self._initialized = True
 
         # 初始化默认配置
@@ -128,7 +1652,7 @@ class AIConfigManager:
 
         if config_from_env:
             # 如果环境变量中有配置，使用环境变量的配置
-            print(f"[配置管理器] 从环境变量加载了默认配置: {config_from_env['name']}")
+            logger.info(f"[配置管理器] 从环境变量加载了默认配置: {config_from_env['name']}")
             config_id = str(self.config_counter)
             self.config_counter += 1
 
@@ -139,16 +1663,10 @@ class AIConfigManager:
             self.configs[config_id] = config
         else:
             # 如果没有环境变量配置，提示用户配置
-            print("=" * 60)
-            print("[配置管理器] ⚠️  未找到 .env 配置文件")
-            print("[配置管理器] 请按照以下步骤配置:")
-            print("[配置管理器] 1. 复制 backend/.env.example 为 backend/.env")
-            print("[配置管理器] 2. 在 .env 文件中填写你的 API 配置")
-            print("[配置管理器] 3. 重启服务")
-            print("[配置管理器] 或者，你也可以在前端界面中手动添加 AI 配置")
-            print("=" * 60)
+            logger.warning("[配置管理器] ⚠️  未找到 .env 配置文件，请复制 backend/.env.example 为 backend/.env，"
+                           "填写 API 配置后重启服务；也可以在前端界面中手动添加 AI 配置")
 
-        print(f"[配置管理器] 已加载 {len(self.configs)} 个配置")
+        logger.info(f"[配置管理器] 已加载 {len(self.configs)} 个配置")
 
     def _load_config_from_env(self) -> Optional[dict]:
         """
@@ -163,7 +1681,7 @@ class AIConfigManager:
 
         # 检查必需字段
         if not all([name, base_url, api_key, model]):
-            print("[配置管理器] 环境变量中的默认配置不完整")
+            logger.warning("[配置管理器] 环境变量中的默认配置不完整")
             return None
 
         # 返回配置（固定 enabled=True, priority=0, is_system=True）
@@ -177,243 +1695,3212 @@ class AIConfigManager:
             "is_system": True  # 标记为系统配置
         }
 
+    def add_listener(self, callback: Callable[[str, Optional[AIConfigModel], Optional[AIConfigModel]], None]):
+        """
+        注册配置变更监听器
+        回调参数: (事件类型 create/update/delete, 旧配置, 新配置)
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, event: str, old: Optional[AIConfigModel], new: Optional[AIConfigModel]):
+        """通知所有监听器配置已变更"""
+        for callback in self._listeners:
+            try:
+                callback(event, old, new)
+            except Exception as e:
+                logger.error(f"[配置管理器] 配置变更回调失败: {str(e)}")
+
+    async def sync(self):
+        """
+        启动时与共享存储同步：写入环境变量中的系统配置（保留其它 worker 或上次运行中修改过的启用状态），
+        删除已不在环境变量中的旧系统配置，然后加载全部配置并订阅变更通知
+        """
+        stored = await self.state.hash_get_all(CONFIG_STATE_KEY)
+        for config_id, value in stored.items():
+            previous = AIConfigModel(**json.loads(value))
+            if previous.is_system and config_id not in self.configs:
+                await self.state.hash_delete(CONFIG_STATE_KEY, config_id)
+        for config in self.configs.values():
+            if config.id in stored:
+                config.enabled = AIConfigModel(**json.loads(stored[config.id])).enabled
+            await self._save(config)
+        await self.reload()
+        self.state.subscribe(self._on_shared_event)
+
+    async def reload(self):
+        """从共享存储重新加载全部配置，对有变化的配置通知监听器"""
+        stored = {
+            config_id: AIConfigModel(**json.loads(value))
+            for config_id, value in (await self.state.hash_get_all(CONFIG_STATE_KEY)).items()
+        }
+        old_configs, self.configs = self.configs, stored
+        for config_id in set(old_configs) | set(stored):
+            old, new = old_configs.get(config_id), stored.get(config_id)
+            if old == new:
+                continue
+            if old is None or new is None or (old.base_url, old.model) != (new.base_url, new.model):
+                self.health.pop(config_id, None)
+            self._notify("create" if old is None else "delete" if new is None else "update", old, new)
+
+    async def _on_shared_event(self, event: dict):
+        if event.get("kind") in ("config", "resync"):
+            await self.reload()
+
+    async def _save(self, config: AIConfigModel):
+        await self.state.hash_set(CONFIG_STATE_KEY, config.id, json.dumps(config.dict(), ensure_ascii=False))
+
     def get_all_configs(self) -> List[AIConfigModel]:
         """获取所有配置（按优先级排序）"""
         configs = list(self.configs.values())
         configs.sort(key=lambda x: x.priority)
         return configs
 
-    def get_enabled_configs(self) -> List[AIConfigModel]:
-        """获取所有启用的配置（按优先级排序）"""
+    def get_enabled_configs(self, include_unhealthy: bool = False) -> List[AIConfigModel]:
+        """
+        获取所有启用的配置（按优先级 + 健康分排序）
+        熔断中（open）的配置会被跳过，除非所有配置都已熔断或 include_unhealthy=True
+        """
         configs = [c for c in self.configs.values() if c.enabled]
-        configs.sort(key=lambda x: x.priority)
+
+        if not include_unhealthy:
+            healthy = [c for c in configs if self.get_health(c.id).state != "open"]
+            if healthy:
+                configs = healthy
+
+        def routing_key(config: AIConfigModel):
+            # 健康分越低，等效优先级越靠后（半开状态的配置照常参与，由真实请求验证是否恢复）
+            return config.priority + (1 - self.get_health(config.id).score()) * HEALTH_ROUTING_WEIGHT
+
+        configs.sort(key=routing_key)
         return configs
 
+    def get_health(self, config_id: str) -> ProviderHealth:
+        """获取（必要时创建）指定配置的健康统计"""
+        health = self.health.get(config_id)
+        if health is None:
+            health = self.health[config_id] = ProviderHealth()
+        return health
+
     def get_config(self, config_id: str) -> Optional[AIConfigModel]:
         """获取指定配置"""
         return self.configs.get(config_id)
 
-    def create_config(self, config_data: AIConfigCreateRequest) -> AIConfigModel:
+    async def create_config(self, config_data: AIConfigCreateRequest) -> AIConfigModel:
         """创建新配置"""
-        config_id = str(self.config_counter)
-        self.config_counter += 1
+        # ID 由共享计数器生成，各 worker 之间不会重复；1 留给环境变量中的系统配置
+        config_id = str(await self.state.incr(CONFIG_COUNTER_KEY) + 1)
 
         config = AIConfigModel(
             id=config_id,
             **config_data.dict()
         )
         self.configs[config_id] = config
+        await self._save(config)
+        await self.state.publish({"kind": "config", "id": config_id})
 
-        print(f"[配置管理器] 创建配置: {config.name} (ID: {config_id})")
+        logger.info(f"[配置管理器] 创建配置: {config.name} (ID: {config_id})")
+        self._notify("create", None, config)
         return config
 
-    def update_config(self, config_id: str, update_data: AIConfigUpdateRequest) -> Optional[AIConfigModel]:
+    async def update_config(self, config_id: str, update_data: AIConfigUpdateRequest) -> Optional[AIConfigModel]:
         """更新配置"""
         if config_id not in self.configs:
             return None
 
         config = self.configs[config_id]
+        old_config = config.copy()
         update_dict = update_data.dict(exclude_unset=True)
 
         for key, value in update_dict.items():
             setattr(config, key, value)
 
-        print(f"[配置管理器] 更新配置: {config.name} (ID: {config_id})")
+        # endpoint 或模型变化后，旧的健康统计不再有参考价值
+        if (old_config.base_url, old_config.model) != (config.base_url, config.model):
+            self.health.pop(config_id, None)
+        await self._save(config)
+        await self.state.publish({"kind": "config", "id": config_id})
+
+        logger.info(f"[配置管理器] 更新配置: {config.name} (ID: {config_id})")
+        self._notify("update", old_config, config)
         return config
 
-    def delete_config(self, config_id: str) -> bool:
+    async def delete_config(self, config_id: str) -> bool:
         """删除配置"""
         if config_id not in self.configs:
             return False
 
         config = self.configs[config_id]
         del self.configs[config_id]
+        self.health.pop(config_id, None)
+        await self.state.hash_delete(CONFIG_STATE_KEY, config_id)
+        await self.state.publish({"kind": "config", "id": config_id})
 
-        print(f"[配置管理器] 删除配置: {config.name} (ID: {config_id})")
+        logger.info(f"[配置管理器] 删除配置: {config.name} (ID: {config_id})")
+        self._notify("delete", config, None)
         return True
 
-    def get_configs_as_dict_list(self) -> List[dict]:
+    def get_configs_as_dict_list(self, include_unhealthy: bool = False) -> List[dict]:
         """
         获取配置列表（字典格式，兼容原有代码）
         只返回启用的配置
         """
-        enabled_configs = self.get_enabled_configs()
+        enabled_configs = self.get_enabled_configs(include_unhealthy)
         return [
             {
+                "id": c.id,
                 "name": c.name,
                 "base_url": c.base_url,
                 "api_key": c.api_key,
-                "model": c.model
+                "model": c.model,
+                "timeout": c.timeout,
+                "history_token_budget": c.history_token_budget
             }
             for c in enabled_configs
         ]
 
-# 创建全局配置管理器实例
-config_manager = AIConfigManager()
+# 创建全局配置管理器实例
+config_manager = AIConfigManager()
+
+# ========== AI 模型配置（多 API 故障转移）==========
+# 注意: 配置已迁移到 AIConfigManager，AI_APIS 保留用于向后兼容
+# 实际使用的配置通过 config_manager.get_configs_as_dict_list() 获取
+def get_ai_apis(include_unhealthy: bool = False):
+    """获取 AI API 配置列表（动态从配置管理器获取，按健康状况路由）"""
+    return config_manager.get_configs_as_dict_list(include_unhealthy)
+
+# ========== 上游 HTTP 连接池 ==========
+# 连接数统计读取 httpx 的私有属性 AsyncHTTPTransport._pool（httpcore 连接池），只在验证过的 httpx 版本上读取，
+# 升级 httpx 时需要重新确认（见 requirements.txt）
+HTTPX_POOL_STATS_VERSION = "0.26."
+
+class _PooledClient:
+    """连接池中的单个 httpx.AsyncClient 及其使用统计"""
+
+    def __init__(self, base_url: str, client: httpx.AsyncClient):
+        self.base_url = base_url
+        self.client = client
+        self.created_at = datetime.now().isoformat()
+        self.in_flight = 0  # 正在使用该客户端的请求数
+        self.total_requests = 0
+        self.retired = False  # 已退役：不再分配新请求，空闲后关闭
+
+
+class AIClientPool:
+    """
+    上游 AI API 的 HTTP 客户端注册表
+    按 base_url 复用 httpx.AsyncClient，避免每次生成都重新进行 DNS/TCP/TLS 握手
+    配置变更时退役旧客户端，正在进行的请求结束后再关闭
+    """
+
+    def __init__(self):
+        self.max_connections = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "100"))
+        self.max_keepalive_connections = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "20"))
+        self.keepalive_expiry = float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY", "60"))
+        self.connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+        self.http2 = os.getenv("HTTP_POOL_HTTP2", "true").lower() == "true"
+
+        if self.http2 and not HTTP2_AVAILABLE:
+            logger.warning("[连接池] 未安装 h2，HTTP/2 已禁用（pip install httpx[http2]）")
+            self.http2 = False
+
+        self._clients: Dict[str, _PooledClient] = {}
+        self._retired: List[_PooledClient] = []
+        self._pool_stats_warned = False
+
+    @staticmethod
+    def _key(base_url: str) -> str:
+        return base_url.rstrip("/")
+
+    def _create_client(self, base_url: str) -> _PooledClient:
+        client = httpx.AsyncClient(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            timeout=httpx.Timeout(120.0, connect=self.connect_timeout)
+        )
+        logger.info(f"[连接池] 创建客户端: {base_url} (HTTP/2: {self.http2})")
+        return _PooledClient(base_url, client)
+
+    def timeout_for(self, api_config: dict, default: float) -> httpx.Timeout:
+        """获取单个配置的请求超时（配置未指定时使用接口默认值）"""
+        return httpx.Timeout(api_config.get('timeout') or default, connect=self.connect_timeout)
+
+    @asynccontextmanager
+    async def acquire(self, base_url: str):
+        """获取指定 base_url 的共享客户端（请求结束后自动归还）"""
+        key = self._key(base_url)
+        pooled = self._clients.get(key)
+        if pooled is None:
+            pooled = self._create_client(key)
+            self._clients[key] = pooled
+
+        pooled.in_flight += 1
+        pooled.total_requests += 1
+        try:
+            yield pooled.client
+        finally:
+            pooled.in_flight -= 1
+            if pooled.retired and pooled.in_flight == 0:
+                await self._close(pooled)
+
+    async def _close(self, pooled: _PooledClient):
+        if pooled in self._retired:
+            self._retired.remove(pooled)
+        await pooled.client.aclose()
+        logger.info(f"[连接池] 已关闭客户端: {pooled.base_url}")
+
+    def retire(self, base_url: str):
+        """退役指定 base_url 的客户端，下次请求时重新创建"""
+        pooled = self._clients.pop(self._key(base_url), None)
+        if pooled is None:
+            return
+
+        pooled.retired = True
+        self._retired.append(pooled)
+        if pooled.in_flight == 0:
+            try:
+                asyncio.get_running_loop().create_task(self._close(pooled))
+            except RuntimeError:
+                pass  # 没有运行中的事件循环，留到应用关闭时统一释放
+
+    def on_config_changed(self, event: str, old: Optional[AIConfigModel], new: Optional[AIConfigModel]):
+        """配置变更回调：endpoint 变化或被删除时重建对应客户端"""
+        if old is None:
+            return
+        if new is not None and self._key(old.base_url) == self._key(new.base_url):
+            return
+        self.retire(old.base_url)
+
+    async def aclose(self):
+        """关闭所有客户端（应用关闭时调用）"""
+        for pooled in list(self._clients.values()) + list(self._retired):
+            await pooled.client.aclose()
+        self._clients.clear()
+        self._retired.clear()
+
+    def _connection_stats(self, client: httpx.AsyncClient) -> dict:
+        """读取底层 httpcore 连接池的连接状态；httpx 版本未经验证或内部结构变化时不返回连接数"""
+        if not httpx.__version__.startswith(HTTPX_POOL_STATS_VERSION):
+            self._warn_pool_stats(f"httpx {httpx.__version__} 未经验证（已验证 {HTTPX_POOL_STATS_VERSION}x）")
+            return {}
+        try:
+            connections = client._transport._pool.connections
+            idle = sum(1 for conn in connections if conn.is_idle())
+        except AttributeError as e:
+            self._warn_pool_stats(f"httpx 内部结构已变化: {e}")
+            return {}
+        return {
+            "connections": len(connections),
+            "idle_connections": idle,
+            "active_connections": len(connections) - idle
+        }
+
+    def _warn_pool_stats(self, reason: str):
+        if not self._pool_stats_warned:
+            self._pool_stats_warned = True
+            logger.warning(f"[连接池] 无法读取连接数统计，统计信息中将不包含连接数: {reason}")
+
+    def stats(self) -> dict:
+        """连接池统计信息"""
+        clients = []
+        for pooled in list(self._clients.values()) + list(self._retired):
+            clients.append({
+                "base_url": pooled.base_url,
+                "created_at": pooled.created_at,
+                "in_flight": pooled.in_flight,
+                "total_requests": pooled.total_requests,
+                "retired": pooled.retired,
+                **self._connection_stats(pooled.client)
+            })
+
+        return {
+            "http2": self.http2,
+            "limits": {
+                "max_connections": self.max_connections,
+                "max_keepalive_connections": self.max_keepalive_connections,
+                "keepalive_expiry": self.keepalive_expiry
+            },
+            "clients": clients
+        }
+
+# 创建全局连接池，并在配置变更时同步重建客户端
+client_pool = AIClientPool()
+config_manager.add_listener(client_pool.on_config_changed)
+
+# Draw.io XML 生成的系统提示词（简化版）
+SYSTEM_PROMPT = """你是 draw.io 流程图生成助手。根据用户描述生成 XML 格式的流程图。
+
+重要规则：
+1. 每个属性只能出现一次（如 x, y, width, height）
+2. 不要重复定义相同的属性
+3. id 必须唯一
+4. 只返回 XML，不要解释
+
+XML 格式：
+<mxfile host="app.diagrams.net">
+  <diagram name="Page-1" id="d1">
+    <mxGraphModel>
+      <root>
+        <mxCell id="0"/>
+        <mxCell id="1" parent="0"/>
+        <!-- 矩形 -->
+        <mxCell id="2" value="文本" style="rounded=1;whiteSpace=wrap;html=1;" vertex="1" parent="1">
+          <mxGeometry x="100" y="100" width="120" height="60" as="geometry"/>
+        </mxCell>
+        <!-- 菱形 -->
+        <mxCell id="3" value="判断?" style="rhombus;whiteSpace=wrap;html=1;" vertex="1" parent="1">
+          <mxGeometry x="80" y="200" width="160" height="80" as="geometry"/>
+        </mxCell>
+        <!-- 连线 -->
+        <mxCell id="4" style="edgeStyle=orthogonalEdgeStyle;rounded=0;html=1;" edge="1" parent="1" source="2" target="3">
+          <mxGeometry relative="1" as="geometry"/>
+        </mxCell>
+      </root>
+    </mxGraphModel>
+  </diagram>
+</mxfile>
+
+只返回 XML，不要解释。"""
+
+# ========== SSE 输出合并 ==========
+# adaptive: 按字节数/时间窗口合并 content 帧；passthrough: 每个 token 单独一帧
+SSE_COALESCE_MODE = os.getenv("SSE_COALESCE_MODE", "adaptive").lower()
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "512"))
+SSE_COALESCE_MS = int(os.getenv("SSE_COALESCE_MS", "50"))
+
+# 流式输出中途发现 XML 无法挽救时，立即断开上游并切换到下一个 API
+STREAM_EARLY_ABORT = os.getenv("STREAM_EARLY_ABORT", "true").lower() == "true"
+# 单次 AI 输出的最大字符数，超过即断开上游（不受 STREAM_EARLY_ABORT 影响）
+MAX_RESPONSE_CHARS = int(os.getenv("MAX_RESPONSE_CHARS", "1000000"))
+
+def sse_event(data: dict) -> str:
+    """序列化为一条 SSE 消息"""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def coalesce_events(events):
+    """
+    合并连续的 content 事件，减少 SSE 帧数和 json.dumps 次数
+    缓冲满 SSE_COALESCE_BYTES 字节或等待 SSE_COALESCE_MS 毫秒（先到者为准）即输出一帧；
+    每段输出的首个 token 立即发送，保证首字延迟不变；其它类型事件到达前先输出已缓冲内容
+    """
+    if SSE_COALESCE_MODE == "passthrough":
+        async for event in events:
+            yield event
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = events.__aiter__()
+    max_delay = SSE_COALESCE_MS / 1000
+    buffer: List[str] = []
+    buffered_bytes = 0
+    deadline = None
+    flush_next = True  # 下一个 content 立即发送
+    pending = None
+
+    def take_buffer() -> dict:
+        nonlocal buffered_bytes, deadline
+        event = {'type': 'content', 'content': ''.join(buffer)}
+        buffer.clear()
+        buffered_bytes = 0
+        deadline = None
+        return event
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                # 时间窗口到期，上游仍未产出新内容
+                yield take_buffer()
+                continue
+
+            task, pending = pending, None
+            try:
+                event = task.result()
+            except StopAsyncIteration:
+                break
+
+            if event.get('type') != 'content':
+                if buffer:
+                    yield take_buffer()
+                flush_next = True
+                yield event
+                continue
+
+            buffer.append(event['content'])
+            buffered_bytes += len(event['content'].encode('utf-8'))
+            if flush_next or buffered_bytes >= SSE_COALESCE_BYTES:
+                flush_next = False
+                yield take_buffer()
+            elif deadline is None:
+                deadline = loop.time() + max_delay
+
+        if buffer:
+            yield take_buffer()
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration):
+                pass
+        await iterator.aclose()
+
+# ========== XML 验证和修复工具 ==========
+
+# 标签结束位置（跳过引号内的 '>'）
+_TAG_BODY_RE = re.compile(r'''(?:[^>"']|"[^"]*"|'[^']*')*>''')
+# 开始标签: <name 属性... /?>
+_START_TAG_RE = re.compile(r'<([^\s/>]+)(.*?)(/?)>\Z', re.DOTALL)
+# 单个属性: name="value" 或 name='value'
+_ATTR_RE = re.compile(r'''([^\s=/<>"']+)\s*=\s*("[^"]*"|'[^']*')''')
+
+class DrawioXMLProcessor:
+    """
+    单次遍历的 draw.io XML 清理/验证器（基于 XMLPullParser）
+    - 去除 markdown 代码块标记、修复重复属性、补全 <br>/<hr> 自闭合
+    - 边修复边送入增量解析器，统计 mxfile/diagram/mxGraphModel/mxCell
+    - 支持在流式输出时逐段 feed，finish() 时只需收尾即可得到最终文档和验证结果
+    - feed 过程中发现输出已不可能成为有效 XML 时设置 abort_reason，供调用方提前终止
+    """
+
+    PROSE_LIMIT = 32  # 根元素之前允许出现的非 XML 字符数，超过即视为说明文字
+
+    def __init__(self, max_chars: Optional[int] = None):
+        self.max_chars = max_chars  # 输出大小上限（字符），为空表示不限制
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._parts: List[str] = []       # 修复后的输出片段
+        self._text_parts: List[str] = []  # 尚未遇到下一个 '<' 的文本
+        self._tag_pending: List[str] = []  # 被分块截断、尚未闭合的标签片段
+        self._open_elements: List[ET.Element] = []  # 增量解析中尚未结束的元素
+        self._depth = 0                   # 扫描到的元素嵌套深度
+        self._root_started = False
+        self._seen_tags = set()
+        self._diagram_depth = 0
+        self._result: Optional[Tuple[str, bool, str]] = None
+
+        self.received = 0            # 已接收字符数
+        self.size = 0                # 已输出字符数
+        self.abort_reason: Optional[str] = None
+        self.over_limit = False      # 超出大小限制（无论是否开启提前终止都会断开上游）
+        self.error: Optional[str] = None
+        self.root_tag: Optional[str] = None
+        self.diagram_count = 0
+        self.model_count = 0
+        self.models_in_diagram = 0
+        self.cell_count = 0
+        self.repaired_attrs = 0      # 移除的重复属性数量
+        self.validate_seconds = 0.0  # finish() 中验证所用时间
+        self.fallback_reason: Optional[str] = None  # 输出无法使用但不是模型的问题（如补丁与当前图表不匹配）
+
+    # ---------- 扫描与修复 ----------
+
+    def feed(self, chunk: str):
+        """送入一段 AI 输出（可以在任意位置截断）"""
+        if not chunk:
+            return
+        self.received += len(chunk)
+        if self._tag_pending:
+            # 标签只可能在 '>' 处结束，没有 '>' 时只暂存片段，避免长标签被反复拼接
+            if '>' not in chunk:
+                self._tag_pending.append(chunk)
+                self._check_abort()
+                return
+            self._tag_pending.append(chunk)
+            chunk = ''.join(self._tag_pending)
+            self._tag_pending = []
+
+        out: List[str] = []
+        pos = 0
+        n = len(chunk)
+        while pos < n:
+            lt = chunk.find('<', pos)
+            if lt == -1:
+                self._text_parts.append(chunk[pos:])
+                break
+            if lt > pos:
+                self._text_parts.append(chunk[pos:lt])
+            self._flush_text(out)
+
+            end = self._find_tag_end(chunk, lt)
+            if end == -1:
+                self._tag_pending = [chunk[lt:]]
+                break
+            out.append(self._repair_tag(chunk[lt:end]))
+            pos = end
+
+        self._emit(''.join(out))
+        self._check_abort()
+
+    def _check_abort(self):
+        """判断输出是否已无法挽救：语法错误、开头的说明文字、超出大小限制"""
+        if self.max_chars and self.received > self.max_chars and not self.over_limit:
+            self.over_limit = True
+            self.abort_reason = self.abort_reason or f"输出超过大小限制（{self.max_chars} 字符）"
+        if self.abort_reason:
+            return
+        if self.error:
+            self.abort_reason = self.error
+        elif not self._root_started and self._text_parts:
+            prefix = ''.join(self._text_parts).replace('```xml', '').replace('```', '')
+            if len(prefix.strip()) > self.PROSE_LIMIT:
+                self.abort_reason = "XML 之前出现了说明文字"
+
+    @staticmethod
+    def _find_tag_end(buf: str, start: int) -> int:
+        """返回标签结束后的位置，标签不完整时返回 -1"""
+        for opener, closer in (('<!--', '-->'), ('<![CDATA[', ']]>'), ('<?', '?>')):
+            if buf.startswith(opener, start):
+                i = buf.find(closer, start + len(opener))
+                return -1 if i == -1 else i + len(closer)
+
+        match = _TAG_BODY_RE.match(buf, start + 1)
+        return -1 if match is None else match.end()
+
+    def _repair_tag(self, tag: str) -> str:
+        """修复单个标签：合并重复属性（保留最后一个值），补全空元素自闭合"""
+        if tag.startswith('</'):
+            self._depth -= 1
+            return tag
+        if tag.startswith('<!') or tag.startswith('<?'):
+            return tag
+
+        match = _START_TAG_RE.match(tag)
+        if match is None:
+            return tag
+
+        name, body, self_closing = match.groups()
+        self._root_started = True
+        if name in ('mxfile', 'mxGraphModel'):
+            self._seen_tags.add(name)
+
+        attrs = _ATTR_RE.findall(body)
+        if len(attrs) > 1 and len({key for key, _ in attrs}) != len(attrs):
+            merged = {}
+            for key, value in attrs:
+                merged[key] = value
+            self.repaired_attrs += len(attrs) - len(merged)
+            tag = '<' + name + ''.join(f' {key}={value}' for key, value in merged.items()) + f'{self_closing}>'
+        elif name in ('br', 'hr') and not self_closing:
+            tag = tag[:-1] + '/>'
+            self_closing = '/'
+
+        if not self_closing:
+            self._depth += 1
+        return tag
+
+    def _flush_text(self, out: List[str]):
+        """输出标签之间的文本：去掉 markdown 标记，丢弃根元素之外的空白"""
+        if not self._text_parts:
+            return
+        text = ''.join(self._text_parts)
+        self._text_parts.clear()
+
+        if '```' in text:
+            text = text.replace('```xml', '').replace('```', '')
+        if (not self._root_started or self._depth <= 0) and not text.strip():
+            return
+        out.append(text)
+
+    # ---------- 增量解析 ----------
+
+    def _emit(self, text: str):
+        if not text:
+            return
+        self._parts.append(text)
+        self.size += len(text)
+
+        if self.error is None:
+            self._parser.feed(text)
+            self._drain_events()
+
+    def _drain_events(self):
+        try:
+            for event, elem in self._parser.read_events():
+                tag = elem.tag
+                if event == 'start':
+                    self._open_elements.append(elem)
+                    if self.root_tag is None:
+                        self.root_tag = tag
+                    if tag == 'mxCell':
+                        self.cell_count += 1
+                    elif tag == 'diagram':
+                        self.diagram_count += 1
+                        self._diagram_depth += 1
+                    elif tag == 'mxGraphModel':
+                        self.model_count += 1
+                        if self._diagram_depth:
+                            self.models_in_diagram += 1
+                else:
+                    if tag == 'diagram':
+                        self._diagram_depth -= 1
+                    # 已统计完的元素从树中移除，解析器只保留当前打开的元素路径，内存不随输出增长
+                    self._open_elements.pop()
+                    elem.clear()
+                    if self._open_elements:
+                        del self._open_elements[-1][-1]
+        except ET.ParseError as e:
+            self.error = f"XML 语法错误: {str(e)}"
+
+    # ---------- 收尾 ----------
+
+    def partial_xml(self) -> Optional[str]:
+        """流式输出过程中可提前在编辑器中渲染的图表；完整 XML 输出不提供"""
+        return None
+
+    def memory_bytes(self) -> int:
+        """当前保留的输出占用的内存（字节，近似值）"""
+        return sum(sys.getsizeof(part) for part in (*self._parts, *self._text_parts, *self._tag_pending))
+
+    def finish(self) -> Tuple[str, bool, str]:
+        """
+        结束输入，返回 (最终 XML, 是否有效, 错误信息)
+        根元素为 mxGraphModel 时自动添加 mxfile 包装
+        """
+        if self._result is not None:
+            return self._result
+
+        xml = self._close_input()
+        if self.root_tag == 'mxGraphModel':
+            xml = re.sub(r'^<\?xml[^>]*\?>\s*', '', xml)
+            xml = f'<mxfile host="app.diagrams.net"><diagram name="Page-1" id="diagram1">{xml}</diagram></mxfile>'
+
+        started = time.perf_counter()
+        self._result = (xml, *self._validate(xml))
+        self.validate_seconds = time.perf_counter() - started
+        return self._result
+
+    async def finish_async(self) -> Tuple[str, bool, str]:
+        """流式接口使用的 finish()：完整 XML 已在接收过程中增量验证，收尾开销很小，直接执行"""
+        return self.finish()
+
+    def _close_input(self) -> str:
+        """输出剩余内容并关闭解析器，返回清理后的完整文本"""
+        if self._tag_pending:
+            self._text_parts.extend(self._tag_pending)
+            self._tag_pending = []
+        out: List[str] = []
+        self._flush_text(out)
+        self._emit(''.join(out))
+
+        if self.error is None and self.size:
+            try:
+                self._parser.close()
+            except ET.ParseError as e:
+                self.error = f"XML 语法错误: {str(e)}"
+            else:
+                self._drain_events()
+
+        return ''.join(self._parts)
+
+    def _validate(self, xml: str) -> Tuple[bool, str]:
+        if not xml:
+            return False, "XML 内容为空"
+        if not self._seen_tags:
+            return False, "缺少 mxfile 或 mxGraphModel 标签"
+        if self.error:
+            return False, self.error
+
+        # 如果是 mxfile 格式，必须包含 diagram，且 diagram 中有 mxGraphModel
+        if self.root_tag == 'mxfile':
+            if self.diagram_count == 0:
+                return False, "mxfile 中缺少 diagram 元素"
+            if self.models_in_diagram == 0:
+                return False, "diagram 中缺少 mxGraphModel"
+
+        # 至少应该有 id=0 和 id=1 两个基础单元格
+        if self.cell_count < 2:
+            return False, "缺少图形元素 (mxCell)"
+
+        return True, ""
+
+def validate_xml_strict(xml_string: str) -> Tuple[bool, str]:
+    """
+    严格验证 XML 是否为有效的 draw.io 格式
+    返回: (是否有效, 错误信息)
+    """
+    processor = DrawioXMLProcessor()
+    processor.feed(xml_string)
+    _, is_valid, error_msg = processor.finish()
+    if is_valid:
+        logger.debug("[XML验证] XML 验证通过")
+    return is_valid, error_msg
+
+async def validate_generated_xml(xml_string: str, api_name: str) -> Tuple[bool, str]:
+    """验证某个 AI 配置生成的 XML（大文档在进程池中验证），并记录验证耗时和失败次数"""
+    started = time.perf_counter()
+    is_valid, error_msg = await xml_pool.run(validate_xml_strict, xml_string)
+    metrics.validate.observe(time.perf_counter() - started, api_name)
+    if not is_valid:
+        metrics.validation_failures.inc(api_name)
+    return is_valid, error_msg
+
+def clean_xml(xml_string: str) -> str:
+    """
+    清理和修复 AI 生成的 XML
+    """
+    logger.debug("[XML清理] 开始清理和验证 XML...")
+
+    processor = DrawioXMLProcessor()
+    processor.feed(xml_string)
+    xml, is_valid, error_msg = processor.finish()
+
+    if processor.repaired_attrs:
+        logger.info(f"[XML清理] 已移除 {processor.repaired_attrs} 个重复属性")
+    if is_valid:
+        logger.debug("[XML清理] XML 格式验证通过")
+    else:
+        # 继续返回，让前端尝试处理
+        logger.warning(f"[XML清理] 警告: {error_msg}")
+
+    logger.debug(f"[XML清理] 清理完成，XML 长度: {len(xml)} 字符")
+    return xml
+
+# ========== 样式规范化与去重 ==========
+# 生成的 XML 中大量单元格重复同一段很长的 style；清理后把 style 解析为规范的 key=value 形式：
+# 合并重复 key（保留最后一个）、去掉与默认值相同的 key、按 key 排序，使等价的样式成为同一个字符串
+STYLE_NORMALIZE = os.getenv("STYLE_NORMALIZE", "true").lower() == "true"
+STYLE_CACHE_SIZE = 4096  # 原始 style → 规范 style 的缓存条数，相同的样式只解析一次
+
+# draw.io 内置命名样式不会设置这些 key，也不能从图表级属性继承，值等于默认值时可以安全省略
+# shadow/sketch 可由 mxGraphModel 的同名属性对整张图开启、glass 可由主题设置，显式的 0 用于关闭继承的值，不能省略
+STYLE_REDUNDANT_DEFAULTS = {
+    "dashed": "0",
+    "rotation": "0",
+    "opacity": "100",
+    "fillOpacity": "100",
+    "strokeOpacity": "100",
+    "textOpacity": "100",
+}
+
+# 只改写元素开始标签中的 style 属性：属性值（如单引号包裹的 value）中出现的 style="..." 文本保持不变
+_STYLE_TAG_RE = re.compile(r'''<[A-Za-z_][\w:.-]*(?:\s+[\w:.-]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*/?>''')
+_STYLE_ATTR_RE = re.compile(r'''(\s)([\w:.-]+)(\s*=\s*)(["'])(.*?)\4''', re.DOTALL)
+_style_cache: Dict[str, str] = {}
+style_stats = {"diagrams": 0, "styles": 0, "bytes_before": 0, "bytes_after": 0}
+
+def canonical_style(style: str) -> str:
+    """
+    规范化单个 style 字符串
+    不带 '=' 的项是命名样式（如 ellipse、swimlane），保持原顺序放在最前面；
+    命名样式出现在 key=value 之后时会覆盖前面的值，这种情况不调整顺序，只去掉空项
+    """
+    cached = _style_cache.get(style)
+    if cached is not None:
+        return cached
+
+    names: List[str] = []
+    values: Dict[str, str] = {}
+    reorder = True
+    for item in style.split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        key, sep, value = item.partition('=')
+        if not sep:
+            if values:
+                reorder = False
+            if item not in names:
+                names.append(item)
+            continue
+        values[key.strip()] = value.strip()  # 重复的 key 以最后一个为准
+
+    if reorder:
+        for key, default in STYLE_REDUNDANT_DEFAULTS.items():
+            if values.get(key) == default:
+                del values[key]
+        items = names + [f"{key}={values[key]}" for key in sorted(values)]
+    else:
+        items = [item.strip() for item in style.split(';') if item.strip()]
+    result = ';'.join(items) + ';' if items else ""
+
+    if len(_style_cache) >= STYLE_CACHE_SIZE:
+        _style_cache.clear()
+    _style_cache[style] = result
+    return result
+
+def _iter_styles(xml: str):
+    """依次产出各开始标签中 style 属性的值"""
+    for tag in _STYLE_TAG_RE.finditer(xml):
+        if 'style' in tag.group(0):
+            for attr in _STYLE_ATTR_RE.finditer(tag.group(0)):
+                if attr.group(2) == 'style':
+                    yield attr.group(5)
+
+def _sub_styles(xml: str, replace: Callable[[str], str]) -> str:
+    """把各开始标签中 style 属性的值替换为 replace(原值)"""
+    def rewrite_attr(attr):
+        if attr.group(2) != 'style':
+            return attr.group(0)
+        return f'{attr.group(1)}{attr.group(2)}{attr.group(3)}{attr.group(4)}{replace(attr.group(5))}{attr.group(4)}'
+
+    def rewrite_tag(tag):
+        if 'style' not in tag.group(0):
+            return tag.group(0)
+        return _STYLE_ATTR_RE.sub(rewrite_attr, tag.group(0))
+
+    return _STYLE_TAG_RE.sub(rewrite_tag, xml)
+
+def dedupe_styles(xml: str) -> Tuple[str, dict]:
+    """规范化 XML 中的所有 style 属性，返回新的 XML 和统计（样式数、去重后的种类数、节省的字节数）"""
+    unique = set()
+    count = 0
+
+    def replace(raw: str) -> str:
+        nonlocal count
+        count += 1
+        style = canonical_style(raw)
+        unique.add(style)
+        return style
+
+    result = _sub_styles(xml, replace)
+    before, after = len(xml.encode('utf-8')), len(result.encode('utf-8'))
+    if count:
+        style_stats["diagrams"] += 1
+        style_stats["styles"] += count
+        style_stats["bytes_before"] += before
+        style_stats["bytes_after"] += after
+    return result, {"styles": count, "unique": len(unique), "saved_bytes": before - after}
+
+def normalize_styles(xml: str) -> str:
+    """STYLE_NORMALIZE 开启时规范化样式并打印节省的字节数"""
+    if not STYLE_NORMALIZE:
+        return xml
+    result, report = dedupe_styles(xml)
+    if report["styles"]:
+        logger.info(f"[样式] {report['styles']} 个样式（{report['unique']} 种），节省 {report['saved_bytes']} 字节")
+    return result
+
+def extract_stylesheet(xml: str) -> Tuple[str, Dict[str, str]]:
+    """
+    把被多个单元格使用的样式提取为命名样式（s1、s2 ... 按使用次数排序），单元格的 style 改为引用名称
+    draw.io 文件本身不能携带样式表，结果不是独立可用的图表：使用方必须先把样式表注册到编辑器
+    （graph.getStylesheet().putCellStyle）才能正确渲染，因此只在调用方显式要求时使用
+    """
+    counts: Dict[str, int] = {}
+    for raw in _iter_styles(xml):
+        style = canonical_style(raw)
+        counts[style] = counts.get(style, 0) + 1
+
+    shared = sorted((style for style, n in counts.items() if n > 1 and style), key=lambda s: -counts[s])
+    names = {style: f"s{i + 1}" for i, style in enumerate(shared)}
+
+    def replace(raw: str) -> str:
+        style = canonical_style(raw)
+        return names.get(style, style)
+
+    return _sub_styles(xml, replace), {name: style for style, name in names.items()}
+
+# ========== 对话历史压缩 ==========
+# 只保留最新一版流程图 XML 原文，更早的助手回复替换为简短摘要，并按模型的 token 预算裁剪最早的轮次
+HISTORY_COMPACTION = os.getenv("HISTORY_COMPACTION", "true").lower() == "true"
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "32000"))  # 默认预算，可在 AI 配置中单独设置
+HISTORY_SUMMARY_LABELS = 8  # 摘要中最多列出的节点名称数
+
+_CJK_RE = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+_CELL_VALUE_RE = re.compile(r'<mxCell\b[^>]*?\bvalue="([^"]*)"[^>]*?\bvertex="1"')
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 token/字，其余约 4 字符/token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def estimate_messages_tokens(messages: List[dict]) -> int:
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages)  # 每条消息约 4 token 的格式开销
+
+def is_diagram_xml(content: str) -> bool:
+    return "<mxGraphModel" in content or "<mxfile" in content
+
+def unescape_xml(value: str) -> str:
+    return (value.replace("&lt;", "<").replace("&gt;", ">").replace("&quot;", '"')
+            .replace("&#xa;", " ").replace("&#10;", " ").replace("&amp;", "&"))
+
+def summarize_diagram(xml: str, version: int) -> str:
+    """把一版流程图替换为节点/连线数量和部分节点名称"""
+    vertices = xml.count('vertex="1"')
+    edges = xml.count('edge="1"')
+    labels = []
+    for value in _CELL_VALUE_RE.findall(xml):
+        label = _HTML_TAG_RE.sub(' ', unescape_xml(value)).strip()
+        if label and label not in labels:
+            labels.append(label[:20])
+        if len(labels) >= HISTORY_SUMMARY_LABELS:
+            break
+
+    summary = f"[第 {version} 版流程图，已省略 XML：{vertices} 个节点、{edges} 条连线"
+    if labels:
+        summary += "，包括 " + "、".join(labels)
+    return summary + "]"
+
+def compact_history(history: List[dict], budget: int) -> List[dict]:
+    """
+    压缩对话历史（不含系统提示词和当前提示）
+    1. 最后一条包含流程图的助手回复保留原文，更早的替换为摘要
+    2. 仍超出预算时从最早的轮次开始丢弃，最新的流程图及请求它的用户消息始终保留
+    """
+    latest = max((i for i, m in enumerate(history) if m["role"] == "assistant" and is_diagram_xml(m["content"])),
+                 default=None)
+
+    compacted = []
+    version = 0
+    for i, message in enumerate(history):
+        if message["role"] == "assistant" and is_diagram_xml(message["content"]):
+            version += 1
+            if i != latest:
+                message = {"role": "assistant", "content": summarize_diagram(message["content"], version)}
+        compacted.append(message)
+
+    # 按预算丢弃最早的消息；请求最新流程图的用户消息及之后的消息不丢弃
+    keep_from = len(compacted)
+    if latest is not None:
+        keep_from = latest
+        if latest > 0 and compacted[latest - 1]["role"] == "user":
+            keep_from = latest - 1
+    dropped = 0
+    while dropped < keep_from and estimate_messages_tokens(compacted[dropped:]) > budget:
+        dropped += 1
+    # 不以助手回复开头，避免孤立的回答
+    while dropped < keep_from and compacted[dropped]["role"] == "assistant":
+        dropped += 1
+
+    return compacted[dropped:]
+
+def history_token_budget(candidates: List[dict]) -> int:
+    """候选 API 中最小的预算：故障转移时同一份消息会发给每个候选模型"""
+    budgets = [c.get("history_token_budget") or HISTORY_TOKEN_BUDGET for c in candidates]
+    return min(budgets) if budgets else HISTORY_TOKEN_BUDGET
+
+# ========== 增量编辑（补丁模式）==========
+# 已有流程图时让模型只返回修改补丁，由服务端应用到当前图表；补丁无法应用时回退为完整生成
+# auto: 有上一版流程图时使用补丁模式；off: 始终完整生成
+EDIT_MODE = os.getenv("EDIT_MODE", "auto").lower()
+
+EDIT_SYSTEM_PROMPT = """你是 draw.io 流程图编辑助手。用户会提供当前流程图的 XML 和修改要求，
+你只需返回修改补丁，不要返回完整的流程图。
+
+补丁格式：
+<patch>
+  <!-- 新增节点或连线：完整的 mxCell，id 不能与已有的重复，parent 必须存在 -->
+  <add>
+    <mxCell id="n1" value="新节点" style="rounded=1;whiteSpace=wrap;html=1;" vertex="1" parent="1">
+      <mxGeometry x="100" y="300" width="120" height="60" as="geometry"/>
+    </mxCell>
+    <mxCell id="n2" style="edgeStyle=orthogonalEdgeStyle;html=1;" edge="1" parent="1" source="2" target="n1">
+      <mxGeometry relative="1" as="geometry"/>
+    </mxCell>
+  </add>
+  <!-- 修改已有元素：只写需要修改的属性；几何信息写在 mxGeometry 中 -->
+  <update id="2" value="新名称" style="rounded=1;fillColor=#dae8fc;html=1;">
+    <mxGeometry x="200" y="100"/>
+  </update>
+  <!-- 删除元素（其子元素和相连的连线会一并删除） -->
+  <delete id="3"/>
+</patch>
+
+只返回 patch XML，不要解释。"""
+
+class DiagramPatchError(ValueError):
+    """补丁与当前图表不匹配"""
+
+def _inner_cell(cell: ET.Element) -> ET.Element:
+    """<object>/<UserObject> 包装的节点，结构属性在内部的 mxCell 上"""
+    if cell.tag == 'mxCell':
+        return cell
+    inner = cell.find('mxCell')
+    return inner if inner is not None else cell
+
+def apply_diagram_patch(base_xml: str, patch_xml: str) -> str:
+    """把补丁应用到图表，返回新的 XML；补丁引用了不存在的元素等情况抛出 DiagramPatchError"""
+    try:
+        base = ET.fromstring(base_xml)
+    except ET.ParseError as e:
+        raise DiagramPatchError(f"当前流程图无法解析: {e}")
+    try:
+        patch = ET.fromstring(patch_xml)
+    except ET.ParseError as e:
+        raise DiagramPatchError(f"XML 语法错误: {e}")
+    if patch.tag != 'patch':
+        raise DiagramPatchError("缺少 patch 根元素")
+    if len(patch) == 0:
+        raise DiagramPatchError("补丁为空")
+
+    # id → (所在 root, 元素)
+    index: Dict[str, Tuple[ET.Element, ET.Element]] = {}
+    for root in base.iter('root'):
+        for cell in root:
+            if cell.get('id') is not None:
+                index.setdefault(cell.get('id'), (root, cell))
+    if not index:
+        raise DiagramPatchError("当前图表中没有可编辑的元素")
+
+    for op in patch:
+        if op.tag == 'add':
+            for cell in op:
+                cell_id = cell.get('id')
+                if not cell_id:
+                    raise DiagramPatchError("新增元素缺少 id")
+                if cell_id in index:
+                    raise DiagramPatchError(f"新增元素 id 已存在: {cell_id}")
+                parent = _inner_cell(cell).get('parent')
+                if parent not in index:
+                    raise DiagramPatchError(f"新增元素 {cell_id} 的 parent 不存在: {parent}")
+                root = index[parent][0]
+                cell.tail = None
+                root.append(cell)
+                index[cell_id] = (root, cell)
+
+        elif op.tag == 'update':
+            cell_id = op.get('id')
+            if cell_id not in index:
+                raise DiagramPatchError(f"要修改的元素不存在: {cell_id}")
+            cell = index[cell_id][1]
+            for key, value in op.attrib.items():
+                if key != 'id':
+                    # 包装节点的 label 等属性在外层，其余结构属性在内部 mxCell 上
+                    target = cell if key in cell.attrib or cell.tag == 'mxCell' else _inner_cell(cell)
+                    target.set(key, value)
+            for child in op:
+                if child.tag != 'mxGeometry':
+                    raise DiagramPatchError(f"update 中不支持的元素: {child.tag}")
+                inner = _inner_cell(cell)
+                geometry = inner.find('mxGeometry')
+                if geometry is None:
+                    child.set('as', 'geometry')
+                    inner.append(child)
+                    continue
+                for key, value in child.attrib.items():
+                    geometry.set(key, value)
+                if len(child):
+                    for old in list(geometry):
+                        geometry.remove(old)
+                    geometry.extend(list(child))
+
+        elif op.tag == 'delete':
+            cell_id = op.get('id')
+            if cell_id not in index:
+                raise DiagramPatchError(f"要删除的元素不存在: {cell_id}")
+            if cell_id in ('0', '1'):
+                raise DiagramPatchError("不能删除基础单元格")
+
+            # 一并删除子元素和相连的连线
+            removed = {cell_id}
+            changed = True
+            while changed:
+                changed = False
+                for other_id, (_, other) in index.items():
+                    if other_id in removed:
+                        continue
+                    inner = _inner_cell(other)
+                    if any(inner.get(attr) in removed for attr in ('parent', 'source', 'target')):
+                        removed.add(other_id)
+                        changed = True
+            for removed_id in removed:
+                root, cell = index.pop(removed_id)
+                root.remove(cell)
+
+        else:
+            raise DiagramPatchError(f"未知的补丁操作: {op.tag}")
+
+    # 应用后所有引用都必须存在
+    for cell_id, (_, cell) in index.items():
+        inner = _inner_cell(cell)
+        for attr in ('parent', 'source', 'target'):
+            ref = inner.get(attr)
+            if ref is not None and ref not in index:
+                raise DiagramPatchError(f"元素 {cell_id} 的 {attr} 不存在: {ref}")
+
+    return ET.tostring(base, encoding='unicode')
+
+def apply_and_validate_patch(base_xml: str, patch: str) -> Tuple[str, bool, str, bool]:
+    """应用补丁并严格验证结果（可在进程池中执行），返回 (XML, 是否有效, 错误信息, 是否为补丁不匹配)"""
+    try:
+        xml = apply_diagram_patch(base_xml, patch)
+    except DiagramPatchError as e:
+        return patch, False, f"补丁无法应用: {e}", True
+    return (xml, *validate_xml_strict(xml), False)
+
+class DrawioPatchProcessor(DrawioXMLProcessor):
+    """
+    补丁模式的输出处理器：清理/增量解析与完整模式相同，
+    finish() 时把补丁应用到 base_xml，返回完整的新图表及验证结果；
+    补丁与当前图表不匹配时设置 fallback_reason，由调用方回退为完整生成
+    """
+
+    def __init__(self, base_xml: str, max_chars: Optional[int] = None):
+        super().__init__(max_chars=max_chars)
+        self.base_xml = base_xml
+
+    def finish(self) -> Tuple[str, bool, str]:
+        if self._result is not None:
+            return self._result
+        patch = self._close_input()
+        if self.error:
+            self._result = (patch, False, self.error)
+            return self._result
+        return self._set_result(apply_and_validate_patch(self.base_xml, patch))
+
+    async def finish_async(self) -> Tuple[str, bool, str]:
+        """应用补丁需要解析整张当前图表，大图表在进程池中执行，不阻塞事件循环"""
+        if self._result is not None:
+            return self._result
+        patch = self._close_input()
+        if self.error:
+            self._result = (patch, False, self.error)
+            return self._result
+        started = time.perf_counter()
+        result = await xml_pool.run(apply_and_validate_patch, self.base_xml, patch)
+        self._set_result(result)
+        self.validate_seconds = time.perf_counter() - started
+        return self._result
+
+    def _set_result(self, result: Tuple[str, bool, str, bool]) -> Tuple[str, bool, str]:
+        xml, is_valid, error, mismatch = result
+        if mismatch:
+            self.fallback_reason = error
+        self._result = (xml, is_valid, error)
+        return self._result
+
+def latest_diagram_xml(request: DiagramGenerateRequest) -> Optional[str]:
+    """对话历史中最新一版流程图"""
+    for msg in reversed(request.messages):
+        if msg.role == "assistant" and is_diagram_xml(msg.content):
+            return msg.content
+    return None
+
+def use_edit_mode(request: DiagramGenerateRequest, base_xml: Optional[str]) -> bool:
+    if base_xml is None or request.edit_mode is False:
+        return False
+    return request.edit_mode is True or EDIT_MODE == "auto"
+
+def build_edit_messages(request: DiagramGenerateRequest, base_xml: str) -> List[dict]:
+    return [
+        {"role": "system", "content": EDIT_SYSTEM_PROMPT},
+        {"role": "user", "content": f"当前流程图：\n{base_xml}\n\n修改要求：{request.prompt}"}
+    ]
+
+def apply_patch_output(base_xml: str, output: str) -> Tuple[str, bool, str]:
+    """处理非流式接口返回的完整补丁"""
+    processor = DrawioPatchProcessor(base_xml)
+    processor.feed(output)
+    return processor.finish()
+
+# ========== 自动布局（分层布局）==========
+# 拓扑模式：模型只给出节点和连线，坐标由服务端分层布局（Sugiyama 风格）确定性计算
+# 相同的拓扑总是得到相同的布局；off: 默认不启用（请求中 auto_layout=true 可单独开启）
+AUTO_LAYOUT = os.getenv("AUTO_LAYOUT", "off").lower()
+LAYOUT_DIRECTION = os.getenv("LAYOUT_DIRECTION", "TB").upper()           # TB: 从上到下；LR: 从左到右
+LAYOUT_NODE_SPACING = int(os.getenv("LAYOUT_NODE_SPACING", "40"))        # 同一层相邻节点的间距
+LAYOUT_LAYER_SPACING = int(os.getenv("LAYOUT_LAYER_SPACING", "60"))      # 相邻两层的间距
+LAYOUT_MARGIN = int(os.getenv("LAYOUT_MARGIN", "40"))                    # 图表四周留白
+LAYOUT_GRID = 10                 # 与模板一致：坐标为 10 的倍数
+LAYOUT_SWEEPS = 4                # 重心法排序的往返扫描次数
+LAYOUT_DEFAULT_SIZE = (120, 60)  # 模型未给出尺寸时的默认节点大小
+
+TOPOLOGY_PROMPT_SUFFIX = """
+
+坐标由程序自动布局：
+- 节点的 mxGeometry 不要写 x、y，只写 width、height，例如 <mxGeometry width="120" height="60" as="geometry"/>
+- 连线写 <mxGeometry relative="1" as="geometry"/>，不要写拐点
+- 按流程顺序给出 source/target，节点的位置由连线关系决定"""
+
+def use_auto_layout(request: DiagramGenerateRequest) -> bool:
+    if request.auto_layout is not None:
+        return request.auto_layout
+    return AUTO_LAYOUT == "on"
+
+def system_prompt_for(request: DiagramGenerateRequest) -> str:
+    """请求使用的系统提示词：自定义提示词（模板）或默认提示词，拓扑模式下附加布局说明"""
+    system_prompt = request.system_prompt if request.system_prompt else SYSTEM_PROMPT
+    if use_auto_layout(request):
+        system_prompt += TOPOLOGY_PROMPT_SUFFIX
+    return system_prompt
+
+def _snap(value: float) -> int:
+    return int(round(value / LAYOUT_GRID)) * LAYOUT_GRID
+
+def layered_layout(sizes: Dict[str, Tuple[float, float]], edges: List[Tuple[str, str]],
+                   direction: str = "TB") -> Dict[str, Tuple[int, int]]:
+    """
+    分层布局，返回各节点左上角坐标（对齐到网格）
+    sizes: 节点 id → (width, height)，按出现顺序；edges: (source, target)
+    1. 去环：DFS 遇到回边时将其反向
+    2. 分层：按拓扑序取最长路径层号
+    3. 排序：逐层按上/下层邻居位置的重心排序，往返扫描若干次以减少交叉
+    4. 坐标：层内节点尽量对齐到上层邻居的中心，并保持最小间距
+    复杂度 O(V + E log E)（每次扫描的排序量为 O(V log V)，扫描次数为常数）
+    """
+    succ: Dict[str, List[str]] = {v: [] for v in sizes}
+    seen_edges = set()
+    for source, target in edges:
+        if source == target or source not in succ or target not in succ or (source, target) in seen_edges:
+            continue
+        seen_edges.add((source, target))
+        succ[source].append(target)
+
+    # 1. 去环（迭代 DFS，避免深图递归溢出）
+    dag: Dict[str, List[str]] = {v: [] for v in sizes}
+    state = dict.fromkeys(sizes, 0)  # 0: 未访问，1: 在栈上，2: 已完成
+    for root in sizes:
+        if state[root]:
+            continue
+        state[root] = 1
+        stack = [(root, iter(succ[root]))]
+        while stack:
+            v, children = stack[-1]
+            for w in children:
+                if state[w] == 1:
+                    dag[w].append(v)  # 回边反向
+                    continue
+                dag[v].append(w)
+                if state[w] == 0:
+                    state[w] = 1
+                    stack.append((w, iter(succ[w])))
+                    break
+            else:
+                state[v] = 2
+                stack.pop()
+
+    # 2. 分层（Kahn 拓扑序 + 最长路径）
+    preds: Dict[str, List[str]] = {v: [] for v in sizes}
+    for v, targets in dag.items():
+        for w in targets:
+            preds[w].append(v)
+    indegree = {v: len(preds[v]) for v in sizes}
+    rank = dict.fromkeys(sizes, 0)
+    ready = deque(v for v in sizes if indegree[v] == 0)
+    order = []
+    while ready:
+        v = ready.popleft()
+        order.append(v)
+        for w in dag[v]:
+            rank[w] = max(rank[w], rank[v] + 1)
+            indegree[w] -= 1
+            if indegree[w] == 0:
+                ready.append(w)
+
+    layers: List[List[str]] = [[] for _ in range(max(rank.values(), default=-1) + 1)]
+    for v in order:
+        layers[rank[v]].append(v)
+
+    # 3. 层内排序（重心法）
+    position = {v: i for layer in layers for i, v in enumerate(layer)}
+
+    def reorder(layer: List[str], neighbors: Dict[str, List[str]]) -> List[str]:
+        if len(layer) < 2:
+            return layer
+
+        def barycenter(v: str) -> float:
+            linked = neighbors[v]
+            return sum(position[u] for u in linked) / len(linked) if linked else position[v]
+        layer = sorted(layer, key=barycenter)  # 稳定排序，重心相同时保持原顺序
+        for i, v in enumerate(layer):
+            position[v] = i
+        return layer
+
+    for _ in range(LAYOUT_SWEEPS):
+        for i in range(1, len(layers)):
+            layers[i] = reorder(layers[i], preds)
+        for i in range(len(layers) - 2, -1, -1):
+            layers[i] = reorder(layers[i], dag)
+
+    # 4. 坐标：cross 为层内方向，main 为层间方向
+    horizontal = direction == "LR"
+    cross_size = (lambda v: sizes[v][1]) if horizontal else (lambda v: sizes[v][0])
+    main_size = (lambda v: sizes[v][0]) if horizontal else (lambda v: sizes[v][1])
+
+    center: Dict[str, float] = {}
+    for layer in layers:
+        cursor = None  # 上一个节点右边界 + 间距
+        for v in layer:
+            placed = [center[u] for u in preds[v] if u in center]
+            left = sum(placed) / len(placed) - cross_size(v) / 2 if placed else (cursor or 0)
+            if cursor is not None:
+                left = max(left, cursor)
+            center[v] = left + cross_size(v) / 2
+            cursor = left + cross_size(v) + LAYOUT_NODE_SPACING
+
+    min_left = min((center[v] - cross_size(v) / 2 for v in center), default=0)
+    positions: Dict[str, Tuple[int, int]] = {}
+    offset = LAYOUT_MARGIN
+    for layer in layers:
+        band = max(main_size(v) for v in layer)
+        for v in layer:
+            cross = _snap(center[v] - cross_size(v) / 2 - min_left + LAYOUT_MARGIN)
+            main = _snap(offset + (band - main_size(v)) / 2)
+            positions[v] = (main, cross) if horizontal else (cross, main)
+        offset += band + LAYOUT_LAYER_SPACING
+    return positions
+
+def auto_layout_xml(xml: str, direction: Optional[str] = None) -> str:
+    """
+    对图表中每一页的顶层节点执行分层布局，重写节点坐标并清除连线的旧拐点
+    容器内的子节点保持相对坐标不变；连到子节点的连线按其所在的顶层容器参与布局
+    """
+    tree = ET.fromstring(xml)
+    for root in tree.iter('root'):
+        cells = {}
+        for cell in root:
+            cell_id = cell.get('id') or _inner_cell(cell).get('id')
+            if cell_id is not None:
+                cells[cell_id] = _inner_cell(cell)
+        base_ids = {i for i, c in cells.items() if c.get('parent') is None}
+        layer_ids = {i for i, c in cells.items()
+                     if c.get('parent') in base_ids and not c.get('vertex') and not c.get('edge')}
+        top = {i: c for i, c in cells.items() if c.get('vertex') == '1' and c.get('parent') in layer_ids}
+
+        def top_level(cell_id: Optional[str]) -> Optional[str]:
+            for _ in range(len(cells)):
+                if cell_id is None or cell_id in top:
+                    return cell_id
+                cell = cells.get(cell_id)
+                cell_id = cell.get('parent') if cell is not None else None
+            return None
+
+        sizes = {}
+        for cell_id, cell in top.items():
+            geometry = cell.find('mxGeometry')
+            if geometry is None:
+                geometry = ET.SubElement(cell, 'mxGeometry', {'as': 'geometry'})
+            width = float(geometry.get('width') or LAYOUT_DEFAULT_SIZE[0])
+            height = float(geometry.get('height') or LAYOUT_DEFAULT_SIZE[1])
+            geometry.set('width', f"{width:g}")
+            geometry.set('height', f"{height:g}")
+            sizes[cell_id] = (width, height)
+
+        edges = []
+        for cell in cells.values():
+            if cell.get('edge') != '1':
+                continue
+            source, target = top_level(cell.get('source')), top_level(cell.get('target'))
+            if source is not None and target is not None:
+                edges.append((source, target))
+            # 节点位置已变化，模型给出的拐点不再有意义
+            geometry = cell.find('mxGeometry')
+            if geometry is not None:
+                for points in geometry.findall("Array[@as='points']"):
+                    geometry.remove(points)
+
+        for cell_id, (x, y) in layered_layout(sizes, edges, direction or LAYOUT_DIRECTION).items():
+            geometry = top[cell_id].find('mxGeometry')
+            geometry.set('x', str(x))
+            geometry.set('y', str(y))
+    return ET.tostring(tree, encoding='unicode')
+
+def layout_generated_xml(xml: str) -> str:
+    """拓扑模式下对生成结果执行自动布局；XML 无法解析时原样返回"""
+    started = time.perf_counter()
+    try:
+        laid_out = auto_layout_xml(xml)
+    except ET.ParseError as e:
+        logger.warning(f"[自动布局] XML 无法解析，跳过布局: {e}")
+        return xml
+    logger.info(f"[自动布局] 完成，耗时 {(time.perf_counter() - started) * 1000:.1f}ms")
+    return laid_out
+
+# ========== 拓扑 DSL ==========
+# DSL 模式：模型输出简洁的节点/连线 DSL（引用命名样式预设），由服务端编译为 draw.io XML 并自动布局
+# 相比完整 XML 省去了重复的 style 和坐标，输出 token 大幅减少；流式输出时可边接收边渲染
+# on: 默认启用；off: 默认关闭（请求中 dsl=true/false 可单独指定）
+DSL_MODE = os.getenv("DSL_MODE", "off").lower()
+DSL_PARTIAL_INTERVAL_MS = int(os.getenv("DSL_PARTIAL_INTERVAL_MS", "500"))  # 流式渲染部分图表的最小间隔
+
+_DSL_NODE_STYLE = "whiteSpace=wrap;html=1;strokeColor=#2C3E50;strokeWidth=2;fontSize=12;fontFamily=Arial;"
+_DSL_EDGE_STYLE = ("edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;"
+                   "strokeColor=#2C3E50;strokeWidth=2;fontSize=10;fontFamily=Arial;endArrow=classicBlock;")
+
+# 节点样式预设：名称 → (style, width, height, 说明)，配色与内置模板一致
+DSL_NODE_PRESETS = {
+    "process": ("rounded=1;fillColor=#dae8fc;" + _DSL_NODE_STYLE, 120, 60, "处理步骤（默认）"),
+    "start": ("ellipse;fillColor=#d5e8d4;" + _DSL_NODE_STYLE, 120, 60, "开始"),
+    "end": ("ellipse;fillColor=#f8cecc;" + _DSL_NODE_STYLE, 120, 60, "结束"),
+    "decision": ("rhombus;fillColor=#fff2cc;" + _DSL_NODE_STYLE, 160, 80, "判断"),
+    "data": ("shape=parallelogram;perimeter=parallelogramPerimeter;fixedSize=1;fillColor=#F7F9FC;" + _DSL_NODE_STYLE,
+             140, 60, "输入/输出数据"),
+    "database": ("shape=cylinder3;boundedLbl=1;backgroundOutline=1;size=15;fillColor=#F7F9FC;" + _DSL_NODE_STYLE,
+                 100, 80, "数据库/存储"),
+    "document": ("shape=document;boundedLbl=1;fillColor=#F7F9FC;" + _DSL_NODE_STYLE, 120, 80, "文档"),
+    "actor": ("shape=umlActor;verticalLabelPosition=bottom;verticalAlign=top;fillColor=#F7F9FC;" + _DSL_NODE_STYLE,
+              40, 70, "用户/角色"),
+    "note": ("shape=note;size=14;fillColor=#F7F9FC;" + _DSL_NODE_STYLE, 140, 60, "备注"),
+}
+DSL_DEFAULT_PRESET = "process"
+
+# 连线样式预设：箭头 → style
+DSL_EDGE_PRESETS = {
+    "->": _DSL_EDGE_STYLE,
+    "-->": _DSL_EDGE_STYLE + "dashed=1;",
+}
+
+_DSL_ID = r'[\w.-]+'
+_DSL_DIRECTION_RE = re.compile(r'^direction\s+(TB|LR)$', re.IGNORECASE)
+_DSL_EDGE_RE = re.compile(rf'^({_DSL_ID}?)\s*(-->|->)\s*({_DSL_ID})(?:(?:\s*:\s*|\s+)(.*))?$')
+_DSL_NODE_RE = re.compile(rf'^({_DSL_ID})(?:\[(\w+)\])?(?:\s+(.*))?$')
+
+DSL_SYSTEM_PROMPT = """你是流程图拓扑生成助手。根据用户描述，用下面的 DSL 描述流程图的节点和连线，不要输出 XML。
+布局和样式由程序自动完成，你只需给出结构。
+
+语法（每行一条）：
+- 节点：id[样式] 文本，例如 check[decision] 库存充足?；省略 [样式] 时为 process
+- 连线：源id -> 目标id 标签，例如 check -> ship 是；--> 表示虚线；标签可省略
+- 方向（可选，写在第一行）：direction TB（从上到下，默认）或 direction LR（从左到右）
+- id 只能包含字母、数字、下划线、点和横线，且不能重复
+
+可用样式：
+""" + "\n".join(f"- {name}：{desc}" for name, (_, _, _, desc) in DSL_NODE_PRESETS.items()) + """
+
+示例：
+start[start] 开始
+input[data] 读取订单
+check[decision] 库存充足?
+ship 发货
+notify[end] 通知缺货
+start -> input
+input -> check
+check -> ship 是
+check --> notify 否
+
+只返回 DSL，不要解释，不要使用代码块。"""
+
+def _strip_quotes(text: Optional[str]) -> str:
+    text = (text or "").strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in "\"'":
+        return text[1:-1]
+    return text
+
+class DiagramDSL:
+    """按行增量解析的拓扑 DSL，可随时编译为 draw.io XML"""
+
+    def __init__(self):
+        self.direction = LAYOUT_DIRECTION
+        self.nodes: Dict[str, Tuple[str, str]] = {}            # id → (预设, 文本)，按首次出现的顺序
+        self.edges: List[Tuple[str, str, str, str]] = []       # (源, 目标, 箭头, 标签)
+        self.ignored_lines = 0
+        self.version = 0  # 每解析出一条有效内容加 1，用于判断是否需要重新渲染
+
+    def add_line(self, line: str):
+        line = line.strip()
+        if not line or line.startswith(('#', '//', '```')):
+            return
+
+        match = _DSL_DIRECTION_RE.match(line)
+        if match:
+            self.direction = match.group(1).upper()
+            self.version += 1
+            return
+
+        match = _DSL_EDGE_RE.match(line)
+        if match:
+            source, arrow, target, label = match.groups()
+            for node_id in (source, target):
+                # 连线可以先于节点定义出现，先按默认样式占位
+                self.nodes.setdefault(node_id, (DSL_DEFAULT_PRESET, node_id))
+            self.edges.append((source, target, arrow, _strip_quotes(label)))
+            self.version += 1
+            return
+
+        match = _DSL_NODE_RE.match(line)
+        if match:
+            node_id, preset, label = match.groups()
+            if preset not in DSL_NODE_PRESETS:
+                preset = DSL_DEFAULT_PRESET
+            self.nodes[node_id] = (preset, _strip_quotes(label) or node_id)
+            self.version += 1
+            return
+
+        self.ignored_lines += 1
+
+    def to_xml(self) -> str:
+        """编译为 draw.io XML：节点使用预设样式，坐标由分层布局计算"""
+        # 0/1 为根节点和默认图层，同名的 DSL id 加前缀；连线 id 避开节点 id
+        cell_ids = {node_id: (f"n{node_id}" if node_id in ("0", "1") else node_id) for node_id in self.nodes}
+        used = set(cell_ids.values())
+        sizes = {node_id: DSL_NODE_PRESETS[preset][1:3] for node_id, (preset, _) in self.nodes.items()}
+        positions = layered_layout(sizes, [(s, t) for s, t, _, _ in self.edges], self.direction)
+
+        mxfile = ET.Element('mxfile', {'host': 'app.diagrams.net'})
+        diagram = ET.SubElement(mxfile, 'diagram', {'name': 'Page-1', 'id': 'diagram1'})
+        model = ET.SubElement(diagram, 'mxGraphModel', {'grid': '1', 'gridSize': str(LAYOUT_GRID)})
+        root = ET.SubElement(model, 'root')
+        ET.SubElement(root, 'mxCell', {'id': '0'})
+        ET.SubElement(root, 'mxCell', {'id': '1', 'parent': '0'})
+
+        for node_id, (preset, label) in self.nodes.items():
+            style, width, height, _ = DSL_NODE_PRESETS[preset]
+            x, y = positions[node_id]
+            cell = ET.SubElement(root, 'mxCell', {'id': cell_ids[node_id], 'value': label, 'style': style,
+                                                  'vertex': '1', 'parent': '1'})
+            ET.SubElement(cell, 'mxGeometry', {'x': str(x), 'y': str(y), 'width': str(width),
+                                               'height': str(height), 'as': 'geometry'})
+
+        counter = 0
+        for source, target, arrow, label in self.edges:
+            counter += 1
+            while f"e{counter}" in used:
+                counter += 1
+            cell = ET.SubElement(root, 'mxCell', {'id': f"e{counter}", 'value': label, 'style': DSL_EDGE_PRESETS[arrow],
+                                                  'edge': '1', 'parent': '1',
+                                                  'source': cell_ids[source], 'target': cell_ids[target]})
+            ET.SubElement(cell, 'mxGeometry', {'relative': '1', 'as': 'geometry'})
+
+        return ET.tostring(mxfile, encoding='unicode')
+
+class DrawioDSLProcessor(DrawioXMLProcessor):
+    """
+    DSL 模式的输出处理器：逐行解析 DSL，finish() 时编译为 draw.io XML
+    模型没有遵守格式、直接输出 XML（首个有效字符为 '<'）时按完整 XML 处理
+    """
+
+    def __init__(self, max_chars: Optional[int] = None):
+        super().__init__(max_chars=max_chars)
+        self.dsl = DiagramDSL()
+        self._xml_mode: Optional[bool] = None  # 尚未判断输出格式时为 None
+        self._line_parts: List[str] = []  # 尚未遇到换行的内容
+        self._rendered_version = 0
+        self._rendered_at = 0.0
+
+    def feed(self, chunk: str):
+        if self._xml_mode:
+            super().feed(chunk)
+            return
+        if not chunk:
+            return
+
+        self.received += len(chunk)
+        self._line_parts.append(chunk)
+        if self._xml_mode is None:
+            head = ''.join(self._line_parts).lstrip()
+            if head.startswith('```'):
+                head = head.partition('\n')[2].lstrip()
+            if not head:
+                return
+            self._xml_mode = head.startswith('<')
+            if self._xml_mode:
+                logger.warning("[DSL] 模型返回了 XML，按完整 XML 处理")
+                buffered, self._line_parts = ''.join(self._line_parts), []
+                self.received = 0
+                super().feed(buffered)
+                return
+
+        if self.max_chars and self.received > self.max_chars:
+            self.over_limit = True
+            self.abort_reason = f"输出超过大小限制（{self.max_chars} 字符）"
+        if '\n' not in chunk:
+            return
+        *lines, rest = ''.join(self._line_parts).split('\n')
+        self._line_parts = [rest]
+        for line in lines:
+            self.dsl.add_line(line)
+
+    def memory_bytes(self) -> int:
+        if self._xml_mode:
+            return super().memory_bytes()
+        nodes = sum(sys.getsizeof(node_id) + sys.getsizeof(label) for node_id, (_, label) in self.dsl.nodes.items())
+        edges = sum(sys.getsizeof(label) for _, _, _, label in self.dsl.edges)
+        return nodes + edges + sum(sys.getsizeof(part) for part in self._line_parts)
+
+    def partial_xml(self) -> Optional[str]:
+        """有新解析出的节点/连线且距上次渲染超过 DSL_PARTIAL_INTERVAL_MS 时返回部分图表"""
+        if self._xml_mode or not self.dsl.nodes or self.dsl.version == self._rendered_version:
+            return None
+        now = time.monotonic()
+        if now - self._rendered_at < DSL_PARTIAL_INTERVAL_MS / 1000:
+            return None
+        self._rendered_version = self.dsl.version
+        self._rendered_at = now
+        return self.dsl.to_xml()
+
+    def finish(self) -> Tuple[str, bool, str]:
+        if self._xml_mode:
+            return super().finish()
+        if self._result is not None:
+            return self._result
+
+        self.dsl.add_line(''.join(self._line_parts))
+        self._line_parts = []
+        if self.dsl.ignored_lines:
+            logger.warning(f"[DSL] 忽略 {self.dsl.ignored_lines} 行无法解析的内容")
+        if not self.dsl.nodes:
+            self._result = ("", False, "DSL 中没有节点")
+        else:
+            self._result = (self.dsl.to_xml(), True, "")
+        return self._result
+
+def use_dsl(request: DiagramGenerateRequest) -> bool:
+    if request.dsl is not None:
+        return request.dsl
+    return DSL_MODE == "on"
+
+def compile_dsl_output(output: str) -> Tuple[str, bool, str]:
+    """处理非流式接口返回的完整 DSL"""
+    processor = DrawioDSLProcessor()
+    processor.feed(output)
+    return processor.finish()
+
+# ========== XML 处理进程池 ==========
+# XML 清理、验证、样式规范化、自动布局、DSL 编译都是纯 CPU 计算，在事件循环中处理几百 KB 的输出会卡住同一进程里的所有 SSE 流
+# 超过 XML_POOL_THRESHOLD 字符的文档交给进程池处理；较小的文档进程间传输的开销比处理本身还大，直接在事件循环中处理
+# 默认在各 worker 之间平分 CPU 核数，多 worker 部署时进程总数不随 worker 数成倍增加；0 表示不使用进程池
+XML_POOL_WORKERS = int(os.getenv("XML_POOL_WORKERS", str(min(4, max(1, (os.cpu_count() or 1) // max(WORKERS, 1))))))
+XML_POOL_THRESHOLD = int(os.getenv("XML_POOL_THRESHOLD", "100000"))
+# 同时提交到进程池的任务上限，超过时调用方排队等待（背压），避免大量大文档堆积在进程池队列中占用内存
+XML_POOL_MAX_PENDING = int(os.getenv("XML_POOL_MAX_PENDING", str(max(XML_POOL_WORKERS, 1) * 4)))
+LOOP_LAG_INTERVAL = 0.5  # 事件循环延迟的采样间隔（秒）
+
+def _payload_size(value) -> int:
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_payload_size(item) for item in value)
+    return 0
+
+def _exit_with_parent(parent_pid: int):
+    """主进程被强制结束（如 SIGKILL）时进程池来不及关闭，子进程发现父进程不在后自行退出"""
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(0)
+
+def _init_xml_worker():
+    """
+    子进程初始化：fork 不会复制日志写出线程，改为直接写 stdout；
+    Ctrl+C 只由主进程处理，子进程随进程池关闭（或主进程退出）退出
+    """
+    threading.Thread(target=_exit_with_parent, args=(os.getppid(),), daemon=True).start()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+    output.addFilter(LogContextFilter())
+    logger.addHandler(output)
+
+def _run_xml_worker(request_id: str, func: Callable, args: tuple):
+    """在子进程中执行；带上 request_id 关联日志，并返回本次调用产生的样式统计增量"""
+    request_id_var.set(request_id)
+    before = dict(style_stats)
+    result = func(*args)
+    return result, {key: style_stats[key] - before[key] for key in before}
+
+class XMLProcessPool:
+    """按文档大小选择在事件循环中处理还是交给进程池；进程池已满时调用方在信号量上排队"""
+
+    def __init__(self, workers: int, threshold: int, max_pending: int):
+        self.workers = workers
+        self.threshold = threshold
+        self.max_pending = max_pending
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots = asyncio.Semaphore(max_pending)
+        self.waiting = 0
+        self.running = 0
+
+    def start(self):
+        if self.workers <= 0 or self._executor is not None:
+            return
+        if "fork" not in multiprocessing.get_all_start_methods():
+            # spawn 方式需要在子进程中重新导入整个应用，不值得；在事件循环中处理
+            logger.warning("[进程池] 当前平台不支持 fork，XML 处理在主进程中执行")
+            self.workers = 0
+            return
+        executor = ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_xml_worker
+        )
+        # 第一次提交任务时一次创建全部子进程。启动时由 lifespan 在没有其它线程时调用；
+        # 重建时（_restart）其它线程已在运行，子进程初始化时替换日志 handler，不使用从父进程复制来的锁和连接
+        executor.submit(int).result()
+        self._executor = executor
+        logger.info(f"[进程池] 已启动 {self.workers} 个 XML 处理进程（超过 {self.threshold} 字符的文档使用进程池）")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, func: Callable, *args):
+        """执行 func(*args)；func 必须是模块级函数，参数和返回值可以被 pickle"""
+        started = time.perf_counter()
+        if self._executor is None or _payload_size(args) < self.threshold:
+            return self._run_inline(func, args, started)
+
+        self.waiting += 1
+        metrics.xml_pool_waiting.inc()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+            metrics.xml_pool_waiting.dec()
+        metrics.xml_pool_wait.observe(time.perf_counter() - started)
+
+        # 槽位在子进程真正处理完后才释放：调用方被取消时子进程仍在运行，仍要占用槽位
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        if executor is None:
+            # 排队期间进程池损坏，正在后台重建
+            self._slots.release()
+            return self._run_inline(func, args, started)
+        self.running += 1
+        metrics.xml_pool_running.inc()
+        try:
+            future = executor.submit(_run_xml_worker, request_id_var.get(), func, args)
+        except (BrokenProcessPool, RuntimeError):
+            self._release()
+            return self._rerun_inline(executor, func, args, started)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+
+        try:
+            result, style_delta = await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            return self._rerun_inline(executor, func, args, started)
+        for key, value in style_delta.items():
+            style_stats[key] += value
+        metrics.xml_tasks.observe(time.perf_counter() - started, func.__name__, "pool")
+        return result
+
+    def _release(self):
+        self.running -= 1
+        metrics.xml_pool_running.dec()
+        self._slots.release()
+
+    def _run_inline(self, func: Callable, args: tuple, started: float):
+        result = func(*args)
+        metrics.xml_tasks.observe(time.perf_counter() - started, func.__name__, "inline")
+        return result
+
+    def _rerun_inline(self, broken: ProcessPoolExecutor, func: Callable, args: tuple, started: float):
+        """
+        子进程异常退出（如被 OOM killer 杀掉）时本次任务在主进程中完成，进程池在后台线程中重建，不阻塞事件循环；
+        重建完成前所有任务都在主进程中执行
+        """
+        logger.warning(f"[进程池] 子进程异常退出，{func.__name__} 改为在主进程中执行")
+        # 同一个进程池上的其它任务也会失败，只有第一个发现的任务负责重建
+        if self._executor is broken:
+            self._executor = None
+            broken.shutdown(wait=False, cancel_futures=True)
+            asyncio.get_running_loop().run_in_executor(None, self._restart)
+        return self._run_inline(func, args, started)
+
+    def _restart(self):
+        try:
+            self.start()
+        except Exception as e:
+            logger.exception(f"[进程池] 重建进程池失败，XML 处理在主进程中执行: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "threshold": self.threshold,
+            "max_pending": self.max_pending,
+            "waiting": self.waiting,
+            "running": self.running
+        }
+
+xml_pool = XMLProcessPool(XML_POOL_WORKERS, XML_POOL_THRESHOLD, XML_POOL_MAX_PENDING)
+
+async def loop_lag_monitor():
+    """定期测量事件循环的调度延迟（sleep 实际多睡的时间），确认大文档处理没有卡住其它请求"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.loop_lag.observe(max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+# ========== 生成流水线（故障转移 + 对冲请求）==========
+# 对冲请求：主 API 迟迟没有首个 token 时，并行启动下一个优先级的 API，先产出有效 XML 者胜出
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_MAX_PARALLEL = int(os.getenv("HEDGE_MAX_PARALLEL", "2"))     # 同时进行的最大请求数
+HEDGE_DELAY_MS = int(os.getenv("HEDGE_DELAY_MS", "8000"))           # 统计样本不足时的对冲延迟
+HEDGE_MIN_DELAY_MS = int(os.getenv("HEDGE_MIN_DELAY_MS", "1000"))
+HEDGE_MAX_DELAY_MS = int(os.getenv("HEDGE_MAX_DELAY_MS", "30000"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "5"))       # 计算 p95 所需的最少样本数
+
+def hedge_delay(api_config: dict, metric: str = "ttft") -> float:
+    """对冲延迟（秒）：取该配置 p95 延迟，并限制在 [HEDGE_MIN_DELAY_MS, HEDGE_MAX_DELAY_MS]"""
+    p95 = config_manager.get_health(api_config['id']).p95(metric, HEDGE_MIN_SAMPLES)
+    if p95 is None:
+        return HEDGE_DELAY_MS / 1000
+    return min(max(p95, HEDGE_MIN_DELAY_MS / 1000), HEDGE_MAX_DELAY_MS / 1000)
+
+async def probe_provider(api_config: dict) -> bool:
+    """发送最小请求，探测熔断中的 API 是否已恢复"""
+    try:
+        async with client_pool.acquire(api_config['base_url']) as client:
+            response = await client.post(
+                f"{api_config['base_url']}/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {api_config['api_key']}",
+                    "Content-Type": "application/json"
+                },
+                json={
+                    "model": api_config['model'],
+                    "messages": [{"role": "user", "content": "ping"}],
+                    "max_tokens": 1
+                },
+                timeout=client_pool.timeout_for(api_config, 30.0)
+            )
+        return response.status_code == 200
+    except httpx.HTTPError:
+        return False
+
+async def circuit_probe_loop():
+    """后台任务：定期探测熔断中的配置，恢复后转为半开状态"""
+    while True:
+        await asyncio.sleep(CIRCUIT_PROBE_INTERVAL)
+        for api_config in get_ai_apis(include_unhealthy=True):
+            health = config_manager.get_health(api_config['id'])
+            if not health.probe_due():
+                continue
+
+            try:
+                recovered = await probe_provider(api_config)
+            except Exception as e:
+                # 配置本身有问题（如 api_key 含非 ASCII 字符无法编码为请求头）时同样视为探测失败，不能让后台任务退出
+                health.trip()
+                logger.warning(f"[熔断器] {api_config['name']} 探测出错，保持熔断: {type(e).__name__}: {e}")
+                continue
+
+            if recovered:
+                health.half_open()
+                logger.info(f"[熔断器] {api_config['name']} 探测成功，进入半开状态")
+            else:
+                health.trip()  # 重新计算冷却时间
+                logger.warning(f"[熔断器] {api_config['name']} 探测失败，保持熔断")
+
+def build_chat_messages(request: DiagramGenerateRequest, candidates: List[dict]) -> List[dict]:
+    """构建发送给模型的消息列表（系统提示词 + 对话历史 + 当前提示）"""
+    # DSL 模式下样式来自预设，模板的系统提示词不再适用
+    system_prompt = DSL_SYSTEM_PROMPT if use_dsl(request) else system_prompt_for(request)
+    history = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+
+    if HISTORY_COMPACTION and history:
+        # 预算扣除系统提示词和当前提示
+        fixed = estimate_messages_tokens([{"content": system_prompt}, {"content": request.prompt}])
+        before = estimate_messages_tokens(history)
+        history = compact_history(history, history_token_budget(candidates) - fixed)
+        after = estimate_messages_tokens(history)
+        if after < before:
+            logger.info(f"[历史压缩] 对话历史约 {before} → {after} tokens（{len(request.messages)} → {len(history)} 条）")
+
+    return [{"role": "system", "content": system_prompt}, *history, {"role": "user", "content": request.prompt}]
+
+def build_new_history(request: DiagramGenerateRequest, xml: str) -> List[dict]:
+    """构建返回给前端的对话历史（包含本次对话）"""
+    new_messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+    new_messages.append({"role": "user", "content": request.prompt})
+    new_messages.append({"role": "assistant", "content": xml})
+    return new_messages
+
+class UpstreamAttemptError(Exception):
+    """单个 API 请求失败（应尝试下一个 API）"""
+
+    def __init__(self, message: str, trip: bool = True):
+        super().__init__(message)
+        self.trip = trip  # 是否计入熔断（模型输出问题不计入）
+
+class StreamAttempt:
+    """
+    一次流式上游请求
+    对冲模式下可能同时存在多个，只有 leader 的内容实时转发给前端，其余先缓冲在 buffer 中
+    """
+
+    def __init__(self, api_config: dict, processor: DrawioXMLProcessor):
+        self.api_config = api_config
+        self.name = api_config['name']
+        self.processor = processor
+        self.buffer: List[str] = []
+        self.started_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.token_count = 0  # 收到的内容增量数（近似 token 数）
+        self.clean_seconds = 0.0  # 增量清理/解析累计耗时
+        self.task: Optional[asyncio.Task] = None
+        self.health = config_manager.get_health(api_config['id'])
+
+async def run_stream_attempt(attempt: StreamAttempt, messages: List[dict], queue: asyncio.Queue):
+    """
+    执行一次流式上游请求，把事件放入队列: (类型, attempt, 数据)
+    类型: content / complete(最终 XML) / invalid(XML 验证失败) / error(请求失败)
+    """
+    api_config = attempt.api_config
+    processor = attempt.processor
+    health = attempt.health
+
+    # 构建请求体 - 启用流式输出
+    payload = {
+        "model": api_config['model'],
+        "messages": messages,
+        "temperature": 0.7,
+        "stream": True  # 关键：启用流式输出
+    }
+
+    headers = {
+        "Authorization": f"Bearer {api_config['api_key']}",
+        "Content-Type": "application/json"
+    }
+
+    try:
+        # 使用流式请求（复用连接池中的客户端），请求期间占用该配置的并发槽位
+        async with admission.config_slot(api_config['id']), client_pool.acquire(api_config['base_url']) as client:
+            async with client.stream(
+                "POST",
+                f"{api_config['base_url']}/chat/completions",
+                headers=headers,
+                json=payload,
+                timeout=client_pool.timeout_for(api_config, 120.0)
+            ) as response:
+                if response.status_code != 200:
+                    error_msg = f"API 返回错误: {response.status_code}"
+                    health.record_failure(error_msg)
+                    metrics.attempts.inc(attempt.name, "error")
+                    await queue.put(('error', attempt, error_msg))
+                    return
+
+                # 边接收边清理/验证，[DONE] 到达时只需收尾
+                stream_done = False
+                async for line in response.aiter_lines():
+                    # 收到 [DONE] 后继续读完剩余响应，连接才能归还连接池复用
+                    if stream_done:
+                        continue
+
+                    if line.startswith("data: "):
+                        data_str = line[6:]  # 去掉 "data: " 前缀
+
+                        if data_str == "[DONE]":
+                            stream_done = True
+                            continue
+
+                        try:
+                            data = json.loads(data_str)
+                            if 'choices' in data and len(data['choices']) > 0:
+                                delta = data['choices'][0].get('delta', {})
+                                content = delta.get('content', '')
+
+                                if content:
+                                    if attempt.first_token_at is None:
+                                        attempt.first_token_at = time.monotonic()
+                                        health.record("ttft", attempt.first_token_at - attempt.started_at)
+                                        metrics.ttft.observe(attempt.first_token_at - attempt.started_at, attempt.name)
+                                    attempt.token_count += 1
+
+                                    started = time.perf_counter()
+                                    processor.feed(content)
+                                    attempt.clean_seconds += time.perf_counter() - started
+                                    await queue.put(('content', attempt, content))
+
+                                    # 输出已不可能成为有效 XML 或超出大小限制：断开上游连接，节省 token 和时间
+                                    if processor.over_limit or (STREAM_EARLY_ABORT and processor.abort_reason):
+                                        break
+                        except json.JSONDecodeError:
+                            continue
+
+        memory = processor.memory_bytes()
+        health.record("memory_kb", memory / 1024)
+        metrics.memory_bytes.observe(memory, attempt.name)
+        if processor.abort_reason:
+            logger.warning(f"[提前终止] {attempt.name} 已收到 {processor.received} 字符: {processor.abort_reason}")
+            health.record_failure(processor.abort_reason, trip=False)
+            metrics.attempts.inc(attempt.name, "invalid")
+            metrics.validation_failures.inc(attempt.name)
+            await queue.put(('invalid', attempt, processor.abort_reason))
+            return
+
+        # 流式输出完成，结束增量清理并得到验证结果
+        started = time.perf_counter()
+        cleaned_xml, is_valid, error_msg = await processor.finish_async()
+        metrics.clean.observe(attempt.clean_seconds + time.perf_counter() - started - processor.validate_seconds, attempt.name)
+        metrics.validate.observe(processor.validate_seconds, attempt.name)
+        if processor.fallback_reason:
+            # 补丁与当前图表不匹配不说明该配置有问题：不计入健康统计，由调用方回退为完整生成
+            logger.info(f"[增量编辑] {attempt.name}: {processor.fallback_reason}")
+            metrics.attempts.inc(attempt.name, "fallback")
+            await queue.put(('invalid', attempt, processor.fallback_reason))
+        elif not cleaned_xml.strip() or not is_valid:
+            error_msg = error_msg if cleaned_xml.strip() else "XML内容为空"
+            logger.warning(f"[验证失败] {attempt.name} XML验证失败: {error_msg}")
+            health.record_failure(error_msg, trip=False)
+            metrics.attempts.inc(attempt.name, "invalid")
+            metrics.validation_failures.inc(attempt.name)
+            await queue.put(('invalid', attempt, error_msg))
+        else:
+            now = time.monotonic()
+            health.record("duration", now - attempt.started_at)
+            metrics.generation.observe(now - attempt.started_at, attempt.name)
+            if attempt.first_token_at is not None and now > attempt.first_token_at:
+                tokens_per_sec = attempt.token_count / (now - attempt.first_token_at)
+                health.record("tokens_per_sec", tokens_per_sec)
+                metrics.tokens_per_sec.observe(tokens_per_sec, attempt.name)
+            health.record_success()
+            metrics.attempts.inc(attempt.name, "success")
+            xml = await xml_pool.run(normalize_styles, cleaned_xml)
+            metrics.output_bytes.observe(len(xml.encode('utf-8')), attempt.name)
+            await queue.put(('complete', attempt, xml))
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        health.record_failure(str(e))
+        metrics.attempts.inc(attempt.name, "error")
+        await queue.put(('error', attempt, str(e)))
+
+async def race_stream_attempts(candidates: List[dict], messages: List[dict],
+                               new_processor: Optional[Callable[[], DrawioXMLProcessor]] = None):
+    """
+    按优先级依次（或对冲并行）请求候选 API，产出与 SSE 协议一致的事件
+    - new_processor 为每个请求创建输出处理器，默认按完整 XML 处理（补丁模式、DSL 模式各有处理器）
+    - 处理器能提前渲染部分图表时，随内容发送 partial 事件
+    - 第一个产出内容的请求成为 leader，其内容实时转发
+    - leader 失败时发送 failover，若有其它进行中的请求则接替输出
+    - 非 leader 的请求先完成时发送 switch，补发其缓冲内容后完成
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+    running: List[StreamAttempt] = []
+    leader: Optional[StreamAttempt] = None
+    next_index = 0
+    hedge_at: Optional[float] = None  # 启动下一个对冲请求的时间
+    hedges = 0
+    last_error = None
+    last_validation_error = None  # 最后一次失败是否为 XML 验证失败
+
+    def launch() -> StreamAttempt:
+        nonlocal next_index, hedge_at
+        if new_processor is None:
+            processor = DrawioXMLProcessor(max_chars=MAX_RESPONSE_CHARS)
+        else:
+            processor = new_processor()
+        attempt = StreamAttempt(candidates[next_index], processor)
+        next_index += 1
+        attempt.task = asyncio.create_task(run_stream_attempt(attempt, messages, queue))
+        running.append(attempt)
+
+        can_hedge = HEDGE_ENABLED and next_index < len(candidates) and len(running) < HEDGE_MAX_PARALLEL
+        hedge_at = loop.time() + hedge_delay(attempt.api_config) if can_hedge else None
+        return attempt
+
+    try:
+        while running or next_index < len(candidates):
+            if not running:
+                attempt = launch()
+                yield {'type': 'start', 'api': attempt.name}
+
+            timeout = None if hedge_at is None else max(0.0, hedge_at - loop.time())
+            try:
+                kind, attempt, data = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                # 主请求超过对冲延迟仍无首个 token，并行启动下一个 API
+                hedged = launch()
+                hedges += 1
+                logger.info(f"[对冲] {running[0].name} 首 token 超时，并行请求 {hedged.name}")
+                yield {'type': 'hedge', 'api': hedged.name}
+                continue
+
+            if kind == 'content':
+                if leader is None:
+                    leader = attempt
+                    hedge_at = None  # 已有首个 token，不再启动新的对冲请求
+                if attempt is leader:
+                    yield {'type': 'content', 'content': data}
+                    partial = attempt.processor.partial_xml()
+                    if partial is not None:
+                        yield {'type': 'partial', 'xml': partial}
+                else:
+                    attempt.buffer.append(data)
+                continue
+
+            running.remove(attempt)
+
+            if kind == 'complete':
+                if attempt is not leader:
+                    if leader is not None:
+                        logger.info(f"[对冲] {attempt.name} 先于 {leader.name} 完成")
+                        yield {'type': 'switch', 'api': attempt.name}
+                    if attempt.buffer:
+                        yield {'type': 'content', 'content': ''.join(attempt.buffer)}
+                yield {
+                    'type': 'complete',
+                    'xml': data,
+                    'api_used': attempt.name,
+                    'hedged': hedges > 0
+                }
+                return
+
+            # 请求失败
+            if running or next_index < len(candidates):
+                metrics.failovers.inc(attempt.name)
+            if kind == 'invalid':
+                last_error = f"{attempt.name} XML验证失败: {data}"
+                last_validation_error = data
+                event = {'type': 'failover', 'api': attempt.name, 'message': f'XML验证失败: {data}', 'error': data}
+            else:
+                last_error = f"{attempt.name} 错误: {data}"
+                last_validation_error = None
+                event = {'type': 'error', 'message': last_error}
+
+            if attempt is leader or leader is None:
+                # 前端会丢弃已输出的内容
+                yield event
+                if attempt is leader:
+                    leader = None
+                    # 由已有内容的并行请求接替输出
+                    for other in running:
+                        if other.buffer:
+                            leader = other
+                            yield {'type': 'content', 'content': ''.join(other.buffer)}
+                            other.buffer.clear()
+                            break
+            else:
+                logger.warning(f"[对冲] 并行请求 {attempt.name} 失败: {data}")
+
+        # 所有API都失败
+        if last_validation_error is not None:
+            yield {'type': 'validation_failed', 'message': f'XML验证失败: {last_validation_error}', 'error': last_validation_error}
+        else:
+            yield {'type': 'failed', 'message': f'所有API都失败了: {last_error}'}
+
+    finally:
+        # 取消仍在进行的请求（断开上游连接）
+        for attempt in running:
+            attempt.task.cancel()
+
+async def request_diagram(api_config: dict, messages: List[dict], raw: bool = False) -> str:
+    """
+    非流式请求单个 API 生成流程图，返回清理后的 XML
+    raw=True 时返回模型的原始输出（DSL、补丁由各自的处理器解析），不做 XML 清理和样式规范化
+    失败时抛出 UpstreamAttemptError
+    """
+    try:
+        logger.info(f"[尝试] 使用 {api_config['name']} 生成流程图",
+                    extra={"url": f"{api_config['base_url']}/chat/completions", "model": api_config['model'],
+                           "history_messages": len(messages) - 2})
+        logger.debug("[调试] 用户提示: %s", messages[-1]['content'])
+
+        # 构建请求体
+        payload = {
+            "model": api_config['model'],
+            "messages": messages,
+            "temperature": 0.7
+            # 不设置 max_tokens 限制，让模型自由生成
+        }
+
+        logger.debug("[调试] 请求体（前200字符）: %.200s...", payload)
+
+        # 构建请求头
+        headers = {
+            "Authorization": f"Bearer {api_config['api_key']}",
+            "Content-Type": "application/json"
+        }
+
+        # 记录请求头（隐藏完整的 API Key）
+        logger.debug("[调试] 请求头: Content-Type: %s, Authorization: Bearer %.15s...（已隐藏）",
+                     headers['Content-Type'], api_config['api_key'])
+
+        # 请求期间占用该配置的并发槽位（故障转移、对冲的每个请求分别计数）
+        async with admission.config_slot(api_config['id']), client_pool.acquire(api_config['base_url']) as client:
+            response = await client.post(
+                f"{api_config['base_url']}/chat/completions",
+                headers=headers,
+                json=payload,
+                timeout=client_pool.timeout_for(api_config, 60.0)
+            )
+
+        logger.debug(f"[调试] 响应状态码: {response.status_code}")
+
+        # 检查响应状态
+        if response.status_code != 200:
+            error_msg = f"{api_config['name']} API 返回错误: {response.status_code}"
+            error_detail = response.text[:300]
+            logger.warning(f"[失败] {error_msg}", extra={"detail": error_detail})
+            raise UpstreamAttemptError(f"{error_msg} - {error_detail}")
+
+        # 解析响应
+        result = response.json()
+
+        # 检查响应格式
+        if 'choices' not in result or len(result['choices']) == 0:
+            error_msg = f"{api_config['name']} 返回格式错误: {result}"
+            logger.warning(f"[失败] {error_msg}")
+            raise UpstreamAttemptError(error_msg)
+
+        xml = result['choices'][0]['message']['content']
+
+        logger.debug(f"[调试] AI 返回的原始 XML 长度: {len(xml)} 字符")
+        if MAX_RESPONSE_CHARS and len(xml) > MAX_RESPONSE_CHARS:
+            raise UpstreamAttemptError(f"{api_config['name']} 输出超过大小限制（{MAX_RESPONSE_CHARS} 字符）", trip=False)
+
+        # 使用 XML 清理和验证函数
+        if not raw:
+            started = time.perf_counter()
+            xml = await xml_pool.run(clean_xml, xml)
+            metrics.clean.observe(time.perf_counter() - started, api_config['name'])
+            xml = await xml_pool.run(normalize_styles, xml)
+
+        # 最后验证
+        if not xml.strip():
+            error_msg = f"{api_config['name']} 返回空内容"
+            logger.warning(f"[失败] {error_msg}")
+            raise UpstreamAttemptError(error_msg, trip=False)
+
+        return xml
+
+    except UpstreamAttemptError:
+        raise
+
+    except httpx.TimeoutException as e:
+        error_msg = f"{api_config['name']} 请求超时"
+        logger.warning(f"[超时] {error_msg}: {e}")
+        raise UpstreamAttemptError(f"{error_msg}: {str(e)}")
+
+    except httpx.ConnectError as e:
+        error_msg = f"{api_config['name']} 连接失败"
+        logger.warning(f"[连接错误] {error_msg}（可能原因: 网络不可达或DNS解析失败）: {e}")
+        raise UpstreamAttemptError(f"{error_msg}: {str(e)}")
+
+    except httpx.HTTPError as e:
+        error_msg = f"{api_config['name']} HTTP错误"
+        logger.warning(f"[HTTP错误] {error_msg}: {e}")
+        raise UpstreamAttemptError(f"{error_msg}: {str(e)}")
+
+    except Exception as e:
+        error_msg = f"{api_config['name']} 未知错误: {type(e).__name__}"
+        logger.exception(f"[错误] {error_msg}: {e}")
+        raise UpstreamAttemptError(f"{error_msg}: {str(e)}")
+
+async def race_diagram_requests(candidates: List[dict], messages: List[dict],
+                                raw: bool = False) -> Tuple[Optional[str], Optional[dict], Optional[str]]:
+    """
+    非流式版本的故障转移/对冲：主请求超过 p95 耗时仍未返回时并行请求下一个 API
+    raw 见 request_diagram（DSL、补丁模式返回原始输出）
+    返回: (XML, 胜出的配置, 最后一个错误)
+    """
+    loop = asyncio.get_running_loop()
+    pending: Dict[asyncio.Task, Tuple[dict, float]] = {}  # 任务 -> (配置, 开始时间)
+    next_index = 0
+    hedge_at: Optional[float] = None
+    last_error = None
+
+    def launch() -> dict:
+        nonlocal next_index, hedge_at
+        api_config = candidates[next_index]
+        next_index += 1
+        task = asyncio.create_task(request_diagram(api_config, messages, raw))
+        pending[task] = (api_config, time.monotonic())
+
+        can_hedge = HEDGE_ENABLED and next_index < len(candidates) and len(pending) < HEDGE_MAX_PARALLEL
+        hedge_at = loop.time() + hedge_delay(api_config, "duration") if can_hedge else None
+        return api_config
+
+    try:
+        while pending or next_index < len(candidates):
+            if not pending:
+                launch()
+
+            timeout = None if hedge_at is None else max(0.0, hedge_at - loop.time())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                api_config = launch()
+                logger.info(f"[对冲] 主请求超时未返回，并行请求 {api_config['name']}")
+                continue
+
+            for task in done:
+                api_config, started_at = pending.pop(task)
+                health = config_manager.get_health(api_config['id'])
+                try:
+                    xml = task.result()
+                except UpstreamAttemptError as e:
+                    health.record_failure(str(e), trip=e.trip)
+                    metrics.attempts.inc(api_config['name'], "error")
+                    if pending or next_index < len(candidates):
+                        metrics.failovers.inc(api_config['name'])
+                    last_error = str(e)
+                    continue
+
+                health.record("duration", time.monotonic() - started_at)
+                health.record_success()
+                metrics.generation.observe(time.monotonic() - started_at, api_config['name'])
+                metrics.attempts.inc(api_config['name'], "success")
+                metrics.output_bytes.observe(len(xml.encode('utf-8')), api_config['name'])
+                return xml, api_config, last_error
+
+        return None, None, last_error
+
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# ========== 分块生成（大纲 + 并行子图）==========
+# 大型流程图先生成子系统大纲，再把各子系统分配到不同 API 并行生成，最后合并并重新分配 id
+CHUNKED_MAX_PARTS = int(os.getenv("CHUNKED_MAX_PARTS", "6"))
+CHUNKED_LAYOUT = os.getenv("CHUNKED_LAYOUT", "single").lower()  # single: 合并到一个画布；pages: 每个子系统一页
+CHUNK_GAP = 80            # 子系统容器之间的水平间距
+CHUNK_PADDING = 20        # 容器内边距
+CHUNK_HEADER = 30         # 容器标题栏高度
+
+OUTLINE_SYSTEM_PROMPT = f"""你是系统架构分析助手。把用户描述的大型流程图拆分为 2~{CHUNKED_MAX_PARTS} 个相对独立的子系统，
+每个子系统之后会单独生成一张子图。
+
+只返回如下格式的 XML，不要解释：
+<outline>
+  <part name="子系统名称">该子系统包含的步骤/组件，以及与其它子系统的交互</part>
+</outline>"""
+
+class ChunkedGenerationError(Exception):
+    """分块生成失败（大纲无法解析或某个子系统所有 API 都失败）"""
+
+def parse_outline(xml: str) -> List[Tuple[str, str]]:
+    try:
+        root = ET.fromstring(xml)
+    except ET.ParseError as e:
+        raise ChunkedGenerationError(f"大纲 XML 无法解析: {e}")
+    parts = []
+    for part in root.iter('part'):
+        name = (part.get('name') or '').strip()
+        if name:
+            parts.append((name, (part.text or '').strip()))
+    if not parts:
+        raise ChunkedGenerationError("大纲中没有子系统")
+    return parts[:CHUNKED_MAX_PARTS]
+
+def build_part_messages(request: DiagramGenerateRequest, parts: List[Tuple[str, str]], index: int) -> List[dict]:
+    outline = "\n".join(f"{i + 1}. {name}：{desc}" for i, (name, desc) in enumerate(parts))
+    name, desc = parts[index]
+    prompt = (f"整体需求：{request.prompt}\n\n整体拆分：\n{outline}\n\n"
+              f"现在只生成其中的子系统「{name}」：{desc}\n不要画其它子系统的内容。")
+    return [{"role": "system", "content": system_prompt_for(request)}, {"role": "user", "content": prompt}]
+
+async def generate_part(candidates: List[dict], messages: List[dict]) -> Tuple[str, dict]:
+    """生成一个子系统；结果无效时换下一个 API"""
+    remaining = candidates
+    last_error = None
+    while remaining:
+        xml, api_config, error = await race_diagram_requests(remaining, messages)
+        if xml is None:
+            last_error = error
+            break
+        is_valid, error = await validate_generated_xml(xml, api_config['name'])
+        if is_valid:
+            return xml, api_config
+        last_error = f"{api_config['name']} XML验证失败: {error}"
+        remaining = remaining[remaining.index(api_config) + 1:]
+    raise ChunkedGenerationError(last_error or "没有可用的 API")
+
+def _shift_points(geometry: ET.Element, dx: float, dy: float):
+    for point in geometry.iter('mxPoint'):
+        for attr, delta in (('x', dx), ('y', dy)):
+            if point.get(attr) is not None:
+                point.set(attr, f"{float(point.get(attr)) + delta:g}")
+
+def merge_diagram_parts(parts: List[Tuple[str, str]], layout: str) -> str:
+    """
+    合并各子系统的图表
+    - pages: 每个子系统一个 <diagram> 页面，页面内 id 互不影响
+    - single: 每个子系统放入一个容器，id 加上子系统前缀，坐标平移到容器内
+    """
+    if layout == "pages":
+        pages = []
+        for i, (name, xml) in enumerate(parts):
+            model = ET.fromstring(xml).find('.//mxGraphModel')
+            page = ET.Element('diagram', {'name': name, 'id': f'part{i + 1}'})
+            page.append(model)
+            pages.append(ET.tostring(page, encoding='unicode'))
+        return f'<mxfile host="app.diagrams.net">{"".join(pages)}</mxfile>'
+
+    cells = ['<mxCell id="0"/>', '<mxCell id="1" parent="0"/>']
+    offset_x = 0.0
+    for i, (name, xml) in enumerate(parts):
+        prefix = f"p{i + 1}-"
+        root = ET.fromstring(xml).find('.//root')
+        # (包装元素, 内部 mxCell, id)：<object>/<UserObject> 的 id 在包装元素上
+        entries = [(w, _inner_cell(w), w.get('id') or _inner_cell(w).get('id')) for w in root]
+        part_cells = [cell for _, cell, _ in entries]
+        # 各子图的根节点和默认图层映射到合并后的 0/1
+        base_ids = {cid for _, c, cid in entries if cid is not None and c.get('parent') is None}
+        layer_ids = {cid for _, c, cid in entries
+                     if cid is not None and c.get('parent') in base_ids and not c.get('vertex') and not c.get('edge')}
+        used_ids = {cid for _, _, cid in entries if cid is not None}
+        container_id = f"{prefix}container"
+
+        def remap(ref: Optional[str]) -> Optional[str]:
+            if ref is None:
+                return None
+            if ref in base_ids:
+                return "0"
+            if ref in layer_ids:
+                return container_id
+            return prefix + ref
+
+        # 顶层节点的包围盒，用于把子图平移到容器内
+        xs, ys, x2s, y2s = [], [], [], []
+        for cell in part_cells:
+            geometry = cell.find('mxGeometry')
+            if cell.get('vertex') == '1' and cell.get('parent') in layer_ids and geometry is not None:
+                x, y = float(geometry.get('x', 0)), float(geometry.get('y', 0))
+                xs.append(x)
+                ys.append(y)
+                x2s.append(x + float(geometry.get('width', 0)))
+                y2s.append(y + float(geometry.get('height', 0)))
+        min_x, min_y = (min(xs), min(ys)) if xs else (0.0, 0.0)
+        width = (max(x2s) - min_x if xs else 0.0) + 2 * CHUNK_PADDING
+        height = (max(y2s) - min_y if ys else 0.0) + 2 * CHUNK_PADDING + CHUNK_HEADER
+        dx, dy = CHUNK_PADDING - min_x, CHUNK_HEADER + CHUNK_PADDING - min_y
+
+        container = ET.Element('mxCell', {
+            'id': container_id, 'value': name, 'vertex': '1', 'parent': '1',
+            'style': 'swimlane;whiteSpace=wrap;html=1;startSize=30;'
+        })
+        ET.SubElement(container, 'mxGeometry', {
+            'x': f"{offset_x:g}", 'y': '0', 'width': f"{width:g}", 'height': f"{height:g}", 'as': 'geometry'
+        })
+        cells.append(ET.tostring(container, encoding='unicode'))
+        offset_x += width + CHUNK_GAP
+
+        unnamed = 0
+        for wrapper, cell, cell_id in entries:
+            if cell_id is None:
+                if cell.get('parent') is None:
+                    continue  # 既没有 id 也没有 parent，无法放入合并后的图表
+                # 没有 id 的元素不会被其它元素引用，分配一个新的 id
+                unnamed += 1
+                while f"auto{unnamed}" in used_ids:
+                    unnamed += 1
+                cell_id = f"auto{unnamed}"
+            elif cell_id in base_ids or cell_id in layer_ids:
+                continue
+            wrapper.set('id', prefix + cell_id)
+            if cell is not wrapper and cell.get('id') is not None:
+                cell.set('id', prefix + cell.get('id'))
+            for attr in ('parent', 'source', 'target'):
+                if cell.get(attr) is not None:
+                    cell.set(attr, remap(cell.get(attr)))
+            # 直接位于图层上的元素平移到容器坐标系
+            if cell.get('parent') == container_id:
+                geometry = cell.find('mxGeometry')
+                if geometry is not None:
+                    if cell.get('vertex') == '1':
+                        geometry.set('x', f"{float(geometry.get('x', 0)) + dx:g}")
+                        geometry.set('y', f"{float(geometry.get('y', 0)) + dy:g}")
+                    _shift_points(geometry, dx, dy)
+            wrapper.tail = None
+            cells.append(ET.tostring(wrapper, encoding='unicode'))
+
+    return ('<mxfile host="app.diagrams.net"><diagram name="Page-1" id="diagram1"><mxGraphModel><root>'
+            + "".join(cells) + '</root></mxGraphModel></diagram></mxfile>')
+
+async def chunked_generation_events(request: DiagramGenerateRequest, candidates: List[dict]):
+    """
+    分块生成，产出 SSE 事件：outline → part_complete ... → complete / failed
+    各子系统轮流分配给不同的 API 并行请求，耗时接近最慢的一个子系统
+    """
+    if not candidates:
+        yield {'type': 'failed', 'message': '没有可用的 API'}
+        return
+
+    outline_messages = [{"role": "system", "content": OUTLINE_SYSTEM_PROMPT}, {"role": "user", "content": request.prompt}]
+    outline_xml, outline_api, last_error = await race_diagram_requests(candidates, outline_messages)
+    try:
+        if outline_xml is None:
+            raise ChunkedGenerationError(f"大纲生成失败: {last_error}")
+        parts = parse_outline(outline_xml)
+    except ChunkedGenerationError as e:
+        yield {'type': 'failed', 'message': str(e)}
+        return
+
+    logger.info(f"[分块生成] {outline_api['name']} 拆分出 {len(parts)} 个子系统: {', '.join(name for name, _ in parts)}")
+    yield {'type': 'outline', 'api': outline_api['name'], 'parts': [name for name, _ in parts]}
+    yield {'type': 'content', 'content': "".join(f"{i + 1}. {name}\n" for i, (name, _) in enumerate(parts))}
+
+    async def run_part(index: int) -> Tuple[int, str, dict]:
+        # 第 i 个子系统优先使用第 i 个 API，失败时依次换下一个
+        shift = index % len(candidates)
+        xml, api_config = await generate_part(candidates[shift:] + candidates[:shift], build_part_messages(request, parts, index))
+        return index, xml, api_config
+
+    tasks = [asyncio.create_task(run_part(i)) for i in range(len(parts))]
+    results: Dict[int, str] = {}
+    apis_used = []
+    try:
+        for future in asyncio.as_completed(tasks):
+            try:
+                index, xml, api_config = await future
+            except ChunkedGenerationError as e:
+                yield {'type': 'failed', 'message': f'子系统生成失败: {e}'}
+                return
+            results[index] = await xml_pool.run(layout_generated_xml, xml) if use_auto_layout(request) else xml
+            if api_config['name'] not in apis_used:
+                apis_used.append(api_config['name'])
+            yield {'type': 'part_complete', 'part': parts[index][0], 'api': api_config['name']}
+            yield {'type': 'content', 'content': f"✓ {parts[index][0]}\n"}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    try:
+        xml = await xml_pool.run(merge_diagram_parts, [(parts[i][0], results[i]) for i in range(len(parts))], CHUNKED_LAYOUT)
+    except Exception as e:
+        # 子图已通过验证，合并仍可能因坐标等属性取值异常而失败
+        logger.exception(f"[分块生成] 合并子图失败: {e}")
+        yield {'type': 'failed', 'message': f'合并子图失败: {e}'}
+        return
+    is_valid, error = await xml_pool.run(validate_xml_strict, xml)
+    if not is_valid:
+        yield {'type': 'validation_failed', 'message': f'合并后的 XML 验证失败: {error}', 'error': error}
+        return
+    yield {'type': 'complete', 'xml': xml, 'api_used': ', '.join(apis_used), 'chunked': True}
+
+# ========== 生成结果缓存 ==========
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # 秒
+RESPONSE_CACHE_REPLAY_CHUNK = 4096  # 命中时回放的每帧字符数
+
+def generation_cache_key(targets: List[dict], messages: List[dict]) -> str:
+    """
+    缓存键：目标 API（endpoint + 模型）+ 系统提示词 + 对话历史 + 提示词的 SHA-256
+    endpoint 也参与计算，配置改为指向其它服务后不会再命中修改前的结果
+    """
+    endpoints = [[c['base_url'], c['model']] for c in targets]
+    raw = json.dumps({"targets": endpoints, "messages": messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    按内容寻址的生成结果缓存（LRU + 总字节数上限 + TTL）
+    相同 endpoint 和模型、相同提示词和历史的请求直接返回上次验证通过的 XML
+    """
+
+    def __init__(self, max_bytes: int, ttl: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, candidates: List[dict], messages: List[dict]) -> Optional[dict]:
+        """按路由顺序查找任一候选模型的缓存结果"""
+        now = time.monotonic()
+        for api_config in candidates:
+            key = generation_cache_key([api_config], messages)
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if entry['expires_at'] <= now:
+                self._remove(key)
+                continue
 
-# ========== AI 模型配置（多 API 故障转移）==========
-# 注意: 配置已迁移到 AIConfigManager，AI_APIS 保留用于向后兼容
-# 实际使用的配置通过 config_manager.get_configs_as_dict_list() 获取
-def get_ai_apis():
-    """获取 AI API 配置列表（动态从配置管理器获取）"""
-    return config_manager.get_configs_as_dict_list()
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
 
-# Draw.io XML 生成的系统提示词（简化版）
-SYSTEM_PROMPT = """你是 draw.io 流程图生成助手。根据用户描述生成 XML 格式的流程图。
+        self.misses += 1
+        return None
 
-重要规则：
-1. 每个属性只能出现一次（如 x, y, width, height）
-2. 不要重复定义相同的属性
-3. id 必须唯一
-4. 只返回 XML，不要解释
+    def store(self, api_config: dict, messages: List[dict], xml: str, api_used: str):
+        key = generation_cache_key([api_config], messages)
+        size = len(xml.encode('utf-8'))
+        if size > self.max_bytes:
+            return
 
-XML 格式：
-<mxfile host="app.diagrams.net">
-  <diagram name="Page-1" id="d1">
-    <mxGraphModel>
-      <root>
-        <mxCell id="0"/>
-        <mxCell id="1" parent="0"/>
-        <!-- 矩形 -->
-        <mxCell id="2" value="文本" style="rounded=1;whiteSpace=wrap;html=1;" vertex="1" parent="1">
-          <mxGeometry x="100" y="100" width="120" height="60" as="geometry"/>
-        </mxCell>
-        <!-- 菱形 -->
-        <mxCell id="3" value="判断?" style="rhombus;whiteSpace=wrap;html=1;" vertex="1" parent="1">
-          <mxGeometry x="80" y="200" width="160" height="80" as="geometry"/>
-        </mxCell>
-        <!-- 连线 -->
-        <mxCell id="4" style="edgeStyle=orthogonalEdgeStyle;rounded=0;html=1;" edge="1" parent="1" source="2" target="3">
-          <mxGeometry relative="1" as="geometry"/>
-        </mxCell>
-      </root>
-    </mxGraphModel>
-  </diagram>
-</mxfile>
+        self._remove(key)
+        self._entries[key] = {
+            "xml": xml,
+            "api_used": api_used,
+            "size": size,
+            "expires_at": time.monotonic() + self.ttl
+        }
+        self.bytes += size
 
-只返回 XML，不要解释。"""
+        # 超出容量时淘汰最久未使用的条目
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
 
-# ========== XML 验证和修复工具 ==========
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry['size']
 
-def validate_xml_strict(xml_string: str) -> Tuple[bool, str]:
-    """
-    严格验证 XML 是否为有效的 draw.io 格式
-    返回: (是否有效, 错误信息)
-    """
-    try:
-        # 1. 基本检查：不能为空
-        if not xml_string or len(xml_string.strip()) == 0:
-            return False, "XML 内容为空"
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
 
-        # 2. 清理 markdown 标记
-        cleaned = xml_string.replace('```xml', '').replace('```', '').strip()
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "evictions": self.evictions
+        }
 
-        # 3. 必须包含 mxfile 或 mxGraphModel
-        if '<mxfile' not in cleaned and '<mxGraphModel' not in cleaned:
-            return False, "缺少 mxfile 或 mxGraphModel 标签"
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
 
-        # 4. 使用 ElementTree 验证 XML 语法
-        try:
-            root = ET.fromstring(cleaned)
-        except ET.ParseError as e:
-            return False, f"XML 语法错误: {str(e)}"
+def cache_enabled_for(request: DiagramGenerateRequest) -> bool:
+    return RESPONSE_CACHE_ENABLED and not request.no_cache
 
-        # 5. 检查必要的结构
-        # 如果是 mxfile 格式，必须包含 diagram
-        if root.tag == 'mxfile':
-            diagrams = root.findall('.//diagram')
-            if not diagrams:
-                return False, "mxfile 中缺少 diagram 元素"
+def replay_cached(entry: dict) -> List[dict]:
+    """把缓存结果转换为与实时生成一致的 SSE 事件：start → content... → complete"""
+    xml = entry['xml']
+    events = [{'type': 'start', 'api': entry['api_used'], 'cached': True}]
+    for i in range(0, len(xml), RESPONSE_CACHE_REPLAY_CHUNK):
+        events.append({'type': 'content', 'content': xml[i:i + RESPONSE_CACHE_REPLAY_CHUNK]})
+    events.append({'type': 'complete', 'xml': xml, 'api_used': entry['api_used'], 'cached': True})
+    return events
 
-            # 检查是否有 mxGraphModel
-            has_model = False
-            for diagram in diagrams:
-                if diagram.find('.//mxGraphModel') is not None:
-                    has_model = True
-                    break
-            if not has_model:
-                return False, "diagram 中缺少 mxGraphModel"
+# ========== 相同请求合并（single-flight） ==========
+STREAM_SINGLE_FLIGHT = os.getenv("STREAM_SINGLE_FLIGHT", "true").lower() == "true"
+SINGLE_FLIGHT_QUEUE_SIZE = int(os.getenv("SINGLE_FLIGHT_QUEUE_SIZE", "64"))  # 每个订阅者最多积压的 content 帧数
 
-        # 6. 检查是否有实际的图形元素 (mxCell)
-        cells = root.findall('.//mxCell')
-        if len(cells) < 2:  # 至少应该有 id=0 和 id=1 两个基础单元格
-            return False, "缺少图形元素 (mxCell)"
+# 这些事件之后前端会丢弃已输出的内容
+CONTENT_RESET_EVENTS = ('failover', 'error', 'switch')
+TERMINAL_EVENTS = ('complete', 'failed', 'validation_failed')
 
-        print("[XML验证] XML 验证通过")
-        return True, ""
+class FlightSubscriber:
+    """单个订阅者的有界事件队列"""
 
-    except Exception as e:
-        return False, f"验证异常: {str(e)}"
+    def __init__(self):
+        self.events: deque = deque()
+        self.ready = asyncio.Event()
+        self.delivered = 0     # 当前这段输出中已发送的字符数
+        self.lagging = False   # 积压过多后不再逐帧转发，追上后一次性补发
+
+    def push(self, event: dict):
+        if event['type'] == 'content' and (self.lagging or len(self.events) >= SINGLE_FLIGHT_QUEUE_SIZE):
+            self.lagging = True
+            return
+        if event['type'] == 'partial':
+            # partial 每次都带完整的图表，只保留最新的一个
+            for queued in self.events:
+                if queued['type'] == 'partial':
+                    self.events.remove(queued)
+                    break
+        self.events.append(event)
+        self.ready.set()
 
-def clean_xml(xml_string: str) -> str:
+class GenerationFlight:
     """
-    清理和修复 AI 生成的 XML
+    一次进行中的流式生成，由所有相同请求共享
+    生成任务只向各订阅者的队列推送事件，不等待任何订阅者；
+    消费过慢的订阅者丢弃中间帧，追上后从 content 中补发缺失部分
     """
-    try:
-        print("[XML清理] 开始清理和验证 XML...")
 
-        # 1. 清理可能的 markdown 标记
-        xml_string = xml_string.replace('```xml', '').replace('```', '').strip()
+    def __init__(self, key: str):
+        self.key = key
+        self.subscribers: List[FlightSubscriber] = []
+        self.content: List[str] = []  # 当前这段输出的全部内容
+        self.content_len = 0
+        self.api: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
 
-        # 2. 移除重复的属性（最常见的错误）
-        # 匹配重复的属性，如 x="100" x="200"
-        def remove_duplicate_attrs(match):
-            tag_content = match.group(1)
+    def start(self, candidates: List[dict], messages: List[dict],
+              new_processor: Optional[Callable[[], DrawioXMLProcessor]]):
+        self.task = asyncio.create_task(self._produce(candidates, messages, new_processor))
 
-            # 提取所有属性
-            attrs = {}
-            attr_pattern = r'(\w+)="([^"]*)"'
+    async def _produce(self, candidates: List[dict], messages: List[dict],
+                       new_processor: Optional[Callable[[], DrawioXMLProcessor]]):
+        try:
+            async for event in race_stream_attempts(candidates, messages, new_processor):
+                if event['type'] == 'complete' and RESPONSE_CACHE_ENABLED:
+                    winner = next(c for c in candidates if c['name'] == event['api_used'])
+                    response_cache.store(winner, messages, event['xml'], event['api_used'])
+                self._publish(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"[合并] 生成任务异常: {e}")
+            self._publish({'type': 'failed', 'message': f'生成失败: {e}'})
+        finally:
+            if flights.get(self.key) is self:
+                flights.pop(self.key)
+
+    def _publish(self, event: dict):
+        kind = event['type']
+        if kind == 'content':
+            self.content.append(event['content'])
+            self.content_len += len(event['content'])
+        elif kind in CONTENT_RESET_EVENTS:
+            self.content.clear()
+            self.content_len = 0
+        if kind in ('start', 'switch'):
+            self.api = event['api']
+
+        for subscriber in self.subscribers:
+            subscriber.push(event)
+
+    def _catch_up(self, subscriber: FlightSubscriber) -> Optional[dict]:
+        subscriber.lagging = False
+        if subscriber.delivered >= self.content_len:
+            return None
+        missing = ''.join(self.content)[subscriber.delivered:]
+        subscriber.delivered = self.content_len
+        return {'type': 'content', 'content': missing}
+
+    async def subscribe(self):
+        """订阅事件流；后加入的订阅者先收到已生成的内容"""
+        subscriber = FlightSubscriber()
+        if self.api is not None:
+            subscriber.push({'type': 'start', 'api': self.api})
+            subscriber.lagging = True
+        self.subscribers.append(subscriber)
 
-            for attr_match in re.finditer(attr_pattern, tag_content):
-                attr_name = attr_match.group(1)
-                attr_value = attr_match.group(2)
-                # 保留最后一个值（通常是最新的）
-                attrs[attr_name] = attr_value
+        try:
+            while True:
+                if subscriber.events:
+                    kind = subscriber.events[0]['type']
+                    if kind in TERMINAL_EVENTS and subscriber.lagging:
+                        # 结束前先补发积压时丢弃的内容
+                        event = self._catch_up(subscriber)
+                        if event is not None:
+                            yield event
+                    event = subscriber.events.popleft()
+                    if kind == 'content':
+                        subscriber.delivered += len(event['content'])
+                    elif kind in CONTENT_RESET_EVENTS:
+                        subscriber.delivered = 0
+                    yield dict(event)
+                    if kind in TERMINAL_EVENTS:
+                        return
+                elif subscriber.lagging:
+                    event = self._catch_up(subscriber)
+                    if event is not None:
+                        yield event
+                else:
+                    subscriber.ready.clear()
+                    await subscriber.ready.wait()
+        finally:
+            self.subscribers.remove(subscriber)
+            # 所有订阅者都已断开，取消生成
+            if not self.subscribers and not self.task.done():
+                logger.info("[合并] 所有客户端已断开，取消生成")
+                self.task.cancel()
+
+flights: Dict[str, GenerationFlight] = {}
+
+def join_generation(candidates: List[dict], messages: List[dict],
+                    new_processor: Optional[Callable[[], DrawioXMLProcessor]] = None):
+    """返回相同请求（候选 API + 消息）的事件流，有进行中的生成则直接加入；new_processor 见 race_stream_attempts"""
+    if not STREAM_SINGLE_FLIGHT:
+        flight = GenerationFlight("")
+        flight.start(candidates, messages, new_processor)
+        return flight.subscribe()
+
+    key = generation_cache_key(candidates, messages)
+    flight = flights.get(key)
+    if flight is None:
+        flight = GenerationFlight(key)
+        flights[key] = flight
+        flight.start(candidates, messages, new_processor)
+    else:
+        logger.info(f"[合并] 加入进行中的相同请求（当前 {len(flight.subscribers)} 个客户端）")
+    return flight.subscribe()
+
+# ========== 会话存储 ==========
+# 对话历史保存在服务端，客户端每轮只需发送 session_id + prompt
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "1000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(128 * 1024 * 1024)))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "86400"))  # 秒，最后一次使用后多久过期
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "50"))  # 每个会话保留的对话轮数，超出时丢弃最早的，0 表示不限制
+SESSION_KEY_PREFIX = "session:"
+
+def messages_size(messages: List[dict]) -> int:
+    return sum(len(m["content"]) for m in messages)
+
+class SessionStore:
+    """
+    会话 LRU（条数上限 + 总大小上限 + TTL），作为共享存储的本地缓存
+    会话历史以列表保存在共享存储中（每条消息一项，gzip 压缩），追加是原子的，多个 worker 并发写入不会互相覆盖；
+    其它 worker 修改或删除会话后通过变更通知使本地缓存失效，内存中被淘汰的会话仍可从共享存储恢复
+    """
 
-            # 重建标签
-            tag_start = tag_content.split()[0] if ' ' in tag_content else tag_content
-            reconstructed = tag_start
-            for key, value in attrs.items():
-                reconstructed += f' {key}="{value}"'
+    def __init__(self, max_count: int, max_bytes: int, ttl: int, max_turns: int, state: SharedState):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self._sessions: "OrderedDict[str, dict]" = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+
+        self.state = state
+        state.subscribe(self._on_shared_event)
+
+    async def _on_shared_event(self, event: dict):
+        if event.get("kind") == "session":
+            self._remove(event["id"])
+        elif event.get("kind") == "resync":
+            self._sessions.clear()
+            self.bytes = 0
+
+    async def create(self) -> str:
+        session_id = uuid.uuid4().hex
+        # 列表第一项是空的占位项，没有对话的新会话在其它 worker 中也能查到
+        await self.state.list_append(SESSION_KEY_PREFIX + session_id, [b""], self.ttl)
+        self._put(session_id, [])
+        return session_id
+
+    async def get_history(self, session_id: str) -> Optional[List[dict]]:
+        """获取会话历史并延长过期时间（读取也算使用）；会话不存在或已过期时返回 None"""
+        # 过期时间只记在共享存储中：其它 worker 的读取和追加也会延长它，本地缓存不单独判断过期
+        if not await self.state.expire(SESSION_KEY_PREFIX + session_id, self.ttl):
+            self._remove(session_id)
+            return None
 
-            return f'<{reconstructed}>'
+        session = self._sessions.get(session_id)
+        if session is None:
+            items = await self.state.list_get(SESSION_KEY_PREFIX + session_id)
+            if items is None:
+                return None
+            messages = [json.loads(gzip.decompress(item)) for item in items if item]
+            self._put(session_id, messages)
+            return messages
 
-        # 匹配开始标签
-        xml_string = re.sub(r'<([^/>]+)>', remove_duplicate_attrs, xml_string)
+        self._sessions.move_to_end(session_id)
+        return session["messages"]
 
-        # 3. 验证 XML 是否可解析
-        try:
-            ET.fromstring(xml_string)
-            print("[XML清理] XML 格式验证通过")
-        except ET.ParseError as e:
-            print(f"[XML清理] 警告: XML 解析错误: {str(e)}")
-            print(f"[XML清理] 尝试修复...")
+    async def append_turn(self, session_id: str, prompt: str, xml: str) -> bool:
+        """
+        记录一轮对话；在共享存储中原子追加，并发请求不会互相覆盖
+        只保留最近 max_turns 轮；会话不存在（或在生成期间过期）时不会新建，返回 False
+        """
+        turn = [{"role": "user", "content": prompt}, {"role": "assistant", "content": xml}]
+        appended = await self.state.list_append(
+            SESSION_KEY_PREFIX + session_id,
+            [gzip.compress(json.dumps(m, ensure_ascii=False).encode('utf-8'), compresslevel=6, mtime=0) for m in turn],
+            self.ttl,
+            max_len=self.max_turns * 2,
+            create=False
+        )
+        # 本地缓存可能缺少其它 worker 追加的对话，下次读取时从共享存储重新加载
+        self._remove(session_id)
+        if appended:
+            await self.state.publish({"kind": "session", "id": session_id})
+        return appended
+
+    async def delete(self, session_id: str) -> bool:
+        existed = self._remove(session_id)
+        existed = await self.state.delete(SESSION_KEY_PREFIX + session_id) or existed
+        await self.state.publish({"kind": "session", "id": session_id})
+        return existed
+
+    def _put(self, session_id: str, messages: List[dict]):
+        self._remove(session_id)
+        size = messages_size(messages)
+        self._sessions[session_id] = {"messages": messages, "size": size}
+        self.bytes += size
+
+        # 超出条数或大小上限时淘汰最久未使用的会话（保留刚写入的）
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_count or self.bytes > self.max_bytes):
+            self._remove(next(iter(self._sessions)))
+            self.evictions += 1
+
+    def _remove(self, session_id: str) -> bool:
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self.bytes -= session["size"]
+        return True
 
-            # 常见错误修复
-            # 修复未闭合的标签
-            xml_string = xml_string.replace('<br>', '<br/>')
-            xml_string = xml_string.replace('<hr>', '<hr/>')
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self.bytes,
+            "max_count": self.max_count,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "max_turns": self.max_turns,
+            "evictions": self.evictions,
+            "backend": STATE_BACKEND,
+            "persistent": STATE_BACKEND != "memory"
+        }
+
+session_store = SessionStore(SESSION_MAX_COUNT, SESSION_MAX_BYTES, SESSION_TTL, SESSION_MAX_TURNS, shared_state)
+
+async def load_session_history(request: DiagramGenerateRequest):
+    """使用会话时以服务端保存的历史代替请求中的 messages；会话不存在或已过期时返回 404"""
+    if request.session_id:
+        history = await session_store.get_history(request.session_id)
+        if history is None:
+            raise HTTPException(status_code=404, detail="会话不存在或已过期")
+        request.messages = [Message(**m) for m in history]
+
+async def complete_turn(request: DiagramGenerateRequest, xml: str) -> dict:
+    """生成成功后记录本轮对话，返回需要附加到响应中的字段"""
+    if request.session_id:
+        if await session_store.append_turn(request.session_id, request.prompt, xml):
+            return {"session_id": request.session_id}
+        # 会话在生成期间过期或被删除：不再记录，改为返回完整历史，由客户端新建会话
+        logger.warning(f"[会话] 会话 {request.session_id} 已不存在，本轮对话未记录")
+    return {"messages": build_new_history(request, xml)}
+
+async def cached_or_generate(request: DiagramGenerateRequest, candidates: List[dict], messages: List[dict],
+                             new_processor: Optional[Callable[[], DrawioXMLProcessor]] = None):
+    """命中缓存时直接回放，否则加入（或发起）生成"""
+    if cache_enabled_for(request):
+        entry = response_cache.lookup(candidates, messages)
+        if entry is not None:
+            logger.info(f"[缓存] 命中缓存 ({entry['api_used']})")
+            metrics.cache_hits.inc(entry['api_used'])
+            for event in replay_cached(entry):
+                yield event
+            return
+
+    async for event in join_generation(candidates, messages, new_processor):
+        yield event
+
+# ========== 准入控制（限流 + 并发排队）==========
+# 生成接口的请求先按客户端做令牌桶限流，再申请全局并发槽位
+# 没有空闲槽位时进入有界队列，不同客户端之间轮流放行（一个客户端的突发请求不会饿死其它客户端），
+# 流式接口用 queued 事件报告排队位置；超出限流或队列已满时返回 429 + Retry-After
+# 每个 AI 配置的并发上限在发起上游请求时单独计数：故障转移、对冲和分块生成的每个请求都占用所用配置的槽位，已满时等待
+# 多 worker 部署时各 worker 分别计数，总上限为单个 worker 的上限乘以 worker 数
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "30"))  # 每个客户端每分钟的生成请求数，0 表示不限流
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))  # 令牌桶容量（允许的突发请求数）
+# 识别客户端的请求头（如 X-API-Key，或部署在反向代理之后时用 X-Forwarded-For），为空或请求中没有时按来源 IP
+RATE_LIMIT_KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER", "")
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "32"))  # 全局并发上限，0 表示不限制
+MAX_CONCURRENT_PER_CONFIG = int(os.getenv("MAX_CONCURRENT_PER_CONFIG", "8"))    # 每个 AI 配置的并发上限，0 表示不限制
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100"))           # 排队请求数上限
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "120"))   # 最长排队时间（秒）
+RATE_LIMIT_MAX_CLIENTS = 10000  # 令牌桶数量超过时清理已回满的桶
+
+class AdmissionRejected(Exception):
+    """请求被限流或排队失败，对应 HTTP 429"""
+
+    def __init__(self, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+        self.reason = reason
+
+    def to_http(self) -> HTTPException:
+        return HTTPException(status_code=429, detail=str(self), headers={"Retry-After": str(self.retry_after)})
+
+class AdmissionTicket:
+    """一个生成请求的准入凭证：排队时在队列中，获得槽位后 granted 被设置，结束时必须 release"""
+
+    def __init__(self, client: str):
+        self.client = client
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.granted = asyncio.Event()
+        self.changed = asyncio.Event()  # 排队位置可能发生变化
+        self.released = False
+
+class AdmissionController:
+    def __init__(self, rate_per_minute: float, burst: int, max_concurrent: int, max_per_config: int,
+                 queue_size: int, queue_timeout: float):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_per_config = max_per_config
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # 客户端 → (令牌数, 上次更新时间)
+        # 客户端 → 排队中的请求；字典顺序即轮转顺序，放行一个请求后该客户端移到末尾
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self.waiting = 0
+        self.active = 0
+        self._config_slots: Dict[str, asyncio.Semaphore] = {}
+        self._active_per_config: Dict[str, int] = {}
+        self.avg_hold_seconds = 10.0  # 每个请求占用槽位的平均时间（指数移动平均），用于估算 Retry-After
+
+    # ---------- 限流 ----------
+
+    def check_rate(self, client: str):
+        """消耗客户端的一个令牌；令牌不足时抛出 AdmissionRejected"""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[client] = (tokens, now)
+            metrics.admission_rejected.inc("rate_limited")
+            raise AdmissionRejected("请求过于频繁，请稍后重试", (1 - tokens) / self.rate, "rate_limited")
+        self._buckets[client] = (tokens - 1, now)
+
+        if len(self._buckets) > RATE_LIMIT_MAX_CLIENTS:
+            full_after = self.burst / self.rate
+            self._buckets = {key: value for key, value in self._buckets.items() if now - value[1] < full_after}
+
+    # ---------- 并发槽位 ----------
+
+    def _can_admit(self) -> bool:
+        return not self.max_concurrent or self.active < self.max_concurrent
+
+    def _grant(self, ticket: AdmissionTicket):
+        self.active += 1
+        ticket.admitted_at = time.monotonic()
+        ticket.granted.set()
+        ticket.changed.set()
+        metrics.admission_wait.observe(ticket.admitted_at - ticket.enqueued_at)
+        metrics.admission_active.set(self.active)
+
+    def enqueue(self, client: str) -> AdmissionTicket:
+        """
+        申请槽位：有空闲槽位且没有人排队时立即获得，否则进入队列
+        队列已满时抛出 AdmissionRejected
+        """
+        ticket = AdmissionTicket(client)
+        if not self.waiting and self._can_admit():
+            self._grant(ticket)
+            return ticket
+        if self.waiting >= self.queue_size:
+            metrics.admission_rejected.inc("queue_full")
+            raise AdmissionRejected("服务繁忙，排队人数已满，请稍后重试", self.retry_after(), "queue_full")
+
+        self._queues.setdefault(client, deque()).append(ticket)
+        self.waiting += 1
+        metrics.admission_waiting.set(self.waiting)
+        self._dispatch()
+        return ticket
+
+    def retry_after(self) -> float:
+        """按平均占用时间估算排在队尾的请求多久后能获得槽位"""
+        slots = self.max_concurrent or max(self.active, 1)
+        return self.avg_hold_seconds * (self.waiting + 1) / slots
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        """按轮转顺序计算排队位置（从 1 开始）；同一客户端的请求先进先出"""
+        queue = self._queues.get(ticket.client)
+        if ticket.granted.is_set() or not queue:
+            return 0
+        index = queue.index(ticket)
+        position = index + 1
+        before = True
+        for client, other in self._queues.items():
+            if client == ticket.client:
+                before = False
+            else:
+                position += min(len(other), index + 1 if before else index)
+        return position
+
+    def _dispatch(self):
+        """轮流从各客户端的队首放行请求，直到没有空闲槽位或队列为空"""
+        while self.waiting and self._can_admit():
+            client, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            self.waiting -= 1
+            self._grant(ticket)
+            del self._queues[client]
+            if queue:
+                self._queues[client] = queue  # 移到轮转顺序末尾
+        metrics.admission_waiting.set(self.waiting)
+        for queue in self._queues.values():
+            for ticket in queue:
+                ticket.changed.set()
+
+    async def wait_turn(self, ticket: AdmissionTicket):
+        """
+        等待获得槽位，期间每当排队位置变化时 yield 新位置
+        超过 ADMISSION_QUEUE_TIMEOUT 时抛出 AdmissionRejected
+        """
+        deadline = ticket.enqueued_at + self.queue_timeout
+        last_position = None
+        while not ticket.granted.is_set():
+            position = self.position(ticket)
+            if position != last_position:
+                last_position = position
+                yield position
+            ticket.changed.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                metrics.admission_rejected.inc("timeout")
+                raise AdmissionRejected("排队超时，服务繁忙，请稍后重试", self.retry_after(), "timeout")
+            try:
+                await asyncio.wait_for(ticket.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
 
-            # 再次尝试解析
+    def release(self, ticket: AdmissionTicket):
+        """请求结束（或排队中的客户端断开）时归还槽位并放行下一个请求；可重复调用"""
+        if ticket.released:
+            return
+        ticket.released = True
+        if not ticket.granted.is_set():
+            queue = self._queues.get(ticket.client)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                self.waiting -= 1
+                if not queue:
+                    del self._queues[ticket.client]
+        else:
+            self.active -= 1
+            hold = time.monotonic() - ticket.admitted_at
+            self.avg_hold_seconds = self.avg_hold_seconds * 0.9 + hold * 0.1
+            metrics.admission_active.set(self.active)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def config_slot(self, config_id: str):
+        """在一次上游请求期间占用该 AI 配置的一个并发槽位；该配置已满时等待其它请求结束"""
+        if not self.max_per_config:
+            yield
+            return
+        semaphore = self._config_slots.get(config_id)
+        if semaphore is None:
+            semaphore = self._config_slots[config_id] = asyncio.Semaphore(self.max_per_config)
+        if semaphore.locked():
+            logger.info(f"[准入控制] AI 配置 {config_id} 的并发已满（{self.max_per_config}），等待空闲槽位")
+        async with semaphore:
+            self._active_per_config[config_id] = self._active_per_config.get(config_id, 0) + 1
             try:
-                ET.fromstring(xml_string)
-                print("[XML清理] 修复后验证通过")
-            except ET.ParseError as e2:
-                print(f"[XML清理] 错误: 仍然无法解析: {str(e2)}")
-                # 继续返回，让前端尝试处理
+                yield
+            finally:
+                remaining = self._active_per_config[config_id] - 1
+                if remaining:
+                    self._active_per_config[config_id] = remaining
+                else:
+                    del self._active_per_config[config_id]
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "active_per_config": dict(self._active_per_config),
+            "clients_queued": len(self._queues),
+            "rate_limited_clients": len(self._buckets),
+            "max_concurrent": self.max_concurrent,
+            "max_per_config": self.max_per_config,
+            "queue_size": self.queue_size,
+            "avg_hold_seconds": round(self.avg_hold_seconds, 2)
+        }
 
-        # 4. 确保有完整的 mxfile 结构
-        if not xml_string.startswith('<mxfile'):
-            if '<mxGraphModel' in xml_string:
-                xml_string = f'<mxfile host="app.diagrams.net"><diagram name="Page-1" id="diagram1">{xml_string}</diagram></mxfile>'
-                print("[XML清理] 已添加 mxfile 包装")
+admission = AdmissionController(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, MAX_CONCURRENT_GENERATIONS,
+                                MAX_CONCURRENT_PER_CONFIG, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
 
-        print(f"[XML清理] 清理完成，XML 长度: {len(xml_string)} 字符")
-        return xml_string
+def client_key(raw_request: Request) -> str:
+    """限流使用的客户端标识"""
+    if RATE_LIMIT_KEY_HEADER:
+        value = raw_request.headers.get(RATE_LIMIT_KEY_HEADER)
+        if value:
+            return value.split(",")[0].strip()
+    return raw_request.client.host if raw_request.client else "-"
 
-    except Exception as e:
-        print(f"[XML清理] 清理过程出错: {str(e)}")
-        return xml_string  # 返回原始内容
+def admit_generation(raw_request: Request) -> AdmissionTicket:
+    """
+    生成请求的准入：限流后申请全局并发槽位（各 AI 配置的并发数在发起上游请求时由 config_slot 计数）
+    被拒绝时抛出 429
+    """
+    try:
+        client = client_key(raw_request)
+        admission.check_rate(client)
+        return admission.enqueue(client)
+    except AdmissionRejected as e:
+        logger.warning(f"[准入控制] 拒绝请求: {e}（Retry-After: {e.retry_after}s）")
+        raise e.to_http()
 
 # ========== API 路由 ==========
 
@@ -466,9 +4953,33 @@ async def get_ai_configs():
             "configs": processed_configs
         }
     except Exception as e:
-        print(f"[配置API] 获取配置失败: {str(e)}")
+        logger.error(f"[配置API] 获取配置失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"获取配置失败: {str(e)}")
 
+@app.get("/api/ai-configs/health")
+async def get_ai_configs_health():
+    """
+    获取所有 AI 配置的健康状况（成功率、延迟、熔断状态），按当前路由顺序排列
+    """
+    routed = [c.id for c in config_manager.get_enabled_configs(include_unhealthy=True)]
+    configs = sorted(
+        config_manager.get_all_configs(),
+        key=lambda c: routed.index(c.id) if c.id in routed else len(routed)
+    )
+    return {
+        "success": True,
+        "configs": [
+            {
+                "id": c.id,
+                "name": c.name,
+                "enabled": c.enabled,
+                "priority": c.priority,
+                **config_manager.get_health(c.id).snapshot()
+            }
+            for c in configs
+        ]
+    }
+
 @app.get("/api/ai-configs/{config_id}")
 async def get_ai_config(config_id: str):
     """
@@ -494,7 +5005,7 @@ async def get_ai_config(config_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[配置API] 获取配置失败: {str(e)}")
+        logger.error(f"[配置API] 获取配置失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"获取配置失败: {str(e)}")
 
 @app.post("/api/ai-configs")
@@ -503,14 +5014,14 @@ async def create_ai_config(request: AIConfigCreateRequest):
     创建新的 AI 配置
     """
     try:
-        config = config_manager.create_config(request)
+        config = await config_manager.create_config(request)
         return {
             "success": True,
             "message": "配置创建成功",
             "config": config.dict()
         }
     except Exception as e:
-        print(f"[配置API] 创建配置失败: {str(e)}")
+        logger.error(f"[配置API] 创建配置失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"创建配置失败: {str(e)}")
 
 @app.put("/api/ai-configs/{config_id}")
@@ -538,11 +5049,11 @@ async def update_ai_config(config_id: str, request: AIConfigUpdateRequest):
 
             # 只允许修改 enabled
             if 'enabled' in update_dict:
-                config.enabled = update_dict['enabled']
-                print(f"[配置管理器] 修改系统配置状态: {config.name} (ID: {config_id}) -> enabled={config.enabled}")
+                config = await config_manager.update_config(config_id, request)
+                logger.info(f"[配置管理器] 修改系统配置状态: {config.name} (ID: {config_id}) -> enabled={config.enabled}")
         else:
             # 用户配置可以正常更新
-            config = config_manager.update_config(config_id, request)
+            config = await config_manager.update_config(config_id, request)
 
         # 返回时隐藏系统配置的敏感信息
         config_dict = config.dict()
@@ -558,7 +5069,7 @@ async def update_ai_config(config_id: str, request: AIConfigUpdateRequest):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[配置API] 更新配置失败: {str(e)}")
+        logger.error(f"[配置API] 更新配置失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"更新配置失败: {str(e)}")
 
 @app.delete("/api/ai-configs/{config_id}")
@@ -579,7 +5090,7 @@ async def delete_ai_config(config_id: str):
                 detail="系统配置不允许删除。如需停用，请使用启用/禁用功能。"
             )
 
-        success = config_manager.delete_config(config_id)
+        success = await config_manager.delete_config(config_id)
         if not success:
             raise HTTPException(status_code=404, detail="配置不存在")
 
@@ -590,7 +5101,7 @@ async def delete_ai_config(config_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[配置API] 删除配置失败: {str(e)}")
+        logger.error(f"[配置API] 删除配置失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"删除配置失败: {str(e)}")
 
 @app.get("/api/test-ai")
@@ -599,16 +5110,15 @@ async def test_ai():
     测试 AI API 是否可用（调试用）
     """
     results = []
-    ai_apis = get_ai_apis()  # 从配置管理器获取配置
+    ai_apis = get_ai_apis(include_unhealthy=True)  # 从配置管理器获取配置（包括熔断中的配置）
 
     for api_config in ai_apis:
         try:
-            print(f"\n[测试] {api_config['name']}")
-            print(f"  URL: {api_config['base_url']}/chat/completions")
-            print(f"  Model: {api_config['model']}")
+            logger.info(f"[测试] {api_config['name']}",
+                        extra={"url": f"{api_config['base_url']}/chat/completions", "model": api_config['model']})
 
-            # 发送简单的测试请求
-            async with httpx.AsyncClient(timeout=30.0) as client:
+            # 发送简单的测试请求（复用连接池中的客户端）
+            async with client_pool.acquire(api_config['base_url']) as client:
                 payload = {
                     "model": api_config['model'],
                     "messages": [
@@ -616,7 +5126,7 @@ async def test_ai():
                     ]
                 }
 
-                print(f"  请求体: {payload}")
+                logger.debug("[测试] 请求体: %s", payload)
 
                 response = await client.post(
                     f"{api_config['base_url']}/chat/completions",
@@ -624,15 +5134,16 @@ async def test_ai():
                         "Authorization": f"Bearer {api_config['api_key']}",
                         "Content-Type": "application/json"
                     },
-                    json=payload
+                    json=payload,
+                    timeout=client_pool.timeout_for(api_config, 30.0)
                 )
 
-                print(f"  状态码: {response.status_code}")
+                logger.info(f"[测试] {api_config['name']} 状态码: {response.status_code}")
 
                 if response.status_code == 200:
                     result_data = response.json()
                     content = result_data.get('choices', [{}])[0].get('message', {}).get('content', '')
-                    print(f"  响应: {content[:100]}...")
+                    logger.debug("[测试] 响应: %.100s...", content)
 
                     results.append({
                         "api": api_config['name'],
@@ -642,7 +5153,7 @@ async def test_ai():
                     })
                 else:
                     error_text = response.text[:200]
-                    print(f"  错误: {error_text}")
+                    logger.warning(f"[测试] {api_config['name']} 错误: {error_text}")
 
                     results.append({
                         "api": api_config['name'],
@@ -653,8 +5164,7 @@ async def test_ai():
 
         except httpx.TimeoutException as e:
             error_msg = f"请求超时: {str(e)}"
-            print(f"  异常类型: TimeoutException")
-            print(f"  异常详情: {error_msg}")
+            logger.warning(f"[测试] {api_config['name']} TimeoutException: {error_msg}")
 
             results.append({
                 "api": api_config['name'],
@@ -665,8 +5175,7 @@ async def test_ai():
 
         except httpx.ConnectError as e:
             error_msg = f"连接失败: {str(e)}"
-            print(f"  异常类型: ConnectError")
-            print(f"  异常详情: {error_msg}")
+            logger.warning(f"[测试] {api_config['name']} ConnectError: {error_msg}")
 
             results.append({
                 "api": api_config['name'],
@@ -677,8 +5186,7 @@ async def test_ai():
 
         except httpx.HTTPError as e:
             error_msg = f"HTTP 错误: {str(e)}"
-            print(f"  异常类型: HTTPError")
-            print(f"  异常详情: {error_msg}")
+            logger.warning(f"[测试] {api_config['name']} HTTPError: {error_msg}")
 
             results.append({
                 "api": api_config['name'],
@@ -691,9 +5199,7 @@ async def test_ai():
             import traceback
             error_msg = str(e)
             error_trace = traceback.format_exc()
-            print(f"  异常类型: {type(e).__name__}")
-            print(f"  异常详情: {error_msg}")
-            print(f"  异常堆栈:\n{error_trace}")
+            logger.exception(f"[测试] {api_config['name']} {type(e).__name__}: {error_msg}")
 
             results.append({
                 "api": api_config['name'],
@@ -706,125 +5212,86 @@ async def test_ai():
     return {"test_results": results}
 
 @app.post("/api/generate-diagram-stream")
-async def generate_diagram_stream(request: DiagramGenerateRequest):
+async def generate_diagram_stream(request: DiagramGenerateRequest, raw_request: Request):
     """
     流式生成 draw.io XML（支持实时输出）
+    并发已满时先排队，期间发送 queued 事件报告排队位置；被限流或队列已满时返回 429
     """
-    async def event_generator():
-        last_error = None
-        ai_apis = get_ai_apis()
+    ticket = admit_generation(raw_request)
+    try:
+        await load_session_history(request)
+    except BaseException:
+        # 会话不存在（404）等情况下不会返回事件流，槽位在这里归还
+        admission.release(ticket)
+        raise
+
+    async def generation_events():
+        try:
+            async for position in admission.wait_turn(ticket):
+                yield {'type': 'queued', 'position': position}
+        except AdmissionRejected as e:
+            yield {'type': 'failed', 'message': str(e)}
+            return
 
-        for api_config in ai_apis:
+        candidates = []
+        for api_config in get_ai_apis():
             if api_config['name'] in request.skip_apis:
-                yield f"data: {json.dumps({'type': 'skip', 'api': api_config['name']}, ensure_ascii=False)}\n\n"
+                yield {'type': 'skip', 'api': api_config['name']}
                 continue
+            candidates.append(api_config)
 
-            try:
-                yield f"data: {json.dumps({'type': 'start', 'api': api_config['name']}, ensure_ascii=False)}\n\n"
-
-                # 构建消息历史
-                # 使用自定义系统提示词（如果提供），否则使用默认提示词
-                system_prompt = request.system_prompt if request.system_prompt else SYSTEM_PROMPT
-                messages = [{"role": "system", "content": system_prompt}]
-                for msg in request.messages:
-                    messages.append({"role": msg.role, "content": msg.content})
-                messages.append({"role": "user", "content": request.prompt})
-
-                # 构建请求体 - 启用流式输出
-                payload = {
-                    "model": api_config['model'],
-                    "messages": messages,
-                    "temperature": 0.7,
-                    "stream": True  # 关键：启用流式输出
-                }
-
-                headers = {
-                    "Authorization": f"Bearer {api_config['api_key']}",
-                    "Content-Type": "application/json"
-                }
-
-                # 使用流式请求
-                async with httpx.AsyncClient(timeout=120.0) as client:
-                    async with client.stream(
-                        "POST",
-                        f"{api_config['base_url']}/chat/completions",
-                        headers=headers,
-                        json=payload
-                    ) as response:
-                        if response.status_code != 200:
-                            error_msg = f"API 返回错误: {response.status_code}"
-                            yield f"data: {json.dumps({'type': 'error', 'message': error_msg}, ensure_ascii=False)}\n\n"
-                            continue
-
-                        full_content = ""
-                        async for line in response.aiter_lines():
-                            if line.startswith("data: "):
-                                data_str = line[6:]  # 去掉 "data: " 前缀
-
-                                if data_str == "[DONE]":
-                                    break
-
-                                try:
-                                    data = json.loads(data_str)
-                                    if 'choices' in data and len(data['choices']) > 0:
-                                        delta = data['choices'][0].get('delta', {})
-                                        content = delta.get('content', '')
-
-                                        if content:
-                                            full_content += content
-                                            # 发送流式内容给前端
-                                            yield f"data: {json.dumps({'type': 'content', 'content': content}, ensure_ascii=False)}\n\n"
-                                            await asyncio.sleep(0.01)  # 小延迟，避免过快
-                                except json.JSONDecodeError:
-                                    continue
-
-                # 流式输出完成，进行XML清理
-                cleaned_xml = clean_xml(full_content)
-
-                if not cleaned_xml.strip():
-                    print(f"[验证失败] {api_config['name']} 返回空内容")
-                    api_name = api_config['name']
-                    # 通知前端验证失败
-                    yield f"data: {json.dumps({'type': 'validation_failed', 'message': 'XML内容为空，请重试', 'error': 'XML内容为空'}, ensure_ascii=False)}\n\n"
-                    return
-
-                # 严格验证 XML
-                is_valid, error_msg = validate_xml_strict(cleaned_xml)
-                if not is_valid:
-                    print(f"[验证失败] {api_config['name']} XML验证失败: {error_msg}")
-                    api_name = api_config['name']
-                    # 通知前端验证失败
-                    yield f"data: {json.dumps({'type': 'validation_failed', 'message': f'XML验证失败: {error_msg}', 'error': error_msg}, ensure_ascii=False)}\n\n"
-                    return
-
-                # 验证通过，构建对话历史
-                new_messages = []
-                for msg in request.messages:
-                    new_messages.append({"role": msg.role, "content": msg.content})
-                new_messages.append({"role": "user", "content": request.prompt})
-                new_messages.append({"role": "assistant", "content": cleaned_xml})
-
-                # 发送完成信号和最终XML
-                result = {
-                    "type": "complete",
-                    "xml": cleaned_xml,
-                    "api_used": api_config['name'],
-                    "messages": new_messages
-                }
-                yield f"data: {json.dumps(result, ensure_ascii=False)}\n\n"
-                return
-
-            except Exception as e:
-                error_msg = f"{api_config['name']} 错误: {str(e)}"
-                yield f"data: {json.dumps({'type': 'error', 'message': error_msg}, ensure_ascii=False)}\n\n"
-                last_error = error_msg
-                continue
+        if request.chunked:
+            async for event in chunked_generation_events(request, candidates):
+                if event['type'] == 'complete':
+                    event.update(await complete_turn(request, event['xml']))
+                yield event
+            return
 
-        # 所有API都失败
-        yield f"data: {json.dumps({'type': 'failed', 'message': f'所有API都失败了: {last_error}'}, ensure_ascii=False)}\n\n"
+        # 已有流程图时先尝试补丁模式（只请求首选 API），失败后回退为完整生成
+        base_xml = latest_diagram_xml(request)
+        if candidates and use_edit_mode(request, base_xml):
+            logger.info("[增量编辑] 使用补丁模式修改当前流程图")
+            edit_messages = build_edit_messages(request, base_xml)
+            new_processor = lambda: DrawioPatchProcessor(base_xml, max_chars=MAX_RESPONSE_CHARS)
+            async with aclosing(cached_or_generate(request, candidates[:1], edit_messages, new_processor)) as events:
+                async for event in events:
+                    if event['type'] in ('failed', 'validation_failed'):
+                        # 前端已在 failover/error 事件中丢弃补丁输出
+                        logger.warning(f"[增量编辑] 补丁模式失败，改为完整生成: {event['message']}")
+                        break
+                    if event['type'] == 'complete':
+                        event['edit_mode'] = True
+                        event.update(await complete_turn(request, event['xml']))
+                        yield event
+                        return
+                    yield event
+
+        # 命中缓存时直接回放；相同请求正在生成时共享同一个上游请求
+        messages = build_chat_messages(request, candidates)
+        new_processor = (lambda: DrawioDSLProcessor(max_chars=MAX_RESPONSE_CHARS)) if use_dsl(request) else None
+        async for event in cached_or_generate(request, candidates, messages, new_processor):
+            if event['type'] == 'complete':
+                # 缓存和合并共享的是模型原始输出，布局在各请求中确定性地重新计算（DSL 编译时已完成布局）
+                if use_auto_layout(request) and not use_dsl(request):
+                    event['xml'] = await xml_pool.run(layout_generated_xml, event['xml'])
+                    event['auto_layout'] = True
+                # 验证通过，记录到会话或附带对话历史
+                event.update(await complete_turn(request, event['xml']))
+            yield event
 
+    async def event_generator():
+        try:
+            async for event in coalesce_events(generation_events()):
+                yield sse_event(event)
+        finally:
+            # 生成结束或客户端断开（包括排队中断开）都归还槽位
+            admission.release(ticket)
+
+    body = event_generator()
+    # 客户端在响应开始前断开时生成器不会启动，finally 不会执行；生成器被回收时兜底归还槽位
+    weakref.finalize(body, admission.release, ticket)
     return StreamingResponse(
-        event_generator(),
+        body,
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -833,250 +5300,319 @@ async def generate_diagram_stream(request: DiagramGenerateRequest):
     )
 
 @app.post("/api/generate-diagram")
-async def generate_diagram(request: DiagramGenerateRequest):
+async def generate_diagram(request: DiagramGenerateRequest, raw_request: Request):
     """
     调用 AI 模型生成 draw.io XML（支持多 API 故障转移 + 对话记忆 + API 切换）
+    并发已满时排队等待；被限流、队列已满或排队超时时返回 429
     """
-    last_error = None
-    ai_apis = get_ai_apis()  # 从配置管理器获取配置
-
-    # 遍历所有配置的 API，按顺序尝试
-    for api_config in ai_apis:
+    ticket = admit_generation(raw_request)
+    try:
+        async for _ in admission.wait_turn(ticket):
+            pass
+        return await run_generate_diagram(request)
+    except AdmissionRejected as e:
+        raise e.to_http()
+    finally:
+        admission.release(ticket)
+
+async def run_generate_diagram(request: DiagramGenerateRequest) -> dict:
+    """非流式生成（已获得准入槽位）"""
+    await load_session_history(request)
+
+    candidates = []
+    for api_config in get_ai_apis():  # 从配置管理器获取配置
         # 检查是否需要跳过此 API
         if api_config['name'] in request.skip_apis:
-            print(f"\n[跳过] {api_config['name']} (前端请求跳过)")
+            logger.info(f"[跳过] {api_config['name']} (前端请求跳过)")
             continue
+        candidates.append(api_config)
+
+    if request.chunked:
+        final = None
+        async for event in chunked_generation_events(request, candidates):
+            final = event
+        if final['type'] != 'complete':
+            raise HTTPException(status_code=500, detail=final['message'])
+        return {
+            "xml": final['xml'],
+            "prompt": request.prompt,
+            "api_used": final['api_used'],
+            "chunked": True,
+            **(await complete_turn(request, final['xml']))
+        }
 
-        try:
-            print(f"\n{'='*60}")
-            print(f"[尝试] 使用 {api_config['name']} 生成流程图")
-            print(f"  URL: {api_config['base_url']}/chat/completions")
-            print(f"  Model: {api_config['model']}")
-            print(f"  用户提示: {request.prompt}")
-            print(f"  对话历史: {len(request.messages)} 条消息")
-            print(f"{'='*60}\n")
-
-            # 构建消息历史
-            # 使用自定义系统提示词（如果提供），否则使用默认提示词
-            system_prompt = request.system_prompt if request.system_prompt else SYSTEM_PROMPT
-            messages = [{"role": "system", "content": system_prompt}]
-
-            # 添加历史对话
-            for msg in request.messages:
-                messages.append({
-                    "role": msg.role,
-                    "content": msg.content
-                })
-
-            # 添加当前用户消息
-            messages.append({
-                "role": "user",
-                "content": request.prompt
-            })
-
-            print(f"[调试] 消息数量: {len(messages)} (包含系统提示词)")
-
-            # 构建请求体
-            payload = {
-                "model": api_config['model'],
-                "messages": messages,
-                "temperature": 0.7
-                # 不设置 max_tokens 限制，让模型自由生成
+    # 已有流程图时先尝试补丁模式（只请求首选 API），失败后回退为完整生成
+    base_xml = latest_diagram_xml(request)
+    if candidates and use_edit_mode(request, base_xml):
+        logger.info("[增量编辑] 使用补丁模式修改当前流程图")
+        patch, api_config, last_error = await race_diagram_requests(
+            candidates[:1], build_edit_messages(request, base_xml), raw=True
+        )
+        if patch is not None:
+            xml, is_valid, last_error = await xml_pool.run(apply_patch_output, base_xml, patch)
+            if is_valid:
+                xml = await xml_pool.run(normalize_styles, xml)
+                return {
+                    "xml": xml,
+                    "prompt": request.prompt,
+                    "api_used": api_config['name'],
+                    "edit_mode": True,
+                    **(await complete_turn(request, xml))
+                }
+        logger.warning(f"[增量编辑] 补丁模式失败，改为完整生成: {last_error}")
+
+    messages = build_chat_messages(request, candidates)
+
+    # 命中缓存：直接返回上次的结果
+    if cache_enabled_for(request):
+        entry = response_cache.lookup(candidates, messages)
+        if entry is not None:
+            logger.info(f"[缓存] 命中缓存 ({entry['api_used']})")
+            metrics.cache_hits.inc(entry['api_used'])
+            xml = entry['xml']
+            if use_auto_layout(request) and not use_dsl(request):
+                xml = await xml_pool.run(layout_generated_xml, xml)
+            return {
+                "xml": xml,
+                "prompt": request.prompt,
+                "api_used": entry['api_used'],
+                "cached": True,
+                **(await complete_turn(request, xml))
             }
 
-            print(f"[调试] 请求体（前200字符）: {str(payload)[:200]}...")
+    # 按顺序尝试（启用对冲时主请求过慢会并行请求下一个 API）
+    xml, api_config, last_error = await race_diagram_requests(candidates, messages, raw=use_dsl(request))
 
-            # 构建请求头
-            headers = {
-                "Authorization": f"Bearer {api_config['api_key']}",
-                "Content-Type": "application/json"
-            }
+    if xml is None:
+        # 所有 API 都失败了
+        logger.warning("[失败] 所有 API 都无法使用")
+        raise HTTPException(
+            status_code=500,
+            detail=f"所有 AI API 都失败了。最后一个错误: {last_error}"
+        )
 
-            # 打印请求头（隐藏完整的 API Key）
-            print(f"[调试] 请求头:")
-            print(f"  - Content-Type: {headers['Content-Type']}")
-            print(f"  - Authorization: Bearer {api_config['api_key'][:15]}...（已隐藏）")
+    if use_dsl(request):
+        xml, is_valid, error_msg = await xml_pool.run(compile_dsl_output, xml)
+        if not is_valid:
+            raise HTTPException(status_code=500, detail=f"{api_config['name']} 返回的 DSL 无效: {error_msg}")
+        xml = await xml_pool.run(normalize_styles, xml)
 
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{api_config['base_url']}/chat/completions",
-                    headers=headers,
-                    json=payload
-                )
+    # 成功生成
+    logger.info(f"[成功] 使用 {api_config['name']} 成功生成流程图！最终 XML 长度: {len(xml)} 字符")
 
-            print(f"[调试] 响应状态码: {response.status_code}")
-
-            # 检查响应状态
-            if response.status_code != 200:
-                error_msg = f"{api_config['name']} API 返回错误: {response.status_code}"
-                error_detail = response.text[:300]
-                print(f"[失败] {error_msg}")
-                print(f"[失败] 错误详情: {error_detail}")
-                last_error = f"{error_msg} - {error_detail}"
-                continue  # 尝试下一个 API
-
-            # 解析响应
-            result = response.json()
-
-            # 检查响应格式
-            if 'choices' not in result or len(result['choices']) == 0:
-                error_msg = f"{api_config['name']} 返回格式错误: {result}"
-                print(f"[失败] {error_msg}")
-                last_error = error_msg
-                continue
+    # 非流式接口不做严格验证，只缓存有效的结果
+    if (await validate_generated_xml(xml, api_config['name']))[0] and RESPONSE_CACHE_ENABLED:
+        response_cache.store(api_config, messages, xml, api_config['name'])
 
-            xml = result['choices'][0]['message']['content']
+    if use_auto_layout(request) and not use_dsl(request):
+        xml = await xml_pool.run(layout_generated_xml, xml)
 
-            print(f"[调试] AI 返回的原始 XML 长度: {len(xml)} 字符")
+    return {
+        "xml": xml,
+        "prompt": request.prompt,
+        "api_used": api_config['name'],
+        **(await complete_turn(request, xml))  # 会话 ID，或不使用会话时返回完整的对话历史
+    }
 
-            # 使用 XML 清理和验证函数
-            xml = clean_xml(xml)
+# ========== 会话 API ==========
 
-            # 最后验证
-            if not xml.strip():
-                error_msg = f"{api_config['name']} 返回空内容"
-                print(f"[失败] {error_msg}")
-                last_error = error_msg
-                continue
+@app.post("/api/sessions")
+async def create_session():
+    """
+    创建会话，之后的生成请求只需携带 session_id 和 prompt
+    """
+    return {"session_id": await session_store.create()}
 
-            # 成功生成
-            print(f"[成功] 使用 {api_config['name']} 成功生成流程图！")
-            print(f"[成功] 最终 XML 长度: {len(xml)} 字符")
-
-            # 构建新的对话历史
-            new_messages = []
-            for msg in request.messages:
-                new_messages.append({
-                    "role": msg.role,
-                    "content": msg.content
-                })
-
-            # 添加本次对话
-            new_messages.append({
-                "role": "user",
-                "content": request.prompt
-            })
-            new_messages.append({
-                "role": "assistant",
-                "content": xml  # AI 返回的 XML
-            })
+@app.get("/api/sessions/stats")
+async def session_stats():
+    """
+    会话存储统计
+    """
+    return session_store.stats()
 
-            return {
-                "xml": xml,
-                "prompt": request.prompt,
-                "api_used": api_config['name'],
-                "messages": new_messages  # 返回完整的对话历史
-            }
+@app.get("/api/sessions/{session_id}")
+async def get_session(session_id: str):
+    """
+    获取会话概况（轮数和最新的流程图）
+    """
+    history = await session_store.get_history(session_id)
+    if history is None:
+        raise HTTPException(status_code=404, detail="会话不存在或已过期")
 
-        except httpx.TimeoutException as e:
-            error_msg = f"{api_config['name']} 请求超时"
-            print(f"[超时] {error_msg}")
-            print(f"[超时] 详情: {str(e)}")
-            last_error = f"{error_msg}: {str(e)}"
-            continue
+    return {
+        "session_id": session_id,
+        "turns": len(history) // 2,
+        "xml": history[-1]["content"] if history else None
+    }
 
-        except httpx.ConnectError as e:
-            error_msg = f"{api_config['name']} 连接失败"
-            print(f"[连接错误] {error_msg}")
-            print(f"[连接错误] 详情: {str(e)}")
-            print(f"[连接错误] 可能原因: 网络不可达或DNS解析失败")
-            last_error = f"{error_msg}: {str(e)}"
-            continue
+@app.delete("/api/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """
+    删除会话
+    """
+    if not await session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail="会话不存在或已过期")
 
-        except httpx.HTTPError as e:
-            error_msg = f"{api_config['name']} HTTP错误"
-            print(f"[HTTP错误] {error_msg}")
-            print(f"[HTTP错误] 详情: {str(e)}")
-            last_error = f"{error_msg}: {str(e)}"
-            continue
+    return {"message": "删除成功"}
 
-        except Exception as e:
-            import traceback
-            error_msg = f"{api_config['name']} 未知错误: {type(e).__name__}"
-            error_trace = traceback.format_exc()
-            print(f"[错误] {error_msg}")
-            print(f"[错误] 详情: {str(e)}")
-            print(f"[错误] 堆栈:\n{error_trace}")
-            last_error = f"{error_msg}: {str(e)}"
-            continue
+@app.post("/api/layout")
+async def layout_diagram(request: DiagramLayoutRequest):
+    """
+    对已有图表重新执行自动布局（分层布局，坐标对齐到 10 的网格）
+    """
+    if request.direction is not None and request.direction.upper() not in ("TB", "LR"):
+        raise HTTPException(status_code=400, detail="direction 只能是 TB 或 LR")
 
-    # 所有 API 都失败了
-    print(f"[失败] 所有 API 都无法使用")
-    raise HTTPException(
-        status_code=500,
-        detail=f"所有 AI API 都失败了。最后一个错误: {last_error}"
-    )
+    try:
+        xml = await xml_pool.run(auto_layout_xml, inflate_drawio_diagrams(request.xml),
+                                 request.direction and request.direction.upper())
+    except ET.ParseError as e:
+        raise HTTPException(status_code=400, detail=f"XML 无法解析: {e}")
+
+    return {"xml": xml}
 
 @app.post("/api/save-diagram")
 async def save_diagram(request: DiagramSaveRequest):
     """
     保存图表到数据库
     """
-    global diagram_counter
-
-    diagram_id = str(diagram_counter)
-    diagram_counter += 1
-
-    diagram = {
-        "id": diagram_id,
-        "xml": request.xml,
-        "name": request.name or f"流程图 {diagram_id}",
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat()
-    }
-
-    diagrams_db[diagram_id] = diagram
+    # draw.io 压缩格式的 <diagram> 统一展开后保存
+    xml = await xml_pool.run(normalize_styles, inflate_drawio_diagrams(request.xml))
+    diagram = await diagram_store.create(xml, request.name)
 
     return {
-        "id": diagram_id,
+        "id": diagram["id"],
         "message": "保存成功",
         "name": diagram["name"]
     }
 
 @app.get("/api/diagram/{diagram_id}")
-async def get_diagram(diagram_id: str):
+async def get_diagram(
+    diagram_id: str,
+    request: Request,
+    fmt: str = Query("json", alias="format", pattern="^(json|xml|drawio)$"),
+    stylesheet: bool = Query(False, description="仅 format=json：提取共享样式表，单元格只引用样式名称（需先注册样式表）")
+):
     """
     加载已保存的图表
+    - format=json（默认）：返回图表信息和 XML
+    - format=xml：直接返回 XML；客户端接受存储使用的压缩编码时原样输出压缩数据，不解压
+    - format=drawio：返回 <diagram> 内容为 draw.io 原生压缩格式的 XML
+    stylesheet=true（默认关闭，仅 format=json）：重复的样式提取到 stylesheet 字段，单元格的 style 改为 s1、s2 等名称。
+    这样返回的 XML 不能直接在 draw.io 中打开，调用方必须先用 graph.getStylesheet().putCellStyle 注册样式表
     """
-    if diagram_id not in diagrams_db:
+    if stylesheet and fmt != "json":
+        raise HTTPException(status_code=400, detail="stylesheet 仅支持 format=json")
+
+    if fmt == "json":
+        diagram = await diagram_store.get(diagram_id)
+        if diagram is None:
+            raise HTTPException(status_code=404, detail="图表不存在")
+        if stylesheet:
+            diagram["xml"], diagram["stylesheet"] = await xml_pool.run(extract_stylesheet, diagram["xml"])
+        return diagram
+
+    diagram = await diagram_store.get_encoded(diagram_id)
+    if diagram is None:
         raise HTTPException(status_code=404, detail="图表不存在")
 
-    return diagrams_db[diagram_id]
+    data, encoding = diagram["data"], diagram["encoding"]
+    if fmt == "xml" and encoding != "identity":
+        if accepts_encoding(request.headers.get("accept-encoding", ""), encoding):
+            return Response(
+                content=data,
+                media_type="application/xml",
+                headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+            )
+
+    xml = decompress_diagram(data, encoding)
+    if fmt == "drawio":
+        xml = deflate_drawio_diagrams(xml)
+    return Response(content=xml, media_type="application/xml", headers={"Vary": "Accept-Encoding"})
 
 @app.put("/api/diagram/{diagram_id}")
 async def update_diagram(diagram_id: str, request: DiagramSaveRequest):
     """
     更新已有图表（支持二次编辑）
     """
-    if diagram_id not in diagrams_db:
+    xml = await xml_pool.run(normalize_styles, inflate_drawio_diagrams(request.xml))
+    if not await diagram_store.update(diagram_id, xml, request.name):
         raise HTTPException(status_code=404, detail="图表不存在")
 
-    diagrams_db[diagram_id]["xml"] = request.xml
-    diagrams_db[diagram_id]["updated_at"] = datetime.now().isoformat()
-
-    if request.name:
-        diagrams_db[diagram_id]["name"] = request.name
-
     return {
         "id": diagram_id,
         "message": "更新成功"
     }
 
+@app.get("/api/diagram/{diagram_id}/revisions")
+async def list_diagram_revisions(diagram_id: str):
+    """
+    获取图表的版本历史（新的在前）
+    """
+    revisions = await diagram_store.list_revisions(diagram_id)
+    if revisions is None:
+        raise HTTPException(status_code=404, detail="图表不存在")
+
+    return {"id": diagram_id, "total": len(revisions), "revisions": revisions}
+
+@app.get("/api/diagram/{diagram_id}/revisions/{revision}")
+async def get_diagram_revision(diagram_id: str, revision: int):
+    """
+    获取图表的指定版本
+    """
+    result = await diagram_store.get_revision(diagram_id, revision)
+    if result is None:
+        raise HTTPException(status_code=404, detail="版本不存在")
+
+    return {"id": diagram_id, **result}
+
+@app.get("/api/diagram/{diagram_id}/diff")
+async def diff_diagram_revisions(
+    diagram_id: str,
+    from_revision: int = Query(..., alias="from", ge=1),
+    to_revision: int = Query(..., alias="to", ge=1)
+):
+    """
+    比较两个版本，按 cell id 列出新增、修改和删除的节点
+    """
+    old = await diagram_store.get_revision(diagram_id, from_revision)
+    new = await diagram_store.get_revision(diagram_id, to_revision)
+    if old is None or new is None:
+        raise HTTPException(status_code=404, detail="版本不存在")
+
+    try:
+        diff = diff_revisions(old["xml"], new["xml"])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {"id": diagram_id, "from": from_revision, "to": to_revision, **diff}
+
 @app.get("/api/diagrams")
-async def list_diagrams():
+async def list_diagrams(
+    limit: int = Query(50, ge=1, le=DIAGRAM_LIST_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    sort: str = Query("created_at", pattern="^(created_at|updated_at)$"),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    name_prefix: Optional[str] = None
+):
     """
-    获取所有图表列表
+    分页获取图表列表
+    - cursor: 上一页返回的 next_cursor，为空表示第一页
+    - sort / order: 按 created_at 或 updated_at 排序，默认最新的在前
+    - name_prefix: 按名称前缀过滤
     """
+    try:
+        diagrams, next_cursor = await diagram_store.list(
+            limit, cursor=cursor, sort=sort, descending=(order == "desc"), name_prefix=name_prefix
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     return {
-        "total": len(diagrams_db),
-        "diagrams": [
-            {
-                "id": d["id"],
-                "name": d["name"],
-                "created_at": d["created_at"]
-            }
-            for d in diagrams_db.values()
-        ]
+        "total": await diagram_store.count(name_prefix),
+        "limit": limit,
+        "next_cursor": next_cursor,
+        "diagrams": diagrams
     }
 
 @app.delete("/api/diagram/{diagram_id}")
@@ -1084,11 +5620,9 @@ async def delete_diagram(diagram_id: str):
     """
     删除图表
     """
-    if diagram_id not in diagrams_db:
+    if not await diagram_store.delete(diagram_id):
         raise HTTPException(status_code=404, detail="图表不存在")
 
-    del diagrams_db[diagram_id]
-
     return {"message": "删除成功"}
 
 # ========== 健康检查 ==========
@@ -1097,9 +5631,65 @@ async def delete_diagram(diagram_id: str):
 async def health_check():
     return {
         "status": "healthy",
-        "diagrams_count": len(diagrams_db)
+        "diagrams_count": await diagram_store.count()
+    }
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """
+    生成结果缓存统计（命中/未命中次数、占用字节数等）
+    """
+    return response_cache.stats()
+
+@app.delete("/api/cache")
+async def clear_cache():
+    """
+    清空生成结果缓存
+    """
+    response_cache.clear()
+    return {"message": "缓存已清空"}
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """
+    Prometheus 文本格式的监控指标
+    """
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="监控指标未启用")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/styles/stats")
+async def styles_stats():
+    """
+    样式规范化统计（累计处理的图表数、样式数和节省的字节数）
+    """
+    return {
+        "enabled": STYLE_NORMALIZE,
+        **style_stats,
+        "saved_bytes": style_stats["bytes_before"] - style_stats["bytes_after"]
     }
 
+@app.get("/api/http-pool/stats")
+async def http_pool_stats():
+    """
+    上游 HTTP 连接池统计（每个 base_url 的连接数、并发请求数等）
+    """
+    return client_pool.stats()
+
+@app.get("/api/admission/stats")
+async def admission_stats():
+    """
+    准入控制统计（占用槽位和排队中的请求数、各 AI 配置的并发数）
+    """
+    return admission.stats()
+
+@app.get("/api/xml-pool/stats")
+async def xml_pool_stats():
+    """
+    XML 处理进程池统计（进程数、大小阈值、排队和处理中的任务数）
+    """
+    return xml_pool.stats()
+
 # ========== 静态文件服务 ==========
 # 挂载静态文件服务（Vue3 构建输出）
 # 注意：必须放在所有 API 路由之后，否则会覆盖 API 路由
@@ -1108,32 +5698,27 @@ async def health_check():
 import os
 frontend_dist = os.path.join(os.path.dirname(__file__), "../frontend/dist")
 if os.path.exists(frontend_dist):
-    print(f"[静态文件] 服务 Vue3 构建输出: {frontend_dist}")
+    logger.info(f"[静态文件] 服务 Vue3 构建输出: {frontend_dist}")
     app.mount("/", StaticFiles(directory=frontend_dist, html=True), name="static")
 else:
-    print(f"[警告] Vue3 构建目录不存在: {frontend_dist}")
-    print("[提示] 开发环境请运行: cd frontend && npm run dev")
-    print("[提示] 生产环境请运行: cd frontend && npm run build")
+    logger.warning(f"[警告] Vue3 构建目录不存在: {frontend_dist}（开发环境请运行 cd frontend && npm run dev，"
+                   "生产环境请运行 cd frontend && npm run build）")
 
 if __name__ == "__main__":
     import uvicorn
-    import os
 
     # 开发模式：启用热重载
     # 生产模式：禁用热重载
-    dev_mode = os.getenv("DEV_MODE", "true").lower() == "true"
-
-    if dev_mode:
-        print("[开发模式] 热重载已启用")
-        print("[提示] 修改代码后会自动重启服务器")
-        print("[警告] 生产环境请设置 DEV_MODE=false")
-        print("")
+    if DEV_MODE:
+        logger.info("[开发模式] 热重载已启用，修改代码后会自动重启服务器")
+        logger.warning("[警告] 生产环境请设置 DEV_MODE=false")
 
     uvicorn.run(
         "main:app",  # 使用字符串形式，支持热重载
         host="0.0.0.0",
         port=8000,
-        reload=dev_mode,  # 开发模式启用热重载
+        reload=DEV_MODE,  # 开发模式启用热重载
+        workers=1 if DEV_MODE else WORKERS,  # 热重载只支持单个 worker
         reload_includes=["*.py"],  # 监控 .py 文件
         log_level="info"
     )
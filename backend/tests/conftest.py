@@ -0,0 +1,15 @@
+"""
+测试环境：导入 main 之前改用内存共享存储和临时图表数据库，并关闭 XML 进程池，
+测试不会读写 backend/data，也不会 fork 子进程
+"""
+import os
+import sys
+import tempfile
+
+_data_dir = tempfile.mkdtemp(prefix="auto-drawio-test-")
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("DIAGRAM_DB_PATH", os.path.join(_data_dir, "diagrams.db"))
+os.environ.setdefault("XML_POOL_WORKERS", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,67 @@
+import pytest
+
+import main
+
+def controller(max_concurrent: int = 1, queue_size: int = 10, rate_per_minute: float = 0, burst: int = 10):
+    return main.AdmissionController(rate_per_minute, burst, max_concurrent, 0, queue_size, 60)
+
+def test_round_robin_positions():
+    admission = controller()
+    first = admission.enqueue("A")
+    assert first.granted.is_set()
+
+    a2, a3 = admission.enqueue("A"), admission.enqueue("A")
+    b1 = admission.enqueue("B")
+    c1 = admission.enqueue("C")
+    assert [admission.position(t) for t in (a2, b1, c1, a3)] == [1, 2, 3, 4]
+    assert admission.position(first) == 0
+
+def test_dispatch_alternates_between_clients():
+    admission = controller()
+    first = admission.enqueue("A")
+    waiting = [admission.enqueue("A"), admission.enqueue("A"), admission.enqueue("B"), admission.enqueue("C")]
+    a2, a3, b1, c1 = waiting
+
+    granted = []
+    current = first
+    for _ in waiting:
+        admission.release(current)
+        current = next(t for t in waiting if t.granted.is_set() and t not in granted)
+        granted.append(current)
+    assert granted == [a2, b1, c1, a3]
+    assert admission.waiting == 0
+
+def test_release_while_waiting_leaves_queue():
+    admission = controller()
+    first = admission.enqueue("A")
+    b1, c1 = admission.enqueue("B"), admission.enqueue("C")
+    admission.release(b1)
+    assert admission.position(c1) == 1
+    admission.release(first)
+    assert c1.granted.is_set()
+    assert admission.active == 1 and admission.waiting == 0
+
+def test_release_is_idempotent():
+    admission = controller(max_concurrent=2)
+    ticket = admission.enqueue("A")
+    admission.release(ticket)
+    admission.release(ticket)
+    assert admission.active == 0
+
+def test_queue_full_is_rejected():
+    admission = controller(queue_size=1)
+    admission.enqueue("A")
+    admission.enqueue("B")
+    with pytest.raises(main.AdmissionRejected) as rejected:
+        admission.enqueue("C")
+    assert rejected.value.reason == "queue_full"
+    assert rejected.value.retry_after >= 1
+
+def test_rate_limit():
+    admission = controller(rate_per_minute=60, burst=2)
+    admission.check_rate("A")
+    admission.check_rate("A")
+    with pytest.raises(main.AdmissionRejected) as rejected:
+        admission.check_rate("A")
+    assert rejected.value.reason == "rate_limited"
+    admission.check_rate("B")  # 各客户端的令牌桶相互独立
@@ -0,0 +1,40 @@
+import main
+
+DIAGRAM = (
+    '<mxfile><diagram id="d1"><mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/>'
+    '<mxCell id="2" value="开始" vertex="1" parent="1"><mxGeometry x="0" y="0" width="120" height="60" as="geometry"/></mxCell>'
+    '</root></mxGraphModel></diagram></mxfile>'
+)
+
+def user(content: str) -> dict:
+    return {"role": "user", "content": content}
+
+def assistant(content: str) -> dict:
+    return {"role": "assistant", "content": content}
+
+def test_older_diagrams_are_summarized():
+    history = [user("画一个流程图"), assistant(DIAGRAM), user("加一个节点"), assistant(DIAGRAM)]
+    compacted = main.compact_history(history, 100000)
+    assert len(compacted) == 4
+    assert compacted[1]["content"] != DIAGRAM
+    assert compacted[3]["content"] == DIAGRAM
+
+def test_budget_keeps_request_for_latest_diagram():
+    history = [user("画一个流程图"), assistant(DIAGRAM), user("x" * 3000), assistant(DIAGRAM)]
+    budget = main.estimate_messages_tokens(history[2:]) - 1
+    compacted = main.compact_history(history, budget)
+    assert compacted == history[2:]
+
+def test_budget_drops_oldest_turns_without_leading_assistant():
+    history = [user("a" * 400), assistant("好的"), user("b" * 400), assistant("好的"), user("c" * 40)]
+    budget = main.estimate_messages_tokens(history[2:])
+    compacted = main.compact_history(history, budget)
+    assert compacted == history[2:]
+
+    compacted = main.compact_history(history, budget - 1)
+    assert compacted[0]["role"] == "user"
+    assert compacted[-1] == history[-1]
+
+def test_history_without_diagram_within_budget_is_unchanged():
+    history = [user("你好"), assistant("你好，有什么可以帮你？")]
+    assert main.compact_history(history, 100000) == history
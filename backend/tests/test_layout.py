@@ -0,0 +1,34 @@
+import main
+
+SIZES = {"a": (120, 60), "b": (120, 60), "c": (160, 80), "d": (120, 60)}
+
+def test_cycle_and_self_loop():
+    edges = [("a", "b"), ("b", "c"), ("c", "a"), ("b", "b"), ("c", "d"), ("a", "missing")]
+    positions = main.layered_layout(SIZES, edges)
+    assert set(positions) == set(SIZES)
+    # 回边 c → a 被反向后仍是 a → b → c → d 的分层
+    ys = [positions[v][1] for v in "abcd"]
+    assert ys == sorted(ys) and len(set(ys)) == 4
+
+def test_self_loop_only_graph():
+    positions = main.layered_layout({"a": (120, 60)}, [("a", "a")])
+    assert positions == {"a": (main.LAYOUT_MARGIN, main.LAYOUT_MARGIN)}
+
+def test_positions_are_on_grid_and_do_not_overlap():
+    edges = [("a", "b"), ("a", "c"), ("a", "d"), ("d", "a")]
+    positions = main.layered_layout(SIZES, edges)
+    for x, y in positions.values():
+        assert x % main.LAYOUT_GRID == 0 and y % main.LAYOUT_GRID == 0
+
+    boxes = [(x, y, x + SIZES[v][0], y + SIZES[v][1]) for v, (x, y) in positions.items()]
+    for i, first in enumerate(boxes):
+        for second in boxes[i + 1:]:
+            overlap = first[0] < second[2] and second[0] < first[2] and first[1] < second[3] and second[1] < first[3]
+            assert not overlap
+
+def test_left_to_right_and_deterministic():
+    edges = [("a", "b"), ("b", "c"), ("c", "a")]
+    positions = main.layered_layout(SIZES, edges, "LR")
+    assert positions == main.layered_layout(SIZES, edges, "LR")
+    xs = [positions[v][0] for v in "abc"]
+    assert xs == sorted(xs) and len(set(xs)) == 3
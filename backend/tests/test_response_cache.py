@@ -0,0 +1,19 @@
+import main
+
+MESSAGES = [{"role": "system", "content": "system"}, {"role": "user", "content": "画一个流程图"}]
+
+def config(base_url: str = "https://api.example.com/v1", model: str = "model-a") -> dict:
+    return {"id": "1", "name": "主配置", "base_url": base_url, "model": model}
+
+def test_hit_for_same_endpoint_and_model():
+    cache = main.ResponseCache(1 << 20, 3600)
+    cache.store(config(), MESSAGES, "<mxfile/>", "主配置")
+    entry = cache.lookup([config(model="model-b"), config()], MESSAGES)
+    assert entry is not None and entry["xml"] == "<mxfile/>"
+
+def test_changed_endpoint_misses():
+    cache = main.ResponseCache(1 << 20, 3600)
+    cache.store(config(), MESSAGES, "<mxfile/>", "主配置")
+    assert cache.lookup([config(base_url="https://other.example.com/v1")], MESSAGES) is None
+    assert cache.lookup([config(model="model-b")], MESSAGES) is None
+    assert cache.stats()["misses"] == 2
@@ -0,0 +1,90 @@
+import asyncio
+
+import main
+
+def diagram(*cells: str, pages: int = 1) -> str:
+    page = '<diagram id="p{}"><mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/>{}</root></mxGraphModel></diagram>'
+    return '<mxfile>' + ''.join(page.format(i, ''.join(cells)) for i in range(pages)) + '</mxfile>'
+
+def vertex(cell_id: str, value: str) -> str:
+    return (f'<mxCell id="{cell_id}" value="{value}" vertex="1" parent="1">'
+            f'<mxGeometry x="0" y="0" width="120" height="60" as="geometry"/></mxCell>')
+
+VERSIONS = [
+    diagram(vertex("2", "A"), vertex("3", "B")),
+    diagram(vertex("2", "A2"), vertex("3", "B")),                    # 修改
+    diagram(vertex("2", "A2"), vertex("3", "B"), vertex("4", "C")),  # 新增
+    diagram(vertex("2", "A2"), vertex("4", "C")),                    # 删除
+    diagram(vertex("4", "C"), vertex("2", "A2")),                    # 仅顺序变化
+    diagram(vertex("4", "C"), vertex("2", "A2"), pages=2),           # frame 变化（新增一页）
+    diagram(vertex("4", "C"), vertex("2", "A3"), pages=2),
+]
+
+def canonical(xml: str) -> str:
+    return main.compose_diagram(main.decompose_diagram(xml))
+
+def build_records(versions):
+    records, prev = [], None
+    for revision, xml in enumerate(versions, start=1):
+        kind, data = main.build_revision(prev, xml, revision)
+        records.append({"kind": kind, "data": data, "encoding": "identity"})
+        prev = xml
+    return records
+
+def chain_for(records, revision):
+    """从目标版本往前找到最近的快照，与存储层读取版本时的范围一致"""
+    start = max(i for i in range(revision) if records[i]["kind"] == "snapshot")
+    return records[start:revision]
+
+def test_diff_and_apply_round_trip():
+    for old_xml, new_xml in zip(VERSIONS, VERSIONS[1:]):
+        old, new = main.decompose_diagram(old_xml), main.decompose_diagram(new_xml)
+        rebuilt = main.apply_delta(old, main.diff_states(old, new))
+        assert main.compose_diagram(rebuilt) == main.compose_diagram(new)
+
+def test_reorder_is_recorded():
+    old, new = main.decompose_diagram(VERSIONS[3]), main.decompose_diagram(VERSIONS[4])
+    delta = main.diff_states(old, new)
+    assert "order" in delta
+    assert "set" not in delta and "del" not in delta
+
+def test_reconstruct_every_revision():
+    records = build_records(VERSIONS)
+    assert [r["kind"] for r in records[:5]] == ["snapshot"] + ["delta"] * 4
+    for revision, xml in enumerate(VERSIONS, start=1):
+        assert canonical(main.reconstruct_revision(chain_for(records, revision))) == canonical(xml)
+
+def test_snapshot_interval(monkeypatch):
+    monkeypatch.setattr(main, "DIAGRAM_SNAPSHOT_INTERVAL", 3)
+    records = build_records(VERSIONS)
+    assert [r["kind"] for r in records][::3] == ["snapshot"] * 3
+    assert records[1]["kind"] == records[4]["kind"] == "delta"
+    for revision, xml in enumerate(VERSIONS, start=1):
+        assert canonical(main.reconstruct_revision(chain_for(records, revision))) == canonical(xml)
+
+def test_diff_revisions_summary():
+    summary = main.diff_revisions(VERSIONS[1], VERSIONS[3])
+    assert summary["added"] == [{"page": 0, "id": "4"}]
+    assert summary["removed"] == [{"page": 0, "id": "3"}]
+    assert summary["changed"] == []
+    assert not summary["frame_changed"]
+
+def test_update_of_diagram_saved_before_revision_history(tmp_path):
+    """版本历史表出现之前保存的图表：第一次更新时当前内容记为版本 1"""
+    async def scenario():
+        store = main.SQLiteDiagramStore(str(tmp_path / "diagrams.db"), 1)
+        try:
+            created = await store.create(VERSIONS[0], "旧图表")
+            store._connect().execute("DELETE FROM diagram_revisions WHERE diagram_id = ?", (created["id"],))
+
+            assert await store.update(created["id"], VERSIONS[1], None)
+            revisions = await store.list_revisions(created["id"])
+            assert [(r["revision"], r["kind"]) for r in revisions] == [(2, "delta"), (1, "snapshot")]
+            first = await store.get_revision(created["id"], 1)
+            second = await store.get_revision(created["id"], 2)
+            assert canonical(first["xml"]) == canonical(VERSIONS[0])
+            assert canonical(second["xml"]) == canonical(VERSIONS[1])
+        finally:
+            store.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,52 @@
+import asyncio
+
+import main
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_reading_history_extends_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "time", clock)
+
+    async def scenario():
+        store = main.SessionStore(10, 1 << 20, 100, 0, main.MemorySharedState())
+        session_id = await store.create()
+        assert await store.append_turn(session_id, "画一个流程图", "<mxfile/>")
+
+        # 每次读取都延长有效期：总时长超过 ttl 但两次使用间隔小于 ttl 时会话仍然有效
+        for _ in range(3):
+            clock.now += 80
+            assert len(await store.get_history(session_id)) == 2
+
+        clock.now += 101
+        assert await store.get_history(session_id) is None
+
+    asyncio.run(scenario())
+
+def test_history_from_other_worker_is_not_served_after_expiry(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "time", clock)
+
+    async def scenario():
+        state = main.MemorySharedState()
+        first = main.SessionStore(10, 1 << 20, 100, 0, state)
+        second = main.SessionStore(10, 1 << 20, 100, 0, state)
+        session_id = await first.create()
+        assert await first.get_history(session_id) == []
+
+        # 另一个 worker 的读取同样延长共享存储中的有效期
+        clock.now += 80
+        assert await second.get_history(session_id) == []
+        clock.now += 80
+        assert await first.get_history(session_id) == []
+
+        clock.now += 101
+        assert await first.get_history(session_id) is None
+        assert first.stats()["sessions"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,139 @@
+import pytest
+
+import main
+
+SAMPLE = (
+    '```xml\n'
+    '<mxfile host="app.diagrams.net"><diagram name="Page-1" id="d1"><mxGraphModel><root>'
+    '<mxCell id="0"/><mxCell id="1" parent="0"/>'
+    '<mxCell id="2" value="开始" style="rounded=1;" style="rounded=0;" vertex="1" parent="1">'
+    '<mxGeometry x="40" y="40" width="120" height="60" as="geometry"/></mxCell>'
+    '<mxCell id="3" value="结束" vertex="1" parent="1">'
+    '<mxGeometry x="40" y="160" width="120" height="60" as="geometry"/></mxCell>'
+    '<mxCell id="4" edge="1" parent="1" source="2" target="3"><mxGeometry relative="1" as="geometry"/></mxCell>'
+    '</root></mxGraphModel></diagram></mxfile>\n'
+    '```'
+)
+
+def process(*chunks: str) -> main.DrawioXMLProcessor:
+    processor = main.DrawioXMLProcessor()
+    for chunk in chunks:
+        processor.feed(chunk)
+    return processor
+
+# ---------- DrawioXMLProcessor ----------
+
+def test_char_by_char_matches_all_at_once():
+    whole = process(SAMPLE)
+    chars = process(*SAMPLE)
+    assert chars.finish() == whole.finish()
+    assert whole.finish()[1:] == (True, '')
+    assert chars.cell_count == whole.cell_count == 5
+
+def test_any_split_point_matches_all_at_once():
+    expected = process(SAMPLE).finish()
+    for i in range(1, len(SAMPLE)):
+        assert process(SAMPLE[:i], SAMPLE[i:]).finish() == expected, f"在第 {i} 个字符处截断"
+
+def test_duplicate_attributes_keep_last_value():
+    processor = process(SAMPLE)
+    xml, is_valid, _ = processor.finish()
+    assert is_valid
+    assert processor.repaired_attrs == 1
+    assert 'style="rounded=0;"' in xml
+    assert 'style="rounded=1;"' not in xml
+
+def test_markdown_fences_are_removed():
+    xml, is_valid, _ = process(SAMPLE).finish()
+    assert is_valid
+    assert '```' not in xml
+    assert xml.startswith('<mxfile') and xml.endswith('</mxfile>')
+
+def test_bare_graph_model_is_wrapped_in_mxfile():
+    model = '<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/></root></mxGraphModel>'
+    xml, is_valid, _ = process(model).finish()
+    assert is_valid
+    assert xml.startswith('<mxfile host="app.diagrams.net"><diagram')
+
+def test_prose_before_xml_aborts():
+    processor = process("Sure! Here is the flowchart you asked for, with every step included:\n")
+    assert processor.abort_reason == "XML 之前出现了说明文字"
+
+def test_short_preamble_does_not_abort():
+    processor = process("```xml\n", SAMPLE.removeprefix('```xml\n'))
+    assert processor.abort_reason is None
+    assert processor.finish()[1]
+
+def test_syntax_error_aborts_while_streaming():
+    processor = process('<mxfile><diagram><mxGraphModel></diagram>')
+    assert processor.abort_reason is not None
+    assert not processor.finish()[1]
+
+def test_output_over_limit_aborts():
+    processor = main.DrawioXMLProcessor(max_chars=100)
+    processor.feed(SAMPLE)
+    assert processor.over_limit
+    assert "大小限制" in processor.abort_reason
+
+# ---------- apply_diagram_patch ----------
+
+BASE = (
+    '<mxfile><diagram id="d1"><mxGraphModel><root>'
+    '<mxCell id="0"/><mxCell id="1" parent="0"/>'
+    '<mxCell id="2" value="A" vertex="1" parent="1"><mxGeometry x="0" y="0" width="120" height="60" as="geometry"/></mxCell>'
+    '<mxCell id="3" value="B" vertex="1" parent="1"><mxGeometry x="0" y="120" width="120" height="60" as="geometry"/></mxCell>'
+    '<mxCell id="4" edge="1" parent="1" source="2" target="3"><mxGeometry relative="1" as="geometry"/></mxCell>'
+    '<mxCell id="5" value="A 的子节点" vertex="1" parent="2"><mxGeometry x="10" y="10" width="40" height="20" as="geometry"/></mxCell>'
+    '</root></mxGraphModel></diagram></mxfile>'
+)
+
+def cells(xml: str) -> dict:
+    return {cell.get('id'): cell for cell in main.ET.fromstring(xml).iter('mxCell')}
+
+def test_patch_add():
+    xml = main.apply_diagram_patch(BASE, (
+        '<patch><add><mxCell id="n1" value="C" vertex="1" parent="1">'
+        '<mxGeometry x="0" y="240" width="120" height="60" as="geometry"/></mxCell>'
+        '<mxCell id="n2" edge="1" parent="1" source="3" target="n1"><mxGeometry relative="1" as="geometry"/></mxCell>'
+        '</add></patch>'
+    ))
+    result = cells(xml)
+    assert result['n1'].get('value') == 'C'
+    assert result['n2'].get('target') == 'n1'
+    assert main.validate_xml_strict(xml)[0]
+
+def test_patch_update_attributes_and_geometry():
+    xml = main.apply_diagram_patch(BASE, '<patch><update id="2" value="A2"><mxGeometry x="200"/></update></patch>')
+    cell = cells(xml)['2']
+    assert cell.get('value') == 'A2'
+    geometry = cell.find('mxGeometry')
+    assert geometry.get('x') == '200'
+    assert geometry.get('width') == '120'
+
+def test_patch_delete_cascades_to_children_and_edges():
+    xml = main.apply_diagram_patch(BASE, '<patch><delete id="2"/></patch>')
+    assert set(cells(xml)) == {'0', '1', '3'}
+
+@pytest.mark.parametrize("patch, message", [
+    ('<patch><add><mxCell id="2" vertex="1" parent="1"/></add></patch>', "id 已存在"),
+    ('<patch><add><mxCell id="n1" vertex="1" parent="missing"/></add></patch>', "parent 不存在"),
+    ('<patch><add><mxCell vertex="1" parent="1"/></add></patch>', "缺少 id"),
+    ('<patch><update id="99" value="x"/></patch>', "要修改的元素不存在"),
+    ('<patch><delete id="99"/></patch>', "要删除的元素不存在"),
+    ('<patch><delete id="1"/></patch>', "不能删除基础单元格"),
+    ('<patch><move id="2"/></patch>', "未知的补丁操作"),
+    ('<patch/>', "补丁为空"),
+    ('<mxfile/>', "缺少 patch 根元素"),
+    ('<patch><add>', "XML 语法错误"),
+    ('<patch><add><mxCell id="n1" edge="1" parent="1" source="2" target="nowhere"/></add></patch>', "target 不存在"),
+])
+def test_patch_errors(patch, message):
+    with pytest.raises(main.DiagramPatchError, match=message):
+        main.apply_diagram_patch(BASE, patch)
+
+def test_patch_processor_sets_fallback_reason_on_mismatch():
+    processor = main.DrawioPatchProcessor(BASE)
+    processor.feed('<patch><delete id="99"/></patch>')
+    _, is_valid, error = processor.finish()
+    assert not is_valid
+    assert processor.fallback_reason == error
@@ -7,6 +7,19 @@ export function useAI() {
   const editorStore = useEditorStore()
   const templateStore = useTemplateStore()
 
+  // 获取当前会话 ID，首次生成时向后端创建会话
+  async function ensureSession() {
+    if (!conversationStore.sessionId) {
+      const response = await fetch('/api/sessions', { method: 'POST' })
+      if (!response.ok) {
+        throw new Error('创建会话失败')
+      }
+      const data = await response.json()
+      conversationStore.sessionId = data.session_id
+    }
+    return conversationStore.sessionId
+  }
+
   // 流式生成流程图
   async function generateDiagramStream(prompt, skipUserMessage = false) {
     if (!prompt) return false
@@ -28,10 +41,13 @@ export function useAI() {
 
     try {
       // 构建请求体
+      // 对话历史保存在后端会话中，只需发送本次提示词
       const requestBody = {
         prompt: prompt,
-        messages: conversationStore.conversationHistory,
-        skip_apis: conversationStore.failedAPIs
+        session_id: await ensureSession(),
+        skip_apis: conversationStore.failedAPIs,
+        // 重新生成时跳过后端缓存，否则会得到相同的结果
+        no_cache: skipUserMessage
       }
 
       // 如果选择了模板，添加自定义系统提示词
@@ -39,12 +55,35 @@ export function useAI() {
         requestBody.system_prompt = templateStore.currentTemplate.systemPrompt
       }
 
-      const response = await fetch('/api/generate-diagram-stream', {
+      const postRequest = () => fetch('/api/generate-diagram-stream', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(requestBody)
       })
 
+      let response = await postRequest()
+
+      if (response.status === 404) {
+        // 会话已过期（服务端历史已清除），新建会话后重试一次
+        conversationStore.sessionId = null
+        requestBody.session_id = await ensureSession()
+        response = await postRequest()
+      }
+
+      if (response.status === 429) {
+        // 被限流或排队已满
+        const retryAfter = response.headers.get('Retry-After')
+        conversationStore.updateStreamStatus(
+          streamMessageIndex,
+          `❌ 请求过多，${retryAfter ? `请 ${retryAfter} 秒后重试` : '请稍后重试'}`,
+          false,
+          true
+        )
+        editorStore.updateStatus('就绪', 'ready')
+        editorStore.setLoading(false)
+        return false
+      }
+
       if (!response.ok) {
         throw new Error('生成失败')
       }
@@ -52,6 +91,7 @@ export function useAI() {
       const reader = response.body.getReader()
       const decoder = new TextDecoder()
       let buffer = ''
+      let queued = false
 
       while (true) {
         const { done, value } = await reader.read()
@@ -66,9 +106,26 @@ export function useAI() {
           if (line.startsWith('data: ')) {
             const data = JSON.parse(line.slice(6))
 
-            if (data.type === 'content') {
+            if (data.type === 'queued') {
+              // 并发已满，等待排队
+              queued = true
+              editorStore.updateStatus(`排队中（第 ${data.position} 位）...`, 'loading')
+            } else if (data.type === 'start' && queued) {
+              queued = false
+              editorStore.updateStatus('生成中...', 'loading')
+            } else if (data.type === 'content') {
               // 追加内容（使用索引）
               conversationStore.appendStreamContent(streamMessageIndex, data.content)
+            } else if (data.type === 'partial') {
+              // DSL 模式：后端已把收到的部分编译为图表，先渲染到编辑器
+              editorStore.loadXMLToEditor(data.xml)
+            } else if (data.type === 'failover' || data.type === 'error') {
+              // 当前 API 失败，后端会自动切换到下一个 API，丢弃已输出的内容
+              conversationStore.resetStreamContent(streamMessageIndex)
+              editorStore.updateStatus('切换 API 重试中...', 'loading')
+            } else if (data.type === 'switch') {
+              // 并行请求中另一个 API 先完成，改为显示它的输出
+              conversationStore.resetStreamContent(streamMessageIndex)
             } else if (data.type === 'validation_failed') {
               // 验证失败
               conversationStore.updateStreamStatus(
@@ -81,15 +138,15 @@ export function useAI() {
               editorStore.setLoading(false)
               return false
             } else if (data.type === 'complete') {
-              // 生成完成（不显示状态消息）
-              conversationStore.conversationHistory = data.messages
+              // 生成完成（不显示状态消息），本轮对话已记录到会话
+              conversationStore.sessionId = data.session_id
 
               // 加载到编辑器
               editorStore.loadXMLToEditor(data.xml)
               editorStore.updateStatus('就绪', 'ready')
               editorStore.setLoading(false)
               return true
-            } else if (data.type === 'error' || data.type === 'failed') {
+            } else if (data.type === 'failed') {
               // 错误
               conversationStore.updateStreamStatus(
                 streamMessageIndex,
@@ -4,7 +4,8 @@ import { ref } from 'vue'
 export const useConversationStore = defineStore('conversation', () => {
   // 对话历史
   const messages = ref([])
-  const conversationHistory = ref([])
+  // 服务端会话 ID（对话历史保存在后端）
+  const sessionId = ref(null)
 
   // 当前提示词
   const lastPrompt = ref(null)
@@ -47,6 +48,15 @@ export const useConversationStore = defineStore('conversation', () => {
     }
   }
 
+  // 清空流式消息内容（切换 API 重新生成时使用）
+  function resetStreamContent(messageIndex) {
+    if (messageIndex >= 0 && messageIndex < messages.value.length) {
+      messages.value[messageIndex].content = ''
+      // 强制触发响应式更新
+      messages.value = [...messages.value]
+    }
+  }
+
   // 更新流式消息状态（使用索引）
   function updateStreamStatus(messageIndex, status, isCompleted = false, isError = false) {
     if (messageIndex >= 0 && messageIndex < messages.value.length) {
@@ -61,7 +71,7 @@ export const useConversationStore = defineStore('conversation', () => {
   // 清空对话
   function clearConversation() {
     messages.value = []
-    conversationHistory.value = []
+    sessionId.value = null
     lastPrompt.value = null
     lastFailedXML.value = null
     lastValidationError.value = null
@@ -87,7 +97,7 @@ export const useConversationStore = defineStore('conversation', () => {
 
   return {
     messages,
-    conversationHistory,
+    sessionId,
     lastPrompt,
     lastFailedXML,
     lastValidationError,
@@ -96,6 +106,7 @@ export const useConversationStore = defineStore('conversation', () => {
     addMessage,
     addStreamMessage,
     appendStreamContent,
+    resetStreamContent,
     updateStreamStatus,
     clearConversation,
     addWelcomeMessage,